@@ -0,0 +1,69 @@
+"""Throughput of data cell layers in MB/s of cell bodies against the number of cells encrypted together
+
+Per cell is a keystream_xor() or apply_layers() call for every cell, batched is one buffer of all the cells
+through keystream_xor_batch() or apply_layers_batch(), as the client encrypts requests and decrypts responses.
+
+Usage: python -m benchmarks.batch_crypto [hops] [cells]
+"""
+import sys
+import time
+
+from data.cryptography import KEYSTREAM_FORWARD, CircuitCrypto, batch_counter_blocks, counter_block, decode_base64, generate_session_key
+from data.onion import CELL_COUNTER_SIZE, ONION_BODY_SIZE, apply_layers, apply_layers_batch, pack_bodies, seal, unpack_bodies, wrap_counters
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+
+def mb_per_s(function, batch: int, cells: int) -> float:
+    rounds = max(1, cells // batch)
+    start = time.process_time()
+    for _ in range(rounds):
+        function()
+    elapsed = time.process_time() - start
+    return rounds * batch * ONION_BODY_SIZE / elapsed / 1e6
+
+
+def main(hops: int = 3, cells: int = 20000):
+    layers = [CircuitCrypto(decode_base64(generate_session_key())) for _ in range(hops)]
+    bodies = [seal(0, bytes(400)) for _ in range(max(BATCH_SIZES))]
+
+    print(f"MB/s of {ONION_BODY_SIZE} byte cell bodies, {hops} hops on the client")
+    print(f"{'batch':>6}{'layer':>10}{'batched':>10}{'client':>10}{'batched':>10}")
+    for batch in BATCH_SIZES:
+        blocks = [counter_block(KEYSTREAM_FORWARD, counter) for counter in range(batch)]
+        batch_bodies = bodies[:batch]
+
+        def layer_per_cell():
+            for block, body in zip(blocks, batch_bodies):
+                layers[0].keystream_xor(block, body)
+
+        def layer_batched():
+            buffer = pack_bodies(batch_bodies, ONION_BODY_SIZE)
+            layers[0].keystream_xor_batch(batch_counter_blocks(b"".join(blocks), ONION_BODY_SIZE), buffer)
+            unpack_bodies(buffer, batch, ONION_BODY_SIZE)
+
+        def client_per_cell():
+            for block, body in zip(blocks, batch_bodies):
+                hop_blocks, _ = wrap_counters(layers, block)
+                apply_layers(layers, hop_blocks, body)
+
+        def client_batched():
+            hop_blocks, _ = wrap_counters(layers, b"".join(blocks))
+            buffer = pack_bodies(batch_bodies, ONION_BODY_SIZE)
+            apply_layers_batch(layers, hop_blocks, buffer, ONION_BODY_SIZE)
+            unpack_bodies(buffer, batch, ONION_BODY_SIZE)
+
+        print(f"{batch:>6}" + "".join(f"{mb_per_s(function, batch, cells):>10.1f}" for function in (
+            layer_per_cell, layer_batched, client_per_cell, client_batched)))
+
+    # The batched layers are the same keystreams as the per cell ones
+    hop_blocks, _ = wrap_counters(layers, b"".join(counter_block(KEYSTREAM_FORWARD, counter) for counter in range(len(bodies))))
+    buffer = pack_bodies(bodies, ONION_BODY_SIZE)
+    apply_layers_batch(layers, hop_blocks, buffer, ONION_BODY_SIZE)
+    cell_blocks = lambda counter: [blocks[counter * CELL_COUNTER_SIZE:(counter + 1) * CELL_COUNTER_SIZE] for blocks in hop_blocks]
+    assert all(bytes(body) == apply_layers(layers, cell_blocks(counter), bodies[counter])
+               for counter, body in enumerate(unpack_bodies(buffer, len(bodies), ONION_BODY_SIZE)))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,76 @@
+"""Wire size and processing cost of the binary cell format against the old nested JSON + base64 framing
+
+Usage: python -m benchmarks.cell_format [request_size]
+"""
+import json
+import sys
+import timeit
+
+from data.cell import pack_cell, unpack_cell
+from data.cryptography import generate_session_key, encrypt_with_aes, decrypt_with_aes, encrypt_bytes_with_aes, decrypt_bytes_with_aes
+from data.header import TorHeader
+
+CLIENT_PORT = 9998
+SERVER_PORT = 9999
+RELAY_STARTING_PORT = 10000
+REPEAT = 200
+
+
+def json_wrap(session_keys: list, request_msg: str) -> bytes:
+    message = {"tor_header": {"circuit_id": len(session_keys), "cmd": "RELAY FORWARD"},
+               "data": {"message": request_msg}, "target_port": SERVER_PORT}
+    for i in reversed(range(len(session_keys))):
+        message = {"tor_header": {"circuit_id": i, "cmd": "RELAY FORWARD"},
+                   "data": encrypt_with_aes(session_keys[i], json.dumps(message)),
+                   "target_port": RELAY_STARTING_PORT + i}
+    message["sender_port"] = CLIENT_PORT
+    return json.dumps(message).encode()
+
+
+def json_relay_path(session_keys: list, wire: bytes):
+    """Work done by every relay on the path to peel its layer and re-frame the message"""
+    for i, sk in enumerate(session_keys):
+        message = json.loads(wire.decode())
+        inner = json.loads(decrypt_with_aes(sk, message["data"]))
+        wire = json.dumps({"tor_header": inner["tor_header"], "data": inner["data"],
+                           "sender_port": RELAY_STARTING_PORT + i}).encode()
+    return wire
+
+
+def binary_wrap(session_keys: list, request_msg: str) -> bytes:
+    tor_header, target_port, data = TorHeader(len(session_keys), "RELAY FORWARD"), SERVER_PORT, request_msg.encode()
+    for i in reversed(range(len(session_keys))):
+        inner_cell = pack_cell(tor_header, target_port, data, fixed=False)
+        data = encrypt_bytes_with_aes(session_keys[i], inner_cell)
+        tor_header, target_port = TorHeader(i, "RELAY FORWARD"), RELAY_STARTING_PORT + i
+    return pack_cell(tor_header, CLIENT_PORT, data)
+
+
+def binary_relay_path(session_keys: list, wire: bytes):
+    for i, sk in enumerate(session_keys):
+        tor_header, sender_port, data = unpack_cell(wire)
+        inner_tor_header, target_port, inner_data = unpack_cell(decrypt_bytes_with_aes(sk, data))
+        wire = pack_cell(inner_tor_header, RELAY_STARTING_PORT + i, inner_data)
+    return wire
+
+
+def main(request_size: int = 64):
+    request_msg = "x" * request_size
+    print(f"{'hops':>4}{'json B':>10}{'cell B':>10}{'json wrap us':>15}{'cell wrap us':>15}{'json path us':>15}{'cell path us':>15}")
+    for circuit_length in range(1, 11):
+        session_keys = [generate_session_key() for _ in range(circuit_length)]
+        json_wire = json_wrap(session_keys, request_msg)
+        cell_wire = binary_wrap(session_keys, request_msg)
+        assert json.loads(json_relay_path(session_keys, json_wire))["data"]["message"] == request_msg
+        assert unpack_cell(binary_relay_path(session_keys, cell_wire))[2].decode() == request_msg
+        timings = [
+            timeit.timeit(lambda: json_wrap(session_keys, request_msg), number=REPEAT),
+            timeit.timeit(lambda: binary_wrap(session_keys, request_msg), number=REPEAT),
+            timeit.timeit(lambda: json_relay_path(session_keys, json_wire), number=REPEAT),
+            timeit.timeit(lambda: binary_relay_path(session_keys, cell_wire), number=REPEAT),
+        ]
+        print(f"{circuit_length:>4}{len(json_wire):>10}{len(cell_wire):>10}" + "".join(f"{t / REPEAT * 1e6:>15.1f}" for t in timings))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,53 @@
+"""Circuit build latency with the RSA handshake, with and without the key pool, against the X25519 handshake
+
+Usage: python -m benchmarks.circuit_build [repeat]
+"""
+import sys
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, run_relay, spawn, wait_for_port
+from client import ClientNode
+from data.cryptography import HANDSHAKE_RSA, HANDSHAKE_X25519
+
+RELAY_COUNT = 10
+CIRCUIT_LENGTHS = [1, 3, 5, 10]
+# (label, handshake, key pool low watermark, key pool high watermark)
+HANDSHAKE_MODES = [
+    ("rsa", HANDSHAKE_RSA, 0, 0),
+    ("rsa pool", HANDSHAKE_RSA, 4, 12),
+    ("x25519", HANDSHAKE_X25519, 0, 0),
+]
+
+
+def main(repeat: int = 5):
+    relay_ports = {node_id: BENCH_RELAY_STARTING_PORT + node_id for node_id in range(RELAY_COUNT)}
+    relays = [spawn(run_relay, node_id, port) for node_id, port in relay_ports.items()]
+    for port in relay_ports.values():
+        wait_for_port(port)
+
+    print(f"{'handshake':<10}{'hops':>6}{'build ms':>12}{'per hop ms':>12}{'pool hits':>11}{'misses':>8}")
+    for label, handshake, pool_low, pool_high in HANDSHAKE_MODES:
+        client = ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=handshake, headless=True,
+                            key_pool_low=pool_low, key_pool_high=pool_high)
+        for circuit_length in CIRCUIT_LENGTHS:
+            if client.rsa_key_pool is not None:
+                # Idle time between circuits, as a client would have between requests
+                client.rsa_key_pool.wait_until_idle()
+                hits, misses = client.rsa_key_pool.hits, client.rsa_key_pool.misses
+            start = time.perf_counter()
+            for _ in range(repeat):
+                client.build_circuit(circuit_length)
+            elapsed = (time.perf_counter() - start) / repeat * 1e3
+            pool_counters = ""
+            if client.rsa_key_pool is not None:
+                pool_counters = f"{client.rsa_key_pool.hits - hits:>11}{client.rsa_key_pool.misses - misses:>8}"
+            print(f"{label:<10}{circuit_length:>6}{elapsed:>12.1f}{elapsed / circuit_length:>12.1f}{pool_counters}")
+        if client.rsa_key_pool is not None:
+            client.rsa_key_pool.stop()
+        client.node_socket.close()
+    for relay in relays:
+        relay.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
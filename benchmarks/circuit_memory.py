@@ -0,0 +1,87 @@
+"""Memory held by a relay's circuit state: the old dict based Circuit in plain dicts, and the compact Circuit in a CircuitTable
+
+Usage: python -m benchmarks.circuit_memory [circuits ...]
+"""
+import multiprocessing
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from data.circuit import Circuit
+from data.circuit_table import CircuitTable
+from data.cryptography import encode_base64
+
+CIRCUIT_COUNTS = [10_000, 100_000, 1_000_000]
+DOWNSTREAM_PORT = 10000
+UPSTREAM_PORT = 10001
+
+
+class LegacyCircuit:
+    """Circuit as relays kept it before: instance __dict__ and base64 key string"""
+
+    def __init__(self, circuit_id: int, sk: str):
+        self.circuit_id = circuit_id
+        self.sk = sk
+        self._downstream_port = None
+        self._upstream_port = None
+
+
+def fill_legacy(count: int):
+    circuit_dict = dict()
+    circuit_where_upstream_id_equals = dict()
+    for circuit_id in range(count):
+        circuit = LegacyCircuit(circuit_id, encode_base64(os.urandom(16)))
+        circuit._downstream_port = DOWNSTREAM_PORT
+        circuit._upstream_port = UPSTREAM_PORT
+        circuit_dict[circuit_id] = circuit
+        circuit_where_upstream_id_equals[random.getrandbits(31)] = circuit
+    return circuit_dict, circuit_where_upstream_id_equals
+
+
+def fill_table(count: int):
+    table = CircuitTable(max_circuits=count)
+    for circuit_id in range(count):
+        circuit = Circuit(circuit_id, encode_base64(os.urandom(16)))
+        circuit.downstream_port = DOWNSTREAM_PORT
+        table.add(circuit)
+        table.bind_upstream(circuit, UPSTREAM_PORT)
+    return table
+
+
+def resident_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(label: str, count: int):
+    fill = STORES[label]
+    resident_before = resident_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+    state = fill(count)
+    elapsed = time.perf_counter() - start
+    traced, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    resident = resident_bytes() - resident_before
+    # The circuits stay referenced until both sizes are taken
+    del state
+    return traced, resident, elapsed
+
+
+STORES = {"legacy": fill_legacy, "table": fill_table}
+
+
+def main(*counts: int):
+    print(f"{'store':<10}{'circuits':>10}{'traced MB':>12}{'B/circuit':>11}{'RSS MB':>10}{'fill s':>8}")
+    for count in counts or CIRCUIT_COUNTS:
+        for label in STORES:
+            # A fresh process each time, so memory freed by an earlier run does not hide in the resident size
+            with multiprocessing.Pool(1) as pool:
+                traced, resident, elapsed = pool.apply(measure, (label, count))
+            print(f"{label:<10}{count:>10}{traced / 2**20:>12.1f}{traced / count:>11.0f}{resident / 2**20:>10.1f}{elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
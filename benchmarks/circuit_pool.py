@@ -0,0 +1,67 @@
+"""Time to first byte of a request with a circuit built per request against one taken from the circuit pool
+
+Usage: python -m benchmarks.circuit_pool [requests]
+"""
+import statistics
+import sys
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, run_relay, run_server, spawn, wait_for_port
+from circuit_pool import CircuitPool
+from client import ClientNode
+from data.cryptography import HANDSHAKE_RSA, HANDSHAKE_X25519
+
+RELAY_COUNT = 10
+CIRCUIT_LENGTH = 3
+POOL_SIZE = 4
+# Low enough that the run rotates circuits while it measures
+POOL_MAX_USES = 10
+HANDSHAKE_MODES = [("rsa", HANDSHAKE_RSA), ("x25519", HANDSHAKE_X25519)]
+
+
+def report(label: str, mode: str, samples: list):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{label:<10}{mode:<12}{statistics.mean(samples):>10.2f}{statistics.median(samples):>10.2f}{p99:>10.2f}")
+
+
+def main(requests: int = 100):
+    spawn(run_server, BENCH_SERVER_PORT)
+    relay_ports = {node_id: BENCH_RELAY_STARTING_PORT + node_id for node_id in range(RELAY_COUNT)}
+    relays = [spawn(run_relay, node_id, port) for node_id, port in relay_ports.items()]
+    for port in relay_ports.values():
+        wait_for_port(port)
+    wait_for_port(BENCH_SERVER_PORT)
+
+    print(f"{CIRCUIT_LENGTH} hop circuits, {requests} requests, times in ms")
+    print(f"{'handshake':<10}{'circuit':<12}{'mean':>10}{'p50':>10}{'p99':>10}")
+    for label, handshake in HANDSHAKE_MODES:
+        client = ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=handshake, headless=True,
+                            server_port=BENCH_SERVER_PORT)
+
+        samples = []
+        for i in range(requests):
+            start = time.perf_counter()
+            client.request(f"request {i}", client.build_circuit(CIRCUIT_LENGTH))
+            samples.append((time.perf_counter() - start) * 1e3)
+        report(label, "per request", samples)
+
+        pool = CircuitPool(client, CIRCUIT_LENGTH, size=POOL_SIZE, max_uses=POOL_MAX_USES)
+        pool.wait_until_full()
+        samples = []
+        for i in range(requests):
+            start = time.perf_counter()
+            pool.request(f"request {i}")
+            samples.append((time.perf_counter() - start) * 1e3)
+        report(label, "pooled", samples)
+        print(f"{'':<10}pool {pool.stats()}")
+        pool.close()
+        if client.rsa_key_pool is not None:
+            client.rsa_key_pool.stop()
+        client.node_socket.close()
+    for relay in relays:
+        relay.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
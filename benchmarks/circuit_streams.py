@@ -0,0 +1,54 @@
+"""Requests per second over one circuit, one request at a time against pipelined streams
+
+Usage: python -m benchmarks.circuit_streams [requests]
+"""
+import sys
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, run_relay, run_server, spawn, wait_for_port
+from client import CircuitStreams, ClientNode
+from data.cryptography import HANDSHAKE_X25519
+
+RELAY_COUNT = 5
+CIRCUIT_LENGTH = 3
+# Streams in flight at once when pipelining
+WINDOWS = [1, 8, 32, 128]
+
+
+def main(requests: int = 1000):
+    spawn(run_server, BENCH_SERVER_PORT)
+    relay_ports = {node_id: BENCH_RELAY_STARTING_PORT + node_id for node_id in range(RELAY_COUNT)}
+    relays = [spawn(run_relay, node_id, port, True) for node_id, port in relay_ports.items()]
+    for port in relay_ports.values():
+        wait_for_port(port)
+    wait_for_port(BENCH_SERVER_PORT)
+
+    client = ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=HANDSHAKE_X25519, headless=True,
+                        server_port=BENCH_SERVER_PORT)
+    print(f"{CIRCUIT_LENGTH} hop circuit, {requests} requests")
+    print(f"{'mode':<16}{'req/s':>10}")
+
+    circuit = client.build_circuit(CIRCUIT_LENGTH)
+    start = time.perf_counter()
+    for i in range(requests):
+        client.request(f"request {i}", circuit)
+    print(f"{'blocking':<16}{requests / (time.perf_counter() - start):>10.0f}")
+
+    streams = CircuitStreams(client, circuit)
+    for window in WINDOWS:
+        start = time.perf_counter()
+        in_flight = []
+        for i in range(requests):
+            in_flight.append(streams.submit(f"request {i}"))
+            if len(in_flight) >= window:
+                in_flight.pop(0).result(timeout=5)
+        for future in in_flight:
+            future.result(timeout=5)
+        print(f"{f'streams x{window}':<16}{requests / (time.perf_counter() - start):>10.0f}")
+    streams.close()
+    for relay in relays:
+        relay.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""Many clients with many circuits each through shared relays, checking every response comes back on its own circuit
+
+Usage: python -m benchmarks.circuit_stress [clients] [circuits per client] [rounds]
+"""
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, run_relay, run_server, spawn, wait_for_port
+from client import ClientNode
+from data.cell import unpack_cell
+from data.cryptography import HANDSHAKE_X25519
+
+RELAY_COUNT = 5
+CIRCUIT_LENGTH = 3
+
+
+def client_loop(client: ClientNode, client_id: int, circuits: int, rounds: int, results: dict):
+    # Every circuit shares the client's socket, so all of them share the link to their first relay
+    circuit_by_id = dict()
+    while len(circuit_by_id) < circuits:
+        client_circuit = client.build_circuit(CIRCUIT_LENGTH)
+        circuit_by_id[client_circuit.circuit_list[0].circuit_id] = client_circuit
+    results[client_id] = {"built": time.perf_counter(), "ok": 0, "wrong": 0}
+
+    client.node_socket.sc.settimeout(5)
+    for round_number in range(rounds):
+        expected = dict()
+        for circuit_id, client_circuit in circuit_by_id.items():
+            request_msg = f"client {client_id} circuit {circuit_id} round {round_number}"
+            expected[circuit_id] = request_msg + " accepted"
+            client.send_request(request_msg, client_circuit)
+        for _ in range(len(circuit_by_id)):
+            inbound_tor_header, sender_port, data = unpack_cell(client.listen_procedure())
+            stream_id, response = client.handle_response(data, circuit_by_id[inbound_tor_header.circuit_id])
+            if response == expected.pop(inbound_tor_header.circuit_id, None):
+                results[client_id]["ok"] += 1
+            else:
+                results[client_id]["wrong"] += 1
+    results[client_id]["done"] = time.perf_counter()
+
+
+def main(clients: int = 8, circuits: int = 64, rounds: int = 5):
+    spawn(run_server, BENCH_SERVER_PORT)
+    relay_ports = {node_id: BENCH_RELAY_STARTING_PORT + node_id for node_id in range(RELAY_COUNT)}
+    relays = [spawn(run_relay, node_id, port, True) for node_id, port in relay_ports.items()]
+    for port in relay_ports.values():
+        wait_for_port(port)
+    wait_for_port(BENCH_SERVER_PORT)
+
+    nodes = [ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=HANDSHAKE_X25519, headless=True,
+                        server_port=BENCH_SERVER_PORT) for _ in range(clients)]
+    results = dict()
+    threads = [threading.Thread(target=client_loop, args=(nodes[i], i, circuits, rounds, results)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ok = sum(result["ok"] for result in results.values())
+    wrong = sum(result["wrong"] for result in results.values())
+    built = max(result["built"] for result in results.values()) - start
+    requests_time = max(result["done"] for result in results.values()) - max(result["built"] for result in results.values())
+    print(f"{clients} clients x {circuits} circuits of {CIRCUIT_LENGTH} hops through {RELAY_COUNT} relays")
+    print(f"built {clients * circuits} circuits in {built:.1f} s")
+    print(f"{ok} responses on the right circuit, {wrong} wrong, {clients * circuits * rounds - ok - wrong} lost")
+    print(f"{(ok + wrong) / requests_time:.0f} requests/s once built")
+    for relay in relays:
+        relay.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,86 @@
+"""Relay circuit tables under churn: DESTROY propagation along circuits, then capacity and idle eviction
+
+Usage: python -m benchmarks.circuit_teardown [circuits]
+"""
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT
+from client import ClientNode
+from data.cell import pack_cell
+from data.cryptography import HANDSHAKE_X25519, generate_x25519_key
+from data.header import TorHeader
+from node_socket import UdpSocket
+from relay_node import RelayNode
+
+RELAY_COUNT = 3
+CIRCUIT_LENGTH = 3
+MAX_CIRCUITS = 1000
+IDLE_TIMEOUT = 5.0
+
+
+def start_relay(node_id: int, **table_limits) -> RelayNode:
+    # In process so the benchmark can read the circuit table metrics directly
+    relay = RelayNode(my_id=node_id, my_port=BENCH_RELAY_STARTING_PORT + node_id, ports_of_nodes=[], node_number=0, **table_limits)
+    threading.Thread(target=relay.start, daemon=True).start()
+    return relay
+
+
+def wait_for_live(relays: list, live: int, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(len(relay.circuits) != live for relay in relays):
+        time.sleep(0.01)
+
+
+def wait_for_created(relay: RelayNode, created: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and relay.circuits.created < created:
+        time.sleep(0.01)
+
+
+def main(circuits: int = 3000):
+    relays = [start_relay(node_id) for node_id in range(RELAY_COUNT)]
+    client = ClientNode(my_port=0, node_and_port_dict={relay.my_id: relay.my_port for relay in relays}, main_gui=None,
+                        handshake=HANDSHAKE_X25519, headless=True)
+    built = [client.build_circuit(CIRCUIT_LENGTH) for _ in range(circuits // 10)]
+    print(f"{len(built)} circuits of {CIRCUIT_LENGTH} hops built")
+    for relay in relays:
+        print(f"  relay {relay.my_id}: {relay.circuits.stats()}")
+    start = time.perf_counter()
+    for client_circuit in built:
+        client.destroy_circuit(client_circuit)
+    wait_for_live(relays, 0)
+    print(f"destroyed from the client in {(time.perf_counter() - start) * 1e3:.0f} ms")
+    for relay in relays:
+        print(f"  relay {relay.my_id}: {relay.circuits.stats()}")
+
+    sender = UdpSocket(0)
+    sender_port = sender.sc.getsockname()[1]
+    private_key, public_key = generate_x25519_key()
+    create_data = bytes([HANDSHAKE_X25519]) + public_key
+
+    relay = start_relay(RELAY_COUNT, max_circuits=MAX_CIRCUITS)
+    start = time.perf_counter()
+    for circuit_id in range(circuits):
+        sender.send(pack_cell(TorHeader(circuit_id, "CREATE"), sender_port, create_data), relay.my_port)
+    wait_for_created(relay, circuits)
+    print(f"{circuits} CREATE cells into a relay holding at most {MAX_CIRCUITS} circuits in {time.perf_counter() - start:.1f} s")
+    print(f"  relay {relay.my_id}: {relay.circuits.stats()}")
+
+    relay = start_relay(RELAY_COUNT + 1, idle_timeout=IDLE_TIMEOUT)
+    for circuit_id in range(MAX_CIRCUITS):
+        sender.send(pack_cell(TorHeader(circuit_id, "CREATE"), sender_port, create_data), relay.my_port)
+    wait_for_created(relay, MAX_CIRCUITS)
+    print(f"{MAX_CIRCUITS} circuits into a relay with a {IDLE_TIMEOUT} s idle timeout")
+    print(f"  relay {relay.my_id}: {relay.circuits.stats()}")
+    time.sleep(IDLE_TIMEOUT)
+    # Idle circuits are evicted when the relay handles its next cell
+    sender.send(pack_cell(TorHeader(MAX_CIRCUITS, "CREATE"), sender_port, create_data), relay.my_port)
+    wait_for_created(relay, MAX_CIRCUITS + 1)
+    print(f"after {IDLE_TIMEOUT} s idle")
+    print(f"  relay {relay.my_id}: {relay.circuits.stats()}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,95 @@
+import itertools
+import multiprocessing
+import socket
+import time
+
+from data.cell import pack_cell, unpack_cell
+from data.circuit import Circuit
+from data.cryptography import HANDSHAKE_RSA, KEYSTREAM_FORWARD, counter_block, generate_rsa_key, decrypt_with_rsa
+from data.header import TorHeader
+from data.onion import onion_payload, seal, split_payload, unseal
+from data.stream import pack_stream, unpack_stream
+from node_socket import SEND_POOL_SIZE, UdpSocket
+
+BENCH_SERVER_PORT = 19999
+BENCH_RELAY_STARTING_PORT = 20000
+
+
+def spawn(target, *args) -> multiprocessing.Process:
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    return process
+
+
+def run_server(my_port: int, async_mode: bool = True, workers: int = 4, handler=None):
+    from server_node import ServerNode
+    obj = ServerNode(my_port=my_port, node_number=0, handler=handler)
+    if async_mode:
+        obj.start_async()
+    else:
+        obj.serve_forever(workers)
+
+
+def run_relay(node_id: int, my_port: int, async_mode: bool = False, workers: int = 0, pool_size: int = SEND_POOL_SIZE,
+              shard: int = 0, shards: int = 1, sc: socket.socket = None, handshake_pool=None):
+    from relay_node import RelayNode
+    obj = RelayNode(my_id=node_id, my_port=my_port, ports_of_nodes=[], node_number=0, worker=shard, workers=shards, sc=sc,
+                    handshake_pool=handshake_pool)
+    obj.node_socket.pool_size = pool_size
+    if async_mode:
+        obj.start_async(workers)
+    else:
+        obj.start()
+
+
+class BenchClient:
+    """Minimal client speaking the onion protocol over a one hop circuit
+
+    Each instance owns its socket so many of them can run side by side in threads
+    """
+
+    def __init__(self, timeout: float = 2.0):
+        self.node_socket = UdpSocket(0)
+        self.node_socket.sc.settimeout(timeout)
+        self.my_port = self.node_socket.sc.getsockname()[1]
+        self.cell_counter = itertools.count()
+
+    def send(self, tor_header: TorHeader, data: bytes, port: int):
+        self.node_socket.send(pack_cell(tor_header, self.my_port, data), port)
+
+    def receive(self) -> bytes:
+        inbound_message, address = self.node_socket.listen()
+        tor_header, sender_port, data = unpack_cell(inbound_message)
+        return data
+
+    def create(self, circuit_id: int, relay_port: int, key_pair=None) -> Circuit:
+        private_key, public_key = key_pair or generate_rsa_key()
+        self.send(TorHeader(circuit_id, "CREATE"), bytes([HANDSHAKE_RSA]) + public_key.encode(), relay_port)
+        circuit = Circuit(circuit_id, decrypt_with_rsa(private_key, self.receive()[1:].decode()))
+        circuit.upstream_port = relay_port
+        return circuit
+
+    def request(self, circuit: Circuit, request_msg: str, server_port: int = BENCH_SERVER_PORT) -> str:
+        block = counter_block(KEYSTREAM_FORWARD, next(self.cell_counter))
+        body = circuit.crypto.keystream_xor(block, seal(server_port, pack_stream(0, request_msg.encode())))
+        self.send(TorHeader(circuit.circuit_id, "RELAY FORWARD"), onion_payload(circuit.crypto.wrap_counters(block), body), circuit.upstream_port)
+        block, body = split_payload(self.receive())
+        block = circuit.crypto.unwrap_counters(block)
+        port, data = unseal(circuit.crypto.keystream_xor(block, body))
+        stream_id, response = unpack_stream(data)
+        return response.decode()
+
+
+def wait_for_port(port: int, timeout: float = 5.0):
+    """Block until a UDP node has bound its port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.bind(("127.0.0.1", port))
+        except OSError:
+            return
+        finally:
+            probe.close()
+        time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
@@ -0,0 +1,36 @@
+"""Per-cell crypto cost with a cipher built on every call against CircuitCrypto and the cipher cache
+
+The cold row cycles through more circuits than the cache holds, so every call builds its cipher again.
+
+Usage: python -m benchmarks.crypto_cost [repeat]
+"""
+import itertools
+import os
+import sys
+import timeit
+
+from data.cell import CELL_PAYLOAD_SIZE
+from data.cryptography import AES_CIPHER_CACHE_SIZE, CircuitCrypto, decode_base64, decrypt_bytes_with_aes, encrypt_bytes_with_aes, generate_session_key
+
+
+def main(repeat: int = 20000):
+    sk = generate_session_key()
+    crypto = CircuitCrypto(decode_base64(sk))
+    payload = bytes(CELL_PAYLOAD_SIZE - 16)
+    ciphertext = crypto.encrypt(payload)
+    cold = itertools.cycle([CircuitCrypto(os.urandom(16)) for _ in range(2 * AES_CIPHER_CACHE_SIZE)])
+
+    rows = [
+        ("AES encrypt", lambda: encrypt_bytes_with_aes(sk, payload), lambda: crypto.encrypt(payload), repeat),
+        ("AES decrypt", lambda: decrypt_bytes_with_aes(sk, ciphertext), lambda: crypto.decrypt(ciphertext), repeat),
+        ("AES cold", lambda: encrypt_bytes_with_aes(sk, payload), lambda: next(cold).encrypt(payload), repeat),
+    ]
+    print(f"{'operation':<14}{'per call us':>13}{'circuit us':>12}{'speedup':>10}")
+    for name, per_call, kept, number in rows:
+        before = timeit.timeit(per_call, number=number) / number * 1e6
+        after = timeit.timeit(kept, number=number) / number * 1e6
+        print(f"{name:<14}{before:>13.2f}{after:>12.2f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
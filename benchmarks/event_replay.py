@@ -0,0 +1,96 @@
+"""Replay time of a run's GUI events: the old scan over the text logs against the binary event traces
+
+Usage: python -m benchmarks.event_replay [events ...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from data.event_trace import EventTraceWriter, LiveEventFeed
+
+EVENT_COUNTS = [10_000, 100_000, 200_000, 1_000_000]
+# The text log scan is quadratic, it is skipped above this many events
+LEGACY_MAX_EVENTS = 200_000
+RELAY_COUNT = 10
+CIRCUIT_LENGTH = 3
+DETAIL = "08:00:00 INFO   MainThread:100 Relaying message to next target port 10001...\n" * 3
+
+
+def event_route(events: int) -> list:
+    """(node, next node) of every event: requests going from the client to the server over random circuits and back"""
+    route = []
+    while len(route) < events:
+        path = ["Client"] + [f"Relay {relay}" for relay in random.sample(range(RELAY_COUNT), CIRCUIT_LENGTH)] + ["Server"]
+        path += path[-2::-1]
+        route.extend(zip(path, path[1:] + ["Client"]))
+    return route[:events]
+
+
+def write_run(directory: str, events: int):
+    traces = dict()
+    logs = dict()
+    for node, next_node in event_route(events):
+        if node not in traces:
+            traces[node] = EventTraceWriter(directory, node)
+            logs[node] = open(os.path.join(directory, f"{node}.txt"), "w")
+        traces[node].append(f"{node}: event", next_node, DETAIL.rstrip("\n"))
+        logs[node].write(f"08:00:00 INFO   MainThread:10 \nGUI_EVENT_START\n{node}: event\n{DETAIL}"
+                         f"08:00:00 INFO   MainThread:20 \nGUI_EVENT_STOP\nNext event at: {next_node}\n")
+    for node in traces:
+        traces[node].close()
+        logs[node].close()
+
+
+def legacy_replay(directory: str) -> list:
+    """ClientNode.organize_event_for_simulation as it was, minus reading the relay list out of the client log"""
+    unread_logs_dict = dict()
+    for file_name in os.listdir(directory):
+        if file_name.endswith(".txt"):
+            with open(os.path.join(directory, file_name)) as log:
+                unread_logs_dict[file_name[:-4]] = [line.rstrip('\n') for line in log.readlines()]
+    event_list = []
+    current_node_log = "Client"
+    while True:
+        start_line = None
+        stop_line = None
+        for i, each_line in enumerate(unread_logs_dict[current_node_log]):
+            if each_line == "GUI_EVENT_START":
+                start_line = i
+            if each_line == "GUI_EVENT_STOP":
+                stop_line = i - 1
+                break
+        if start_line == None or stop_line == None:
+            return event_list
+        event_name = unread_logs_dict[current_node_log][start_line + 1]
+        event_list.append((event_name, "\n".join(unread_logs_dict[current_node_log][start_line + 2:stop_line])))
+        next_node = unread_logs_dict[current_node_log][stop_line + 2][15:]
+        del unread_logs_dict[current_node_log][:stop_line + 3]
+        current_node_log = next_node
+
+
+def main(*counts: int):
+    print(f"{'events':>8}{'text log s':>12}{'trace s':>10}{'events/s':>11}")
+    for events in counts or EVENT_COUNTS:
+        directory = tempfile.mkdtemp()
+        write_run(directory, events)
+
+        legacy = "skipped"
+        if events <= LEGACY_MAX_EVENTS:
+            start = time.perf_counter()
+            legacy_events = legacy_replay(directory)
+            legacy = f"{time.perf_counter() - start:.2f}"
+        start = time.perf_counter()
+        feed = LiveEventFeed(directory)
+        replayed = [(event.name, event.detail) for event in feed.poll()]
+        elapsed = time.perf_counter() - start
+        feed.close()
+        assert len(replayed) == events
+        if events <= LEGACY_MAX_EVENTS:
+            assert replayed == legacy_events
+        print(f"{events:>8}{legacy:>12}{elapsed:>10.2f}{events / elapsed:>11.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,89 @@
+"""Live event viewer: how fast the feed tails traces that relays are still writing, and what adding and
+scrolling through rows costs in a Tk Listbox against VirtualListbox (needs a display)
+
+Usage: python -m benchmarks.event_viewer [events] [relays]
+"""
+import sys
+import tempfile
+import threading
+import time
+import tkinter as tk
+
+from benchmarks.event_replay import DETAIL
+from data.event_trace import EventTraceWriter, LiveEventFeed
+from event_viewer import VirtualListbox
+
+WRITE_BATCH = 1000
+
+
+def write_run(directory: str, events: int, relays: int):
+    """Events going round Client -> Relay 0 -> ... -> Relay n -> Client, flushed every WRITE_BATCH events"""
+    nodes = ["Client"] + [f"Relay {relay}" for relay in range(relays)]
+    traces = [EventTraceWriter(directory, node) for node in nodes]
+    for position in range(events):
+        hop = position % len(nodes)
+        traces[hop].append(f"{nodes[hop]}: event {position}", nodes[(hop + 1) % len(nodes)], DETAIL)
+        if position % WRITE_BATCH == 0:
+            for trace in traces:
+                trace.flush()
+    for trace in traces:
+        trace.close()
+
+
+def tail_run(events: int, relays: int):
+    directory = tempfile.mkdtemp()
+    # The feed starts before the traces exist, like the client gui does
+    writer = threading.Thread(target=write_run, args=(directory, events, relays))
+    start = time.perf_counter()
+    writer.start()
+    feed = LiveEventFeed(directory)
+    received = 0
+    polls = 0
+    while received < events:
+        received += len(feed.poll(5000))
+        polls += 1
+    elapsed = time.perf_counter() - start
+    writer.join()
+    feed.close()
+    print(f"tailed {received} events from {relays + 1} traces being written in {elapsed:.2f} s, {polls} polls, "
+          f"{received / elapsed:.0f} events/s")
+
+
+def fill_and_scroll(widget, append, events: int) -> tuple:
+    rows = [f"Relay {position % 100}: event {position}" for position in range(events)]
+    start = time.perf_counter()
+    for position in range(0, events, WRITE_BATCH):
+        append(rows[position:position + WRITE_BATCH])
+        widget.update()
+    fill = time.perf_counter() - start
+    start = time.perf_counter()
+    for step in range(100):
+        widget.yview("moveto", step / 100)
+        widget.update()
+    return fill, (time.perf_counter() - start) / 100 * 1e3
+
+
+def gui_run(events: int):
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"widget comparison skipped: {e}")
+        return
+    listbox = tk.Listbox(root, height=20)
+    listbox.pack()
+    fill, scroll = fill_and_scroll(listbox, lambda rows: listbox.insert("end", *rows), events)
+    print(f"Tk Listbox       fill {fill:.2f} s, scroll {scroll:.2f} ms per jump")
+    virtual = VirtualListbox(root, height=20)
+    virtual.pack()
+    fill, scroll = fill_and_scroll(virtual, virtual.append, events)
+    print(f"VirtualListbox   fill {fill:.2f} s, scroll {scroll:.2f} ms per jump")
+    root.destroy()
+
+
+def main(events: int = 100_000, relays: int = 200):
+    tail_run(events, relays)
+    gui_run(events)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
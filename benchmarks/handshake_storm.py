@@ -0,0 +1,103 @@
+"""Latency of data cells through a relay while it is flooded with RSA CREATE cells
+
+A client sends requests one at a time over an existing circuit through the relay, first on an idle
+relay and then while a storm process sends CREATE cells at a fixed rate. The relay does the public
+key work of the storm inline, or in a handshake pool of worker processes.
+
+Usage: python -m benchmarks.handshake_storm [creates per second] [seconds]
+"""
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, BenchClient, run_relay, run_server, spawn, wait_for_port
+from data.cell import pack_cell, unpack_cell
+from data.cryptography import HANDSHAKE_RSA, generate_rsa_key
+from data.gui_logging_tools import set_fast_mode
+from data.header import TorHeader
+from handshake_pool import HandshakePool
+from node_socket import DATAGRAM_SIZE, FRAGMENT_STRUCT, fragment
+
+# (label, handshake pool workers), 0 does the handshakes in the relay
+RELAY_MODES = [("inline", 0), ("pool x1", 1), ("pool x2", 2)]
+
+
+def storm(relay_port: int, public_key: str, rate: int, seconds: float, replies: multiprocessing.Queue):
+    sc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sc.bind(("127.0.0.1", 0))
+    sc.setblocking(False)
+    my_port = sc.getsockname()[1]
+    counts = {"CREATED": 0, "DESTROY": 0}
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < seconds:
+        if sent < (time.monotonic() - start) * rate:
+            sent += 1
+            for datagram in fragment(pack_cell(TorHeader(sent, "CREATE"), my_port, bytes([HANDSHAKE_RSA]) + public_key.encode())):
+                sc.sendto(datagram, ("127.0.0.1", relay_port))
+        try:
+            datagram = sc.recv(DATAGRAM_SIZE)
+            tor_header, sender_port, data = unpack_cell(datagram[FRAGMENT_STRUCT.size:])
+            counts[tor_header.cmd] += 1
+        except BlockingIOError:
+            time.sleep(0.0002)
+    replies.put((sent, counts))
+
+
+def request_latencies(client: BenchClient, circuit, seconds: float) -> list:
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            client.request(circuit, "ping")
+        except socket.timeout:
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def summary(latencies: list) -> str:
+    latencies = sorted(latencies)
+    p50, p99 = (latencies[min(len(latencies) - 1, len(latencies) * percent // 100)] * 1e3 for percent in (50, 99))
+    return f"{len(latencies):>9}{p50:>9.2f}{p99:>9.2f}{latencies[-1] * 1e3:>9.2f}"
+
+
+def main(rate: int = 300, seconds: int = 3):
+    # A pool that falls behind refuses CREATE cells with a warning each, the table below counts them
+    logging.getLogger().setLevel(logging.ERROR)
+    set_fast_mode(True)
+    server = spawn(run_server, BENCH_SERVER_PORT, True)
+    wait_for_port(BENCH_SERVER_PORT)
+    key_pair = generate_rsa_key()
+    storm_private_key, storm_public_key = generate_rsa_key()
+    print(f"{'relay':<10}{'phase':<8}{'requests':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}   CREATE cells")
+    for label, pool_workers in RELAY_MODES:
+        relay_port = BENCH_RELAY_STARTING_PORT + pool_workers
+        pool = None
+        if pool_workers:
+            pool = HandshakePool(pool_workers)
+            pool.start()
+        relay = spawn(run_relay, 0, relay_port, False, 0, 16, 0, 1, None, pool)
+        wait_for_port(relay_port)
+        client = BenchClient()
+        circuit = client.create(1 << 30, relay_port, key_pair)
+
+        print(f"{label:<10}{'idle':<8}{summary(request_latencies(client, circuit, seconds))}")
+        replies = multiprocessing.Queue()
+        storm_process = spawn(storm, relay_port, storm_public_key, rate, seconds, replies)
+        latencies = request_latencies(client, circuit, seconds)
+        sent, counts = replies.get()
+        print(f"{label:<10}{'storm':<8}{summary(latencies)}   {sent} sent, {counts['CREATED']} created, {counts['DESTROY']} refused")
+        storm_process.join()
+        relay.terminate()
+        relay.join()
+        if pool is not None:
+            pool.terminate()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,49 @@
+"""Per-hop latency of requests over one circuit, from the hop records traced cells carry
+
+Relays and a persistent server are started the way main.py starts them, in fast mode, and a client with
+trace_hops sends requests over a circuit through them. Prints the transit, queue and crypto times of
+every position along the circuit and of every node, as JSON.
+
+Usage: python -m benchmarks.hop_latency [relays] [circuit length] [requests]
+"""
+import json
+import logging
+import sys
+
+import main as simulator
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, wait_for_port
+from client import ClientNode
+from data.cryptography import HANDSHAKE_X25519
+from data.gui_logging_tools import set_fast_mode
+
+PAYLOAD_SIZE = 400
+# Seconds without a response before the run is given up
+RESPONSE_TIMEOUT = 2.0
+
+
+def main(relays: int = 5, circuit_length: int = 3, requests: int = 2000):
+    logging.getLogger().setLevel(logging.WARNING)
+    set_fast_mode(True)
+    relay_ports = simulator.start_nodes(relays, BENCH_SERVER_PORT, BENCH_RELAY_STARTING_PORT, persistent=True, fast=True)
+    for port in list(relay_ports.values()) + [BENCH_SERVER_PORT]:
+        wait_for_port(port)
+
+    client = ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=HANDSHAKE_X25519, headless=True,
+                        server_port=BENCH_SERVER_PORT, trace_hops=True)
+    client.node_socket.sc.settimeout(RESPONSE_TIMEOUT)
+    try:
+        client_circuit = client.build_circuit(circuit_length)
+        payload = "x" * PAYLOAD_SIZE
+        for _ in range(requests):
+            client.request(payload, client_circuit)
+        node_names = {port: f"Relay {node_id}" for node_id, port in relay_ports.items()}
+        node_names[BENCH_SERVER_PORT] = "Server"
+        node_names[client_circuit.port] = "Client"
+        print(json.dumps(client.hop_stats.report(node_names), indent=2))
+    finally:
+        for process in simulator.list_nodes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
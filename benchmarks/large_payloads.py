@@ -0,0 +1,66 @@
+"""Throughput of fragmented messages, over the bare transport and round trip through a relay and the server
+
+Usage: python -m benchmarks.large_payloads [repeat]
+"""
+import os
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, BenchClient, run_relay, run_server, spawn, wait_for_port
+from data.cryptography import generate_rsa_key
+from node_socket import UdpSocket
+
+PAYLOAD_SIZES = [1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def transport_throughput(size: int, repeat: int) -> float:
+    receiver = UdpSocket(0)
+    sender_socket = UdpSocket(0)
+    port = receiver.sc.getsockname()[1]
+    message = os.urandom(size)
+
+    def sender():
+        for _ in range(repeat):
+            sender_socket.send(message, port)
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=sender)
+    thread.start()
+    for _ in range(repeat):
+        receiver.listen()
+    thread.join()
+    elapsed = time.perf_counter() - start
+    receiver.close()
+    sender_socket.close()
+    return size * repeat / elapsed / 1e6
+
+
+def circuit_throughput(client: BenchClient, circuit, size: int, repeat: int) -> float:
+    request_msg = "x" * size
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = client.request(circuit, request_msg)
+        assert len(response) == size + len(" accepted")
+    elapsed = time.perf_counter() - start
+    # Request and response both cross the relay
+    return 2 * size * repeat / elapsed / 1e6
+
+
+def main(repeat: int = 5):
+    server = spawn(run_server, BENCH_SERVER_PORT, False)
+    relay = spawn(run_relay, 0, BENCH_RELAY_STARTING_PORT, False)
+    wait_for_port(BENCH_SERVER_PORT)
+    wait_for_port(BENCH_RELAY_STARTING_PORT)
+    client = BenchClient(timeout=30.0)
+    circuit = client.create(0, BENCH_RELAY_STARTING_PORT, generate_rsa_key())
+
+    print(f"{'payload KiB':>12}{'transport MB/s':>16}{'1 hop MB/s':>12}")
+    for size in PAYLOAD_SIZES:
+        print(f"{size // 1024:>12}{transport_throughput(size, repeat):>16.1f}{circuit_throughput(client, circuit, size, repeat):>12.1f}")
+    relay.terminate()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,151 @@
+"""Headless load run: relays and a persistent server started the way main.py starts them, in fast mode, then
+concurrent clients building circuits of several lengths and sending payloads of several sizes
+
+Prints one JSON object per (circuit length, payload size) with circuit build times, throughput and
+request latency percentiles.
+
+Usage: python -m benchmarks.load_harness [relays] [clients] [requests per client] [circuit lengths] [payload sizes]
+with the circuit lengths and payload sizes comma separated, like 1,3,5 and 16,400,4000
+"""
+import json
+import logging
+import socket
+import sys
+import threading
+import time
+
+import main as simulator
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, wait_for_port
+from client import ClientNode
+from data.cryptography import HANDSHAKE_X25519
+from data.gui_logging_tools import set_fast_mode
+from node_socket import UdpSocket
+
+CIRCUIT_LENGTHS = [1, 3, 5]
+PAYLOAD_SIZES = [16, 400, 4000]
+# Seconds without a response before a request counts as lost
+RESPONSE_TIMEOUT = 2.0
+
+
+def percentiles_ms(samples: list) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    summary = {f"p{percent}": round(samples[min(len(samples) - 1, len(samples) * percent // 100)] * 1e3, 3) for percent in (50, 90, 99)}
+    summary["max"] = round(samples[-1] * 1e3, 3)
+    return summary
+
+
+def circuit_socket() -> UdpSocket:
+    """Every circuit gets a socket of its own, so a late response on an abandoned circuit is never read on the next one"""
+    node_socket = UdpSocket(0)
+    node_socket.sc.settimeout(RESPONSE_TIMEOUT)
+    return node_socket
+
+
+def retire(client: ClientNode, client_circuit):
+    client.destroy_circuit(client_circuit)
+    client_circuit.node_socket.close()
+
+
+def build(client: ClientNode, circuit_length: int, result: dict):
+    """A new circuit, None if a relay refused it or did not answer in time"""
+    node_socket = circuit_socket()
+    start = time.perf_counter()
+    try:
+        client_circuit = client.build_circuit(circuit_length, node_socket)
+    except (socket.timeout, ConnectionError):
+        node_socket.close()
+        result["failed_builds"] += 1
+        return None
+    result["build"].append(time.perf_counter() - start)
+    return client_circuit
+
+
+def client_loop(client: ClientNode, circuit_length: int, payload: str, requests: int, results: list):
+    result = {"build": [], "latency": [], "lost": 0, "failed_builds": 0}
+    results.append(result)
+    client_circuit = build(client, circuit_length, result)
+    result["started"] = time.perf_counter()
+    try:
+        for _ in range(requests):
+            if client_circuit is None:
+                client_circuit = build(client, circuit_length, result)
+                if client_circuit is None:
+                    result["lost"] += 1
+                    continue
+            start = time.perf_counter()
+            try:
+                client.request(payload, client_circuit)
+            except (socket.timeout, ConnectionError):
+                # A late response would be taken for the next one, carry on over a new circuit
+                result["lost"] += 1
+                retire(client, client_circuit)
+                client_circuit = None
+                continue
+            result["latency"].append(time.perf_counter() - start)
+    finally:
+        result["done"] = time.perf_counter()
+        if client_circuit is not None:
+            retire(client, client_circuit)
+
+
+def run_scenario(clients: list, circuit_length: int, payload_size: int, requests: int) -> dict:
+    results = []
+    payload = "x" * payload_size
+    threads = [threading.Thread(target=client_loop, args=(client, circuit_length, payload, requests, results)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A client thread that died on an unexpected error has no times, its requests are left out
+    results = [result for result in results if "done" in result]
+    # Throughput over the time requests were being sent, circuit builds apart
+    elapsed = max((result["done"] for result in results), default=0.0) - min((result["started"] for result in results), default=0.0)
+    latencies = [latency for result in results for latency in result["latency"]]
+    builds = [build for result in results for build in result["build"]]
+    return {
+        "relays": len(clients[0].node_and_port_dict),
+        "clients": len(clients),
+        "circuit_length": circuit_length,
+        "payload_bytes": payload_size,
+        "requests": len(latencies),
+        "lost": sum(result["lost"] for result in results),
+        "failed_builds": sum(result["failed_builds"] for result in results),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "build_ms": percentiles_ms(builds),
+        "latency_ms": percentiles_ms(latencies),
+    }
+
+
+def int_list(arg: str) -> list:
+    return [int(value) for value in arg.split(",")]
+
+
+def main(relays: int = 8, clients: int = 8, requests: int = 200, circuit_lengths: list = CIRCUIT_LENGTHS,
+         payload_sizes: list = PAYLOAD_SIZES):
+    # Nodes log nothing but warnings and the harness prints its results only
+    logging.getLogger().setLevel(logging.WARNING)
+    set_fast_mode(True)
+    relay_ports = simulator.start_nodes(relays, BENCH_SERVER_PORT, BENCH_RELAY_STARTING_PORT, persistent=True, fast=True)
+    for port in list(relay_ports.values()) + [BENCH_SERVER_PORT]:
+        wait_for_port(port)
+
+    nodes = []
+    for _ in range(clients):
+        nodes.append(ClientNode(my_port=0, node_and_port_dict=relay_ports, main_gui=None, handshake=HANDSHAKE_X25519, headless=True,
+                                server_port=BENCH_SERVER_PORT))
+    try:
+        for circuit_length in circuit_lengths:
+            if circuit_length > relays:
+                continue
+            for payload_size in payload_sizes:
+                print(json.dumps(run_scenario(nodes, circuit_length, payload_size, requests)), flush=True)
+    finally:
+        for process in simulator.list_nodes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) if i < 3 else int_list(arg) for i, arg in enumerate(sys.argv[1:])))
@@ -0,0 +1,65 @@
+"""Relay latency per cell with teaching mode narration logged synchronously to a file, through the queued
+background writer, and with logging off
+
+Usage: python -m benchmarks.logging_latency [cells]
+"""
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from benchmarks.relay_cell_cpu import relay_cells
+from data.node_logging import NODE_LOG_DATE_FORMAT, NODE_LOG_FORMAT, start_node_logging
+
+
+def log_synchronously(filename: str):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(format=NODE_LOG_FORMAT, datefmt=NODE_LOG_DATE_FORMAT, filename=filename, filemode='w', level=logging.INFO)
+
+
+def log_nothing(filename: str):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(logging.WARNING)
+
+
+def latencies_us(relay, cell: bytes, cells: int, gap: float) -> list:
+    latencies = []
+    for _ in range(cells):
+        # A relay waits in recvfrom between cells, which lets the writer thread run
+        time.sleep(gap)
+        start = time.perf_counter()
+        relay.handle_message(cell)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return latencies
+
+
+def main(cells: int = 10000, gap_us: int = 500):
+    relay, cases, sockets = relay_cells()
+    log_file = os.path.join(tempfile.mkdtemp(), "Relay 0.txt")
+    modes = [
+        ("off", log_nothing),
+        ("synchronous", log_synchronously),
+        ("queued", lambda filename: start_node_logging(filename, logging.INFO)),
+    ]
+    print(f"{'logging':<13}{'cell':<16}{'p50 us':>8}{'p99 us':>8}{'max us':>9}{'dropped':>9}")
+    for label, configure in modes:
+        writer = configure(log_file)
+        for name, cell in cases.items():
+            latencies = sorted(latencies_us(relay, cell, cells, gap_us / 1e6))
+            dropped = writer.queue_handler.dropped if writer else 0
+            print(f"{label:<13}{name:<16}{statistics.median(latencies):>8.1f}{latencies[int(len(latencies) * 0.99)]:>8.1f}"
+                  f"{latencies[-1]:>9.0f}{dropped:>9}")
+        if writer:
+            writer.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
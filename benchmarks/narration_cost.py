@@ -0,0 +1,80 @@
+"""What the step by step narration costs per cell: teaching mode logging to a file, teaching mode with
+INFO logging off, and fast mode
+
+Usage: python -m benchmarks.narration_cost [cells]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.relay_cell_cpu import relay_cells
+from client import ClientCircuit, ClientNode
+from data.circuit import Circuit
+from data.cryptography import KEYSTREAM_BACKWARD, counter_block, generate_session_key
+from data.gui_logging_tools import set_fast_mode
+from data.onion import apply_layers, onion_payload, seal, wrap_counters
+from data.stream import pack_stream
+from node_socket import UdpSocket
+
+CIRCUIT_LENGTH = 3
+
+
+def client_circuit(client: ClientNode, sink_port: int) -> ClientCircuit:
+    client_circuit = ClientCircuit(client.node_socket)
+    for relay_id in range(CIRCUIT_LENGTH):
+        circuit = Circuit(relay_id + 1, generate_session_key())
+        circuit.upstream_port = sink_port
+        client_circuit.circuit_list.append(circuit)
+        client_circuit.random_node_id_list.append(relay_id)
+    return client_circuit
+
+
+def log_to(filename: str, level: int):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(format='%(asctime)-4s %(levelname)-6s %(threadName)s:%(lineno)-3d %(message)s',
+                        filename=filename, filemode='w', level=level)
+
+
+def per_call_us(function, calls: int) -> float:
+    start = time.process_time()
+    for _ in range(calls):
+        function()
+    return (time.process_time() - start) / calls * 1e6
+
+
+def main(cells: int = 10000):
+    relay, cases, sockets = relay_cells()
+    sink = UdpSocket(0)
+    client = ClientNode(my_port=0, node_and_port_dict={}, main_gui=None, headless=True)
+    circuit = client_circuit(client, sink.sc.getsockname()[1])
+    body = seal(0, pack_stream(0, b"response"))
+    layers = [hop.crypto for hop in circuit.circuit_list]
+    hop_blocks, block = wrap_counters(layers, counter_block(KEYSTREAM_BACKWARD, 0))
+    response = onion_payload(block, apply_layers(layers, hop_blocks, body))
+
+    modes = [
+        ("teaching, log file", logging.INFO, False),
+        ("teaching, INFO off", logging.WARNING, False),
+        ("fast", logging.INFO, True),
+    ]
+    log_file = os.path.join(tempfile.mkdtemp(), "narration.txt")
+    print(f"{'mode':<20}{'FORWARD us':>12}{'BACKWARD us':>13}{'client send us':>16}{'client recv us':>16}{'log KB':>8}")
+    for label, level, fast in modes:
+        log_to(log_file, level)
+        set_fast_mode(fast)
+        forward = per_call_us(lambda: relay.handle_message(cases["RELAY FORWARD"]), cells)
+        backward = per_call_us(lambda: relay.handle_message(cases["RELAY BACKWARD"]), cells)
+        send = per_call_us(lambda: client.send_request("request", circuit), cells)
+        receive = per_call_us(lambda: client.handle_response(response, circuit), cells)
+        logging.shutdown()
+        print(f"{label:<20}{forward:>12.1f}{backward:>13.1f}{send:>16.1f}{receive:>16.1f}{os.path.getsize(log_file) / 1024:>8.0f}")
+    set_fast_mode(False)
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
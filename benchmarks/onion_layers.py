@@ -0,0 +1,117 @@
+"""Onion layers of data cells: AES-ECB with padding and a cell header per layer, as data cells were built
+before, against the counter mode keystream layers over a fixed size body
+
+Prints the size of the cell on every link from the client to the exit relay, and the CPU time of a relay
+hop in each direction and of the client building a request.
+
+Usage: python -m benchmarks.onion_layers [hops] [repeat]
+"""
+import sys
+import timeit
+
+from data.cell import Cell, pack_cell
+from data.cryptography import KEYSTREAM_BACKWARD, KEYSTREAM_FORWARD, CircuitCrypto, counter_block, decode_base64, generate_session_key
+from data.header import TorHeader
+from data.onion import apply_layers, onion_payload, seal, split_payload, unseal, wrap_counters
+from data.stream import pack_stream
+
+PAYLOAD_SIZES = [16, 400, 480, 4000]
+SERVER_PORT = 9999
+RELAY_PORT = 10000
+
+
+def ecb_onion(layers: list, data: bytes) -> list:
+    """Cells on every link, client first, with a header and an ECB layer added per hop"""
+    cells = []
+    tor_header, target_port = TorHeader(0, "RELAY FORWARD"), SERVER_PORT
+    for crypto in reversed(layers):
+        inner_cell = pack_cell(tor_header, target_port, data, fixed=False)
+        tor_header, target_port, data = TorHeader(1, "RELAY FORWARD"), RELAY_PORT, crypto.encrypt(inner_cell)
+        cells.append(pack_cell(tor_header, RELAY_PORT, data))
+    return cells[::-1]
+
+
+def ctr_onion(layers: list, data: bytes, counter: int = 0) -> list:
+    """Cells on every link, client first: the same body with one keystream layer fewer at every hop"""
+    hop_blocks, block = wrap_counters(layers, counter_block(KEYSTREAM_FORWARD, counter))
+    body = apply_layers(layers, hop_blocks, seal(SERVER_PORT, data))
+    cells = []
+    for crypto, hop_block in zip(layers, hop_blocks):
+        cells.append(pack_cell(TorHeader(1, "RELAY FORWARD"), RELAY_PORT, onion_payload(block, body)))
+        block, body = hop_block, crypto.keystream_xor(hop_block, body)
+    return cells
+
+
+def ecb_request(layers: list, data: bytes) -> bytes:
+    tor_header, target_port = TorHeader(0, "RELAY FORWARD"), SERVER_PORT
+    for crypto in reversed(layers):
+        data = crypto.encrypt(pack_cell(tor_header, target_port, data, fixed=False))
+        tor_header, target_port = TorHeader(1, "RELAY FORWARD"), RELAY_PORT
+    return pack_cell(tor_header, RELAY_PORT, data)
+
+
+def ctr_request(layers: list, data: bytes, counter: int = 0) -> bytes:
+    hop_blocks, block = wrap_counters(layers, counter_block(KEYSTREAM_FORWARD, counter))
+    body = apply_layers(layers, hop_blocks, seal(SERVER_PORT, data))
+    return pack_cell(TorHeader(1, "RELAY FORWARD"), RELAY_PORT, onion_payload(block, body))
+
+
+def ecb_forward_hop(crypto: CircuitCrypto, cell: bytes) -> bytes:
+    inner_cell = Cell.unpack(crypto.decrypt(Cell.unpack(cell).payload))
+    return pack_cell(TorHeader(1, "RELAY FORWARD"), RELAY_PORT, inner_cell.payload)
+
+
+def ctr_forward_hop(crypto: CircuitCrypto, cell: bytes) -> bytes:
+    block, body = split_payload(Cell.unpack(cell).payload)
+    block = crypto.unwrap_counters(block)
+    return pack_cell(TorHeader(1, "RELAY FORWARD"), RELAY_PORT, onion_payload(block, crypto.keystream_xor(block, body)))
+
+
+def ecb_backward_hop(crypto: CircuitCrypto, cell: bytes) -> bytes:
+    return pack_cell(TorHeader(1, "RELAY BACKWARD"), RELAY_PORT, crypto.encrypt(Cell.unpack(cell).payload))
+
+
+def ctr_backward_hop(crypto: CircuitCrypto, cell: bytes) -> bytes:
+    block, body = split_payload(Cell.unpack(cell).payload)
+    return pack_cell(TorHeader(1, "RELAY BACKWARD"), RELAY_PORT, onion_payload(crypto.wrap_counters(block), crypto.keystream_xor(block, body)))
+
+
+def per_call_us(function, repeat: int) -> float:
+    return min(timeit.repeat(function, number=repeat, repeat=3)) / repeat * 1e6
+
+
+def main(hops: int = 3, repeat: int = 5000):
+    layers = [CircuitCrypto(decode_base64(generate_session_key())) for _ in range(hops)]
+    print(f"cell size on every link, client first, {hops} hops")
+    print(f"{'payload':>8}  {'ECB':<32}{'CTR':<32}")
+    for payload_size in PAYLOAD_SIZES:
+        data = pack_stream(0, bytes(payload_size))
+        ecb_sizes = " ".join(str(len(cell)) for cell in ecb_onion(layers, data))
+        ctr_sizes = " ".join(str(len(cell)) for cell in ctr_onion(layers, data))
+        print(f"{payload_size:>8}  {ecb_sizes:<32}{ctr_sizes:<32}")
+
+    print("\nCPU per cell (us)")
+    print(f"{'payload':>8}{'layers':>8}{'forward hop':>13}{'backward hop':>14}{'client request':>16}")
+    for payload_size in PAYLOAD_SIZES:
+        data = pack_stream(0, bytes(payload_size))
+        ecb_cell, ctr_cell = ecb_onion(layers, data)[-1], ctr_onion(layers, data)[-1]
+        # A backward cell as a middle relay gets it, with the exit's layer on
+        ecb_response = pack_cell(TorHeader(1, "RELAY BACKWARD"), RELAY_PORT, layers[-1].encrypt(data))
+        block = counter_block(KEYSTREAM_BACKWARD, 0)
+        ctr_response = pack_cell(TorHeader(1, "RELAY BACKWARD"), RELAY_PORT,
+                                 onion_payload(layers[-1].wrap_counters(block), layers[-1].keystream_xor(block, seal(0, data))))
+        rows = [
+            ("ECB", lambda: ecb_forward_hop(layers[-1], ecb_cell), lambda: ecb_backward_hop(layers[0], ecb_response),
+             lambda: ecb_request(layers, data)),
+            ("CTR", lambda: ctr_forward_hop(layers[-1], ctr_cell), lambda: ctr_backward_hop(layers[0], ctr_response),
+             lambda: ctr_request(layers, data)),
+        ]
+        for label, forward, backward, client in rows:
+            print(f"{payload_size:>8}{label:>8}{per_call_us(forward, repeat):>13.1f}{per_call_us(backward, repeat):>14.1f}"
+                  f"{per_call_us(client, repeat):>16.1f}")
+    hop_blocks, _ = wrap_counters(layers, counter_block(KEYSTREAM_FORWARD, 0))
+    assert unseal(apply_layers(layers, hop_blocks, split_payload(Cell.unpack(ctr_onion(layers, b"x")[0]).payload)[1]))[1] == b"x"
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,158 @@
+"""Allocations and CPU time per cell on a relay's path from its socket back to a socket, with every message
+copied out of the receive buffer, as clients and the server read them, or handled as a view into the receive ring
+
+Cells are sent to an in process relay that reads and handles them the way its receive loop does. Allocations are
+counted with tracemalloc: the blocks allocated since the relay read the cell that are still alive when the cell is
+handed to the socket, how many of those are copies of the cell or its body, and the peak of traced memory while
+the cell is handled.
+
+Usage: python -m benchmarks.receive_path [cells]
+"""
+import select
+import sys
+import time
+import tracemalloc
+
+from benchmarks.relay_cell_cpu import relay_cells
+from data.cell import pack_cell
+from data.circuit import Circuit
+from data.cryptography import KEYSTREAM_BACKWARD, KEYSTREAM_FORWARD, counter_block, generate_session_key
+from data.gui_logging_tools import set_fast_mode
+from data.header import TorHeader
+from data.onion import onion_payload, seal
+from data.stream import pack_stream
+from node_socket import UdpSocket
+
+# Cells read and handled at a time when timing, all waiting in the relay's socket
+TIMING_BATCH = 256
+PROBED_CELLS = 50
+# Blocks at least this large are counted as copies of the cell or of its body
+CELL_COPY_SIZE = 256
+
+
+class SendProbe:
+    """Stands in for one of the relay's send sockets and snapshots the traced memory when a cell is handed to it"""
+
+    def __init__(self, sc):
+        self.sc = sc
+        self.armed = False
+        self.snapshot = None
+
+    def take(self):
+        if self.armed:
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def sendmsg(self, *args):
+        self.take()
+        return self.sc.sendmsg(*args)
+
+    def send(self, *args):
+        self.take()
+        return self.sc.send(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.sc, name)
+
+
+def traced(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+    return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+
+
+def cell_copies(snapshot: tracemalloc.Snapshot) -> int:
+    return sum(1 for trace in snapshot.traces if trace.size >= CELL_COPY_SIZE)
+
+
+def middle_cells(relay, downstream_port: int, upstream_port: int) -> dict:
+    """A circuit the relay has extended, and a FORWARD and a BACKWARD cell for it"""
+    circuit = Circuit(2, generate_session_key())
+    circuit.downstream_port = downstream_port
+    circuit.exit_counter = None
+    relay.circuits.add(circuit)
+    relay.circuits.bind_upstream(circuit, upstream_port)
+    body = seal(upstream_port, pack_stream(0, bytes(400)))
+    forward, backward = counter_block(KEYSTREAM_FORWARD, 0), counter_block(KEYSTREAM_BACKWARD, 0)
+    return {
+        "middle forward": pack_cell(TorHeader(circuit.circuit_id, "RELAY FORWARD"), downstream_port,
+                                    onion_payload(circuit.crypto.wrap_counters(forward), circuit.crypto.keystream_xor(forward, body))),
+        "middle backward": pack_cell(TorHeader(circuit.upstream_id, "RELAY BACKWARD"), upstream_port,
+                                     onion_payload(backward, circuit.crypto.keystream_xor(backward, body))),
+    }
+
+
+def handle_one(relay, copy: bool):
+    message, address = relay.node_socket.listen(copy)
+    relay.handle_received(message)
+
+
+def wait_readable(relay):
+    select.select([relay.node_socket.sc], [], [])
+
+
+def allocations(relay, sender: UdpSocket, cell: bytes, copy: bool, probes: list) -> tuple:
+    """Mean blocks and cell copies alive at the send, and mean peak bytes per cell"""
+    blocks = copies = peak = 0
+    for _ in range(PROBED_CELLS):
+        sender.send(cell, relay.my_port)
+        wait_readable(relay)
+        for probe in probes:
+            probe.armed, probe.snapshot = True, None
+        before = traced(tracemalloc.take_snapshot())
+        handle_one(relay, copy)
+        at_send = next(probe.snapshot for probe in probes if probe.snapshot is not None)
+        at_send = traced(at_send)
+        blocks += sum(stat.count_diff for stat in at_send.compare_to(before, "filename"))
+        copies += cell_copies(at_send) - cell_copies(before)
+
+        sender.send(cell, relay.my_port)
+        wait_readable(relay)
+        for probe in probes:
+            probe.armed = False
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        handle_one(relay, copy)
+        peak += tracemalloc.get_traced_memory()[1] - current
+    return blocks / PROBED_CELLS, copies / PROBED_CELLS, peak / PROBED_CELLS
+
+
+def cpu_per_cell_us(relay, sender: UdpSocket, cell: bytes, copy: bool, cells: int) -> float:
+    elapsed = 0.0
+    for _ in range(max(1, cells // TIMING_BATCH)):
+        for _ in range(TIMING_BATCH):
+            sender.send(cell, relay.my_port)
+        wait_readable(relay)
+        start = time.process_time()
+        for _ in range(TIMING_BATCH):
+            handle_one(relay, copy)
+        elapsed += time.process_time() - start
+    return elapsed / (max(1, cells // TIMING_BATCH) * TIMING_BATCH) * 1e6
+
+
+def main(cells: int = 20000):
+    # Relays only handle cells in the receive ring when they are not narrating
+    set_fast_mode(True)
+    relay, exit_cases, sockets = relay_cells()
+    downstream, upstream = sockets
+    cases = {"exit forward": exit_cases["RELAY FORWARD"], "exit backward": exit_cases["RELAY BACKWARD"]}
+    cases.update(middle_cells(relay, downstream.sc.getsockname()[1], upstream.sc.getsockname()[1]))
+    sender = UdpSocket(0)
+    # Open the relay's send sockets, then put probes in their place
+    for cell in cases.values():
+        sender.send(cell, relay.my_port)
+        handle_one(relay, True)
+    probes = []
+    for port, (sc, send_lock) in relay.node_socket.send_sockets.items():
+        probes.append(SendProbe(sc))
+        relay.node_socket.send_sockets[port] = (probes[-1], send_lock)
+
+    print(f"{'cell':<17}{'receive':<9}{'us/cell':>9}{'blocks at send':>16}{'cell copies':>13}{'peak bytes':>12}")
+    for label, cell in cases.items():
+        for copy in (True, False):
+            us = cpu_per_cell_us(relay, sender, cell, copy, cells)
+            tracemalloc.start()
+            blocks, copies, peak = allocations(relay, sender, cell, copy, probes)
+            tracemalloc.stop()
+            print(f"{label:<17}{'copy' if copy else 'view':<9}{us:>9.1f}{blocks:>16.1f}{copies:>13.1f}{peak:>12.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,59 @@
+"""CPU time a relay spends per cell, from the received bytes to the cell handed to the socket
+
+The relay runs in process and sends to sockets nobody reads, so only relay processing is timed.
+
+Usage: python -m benchmarks.relay_cell_cpu [cells]
+"""
+import sys
+import time
+
+from data.cell import pack_cell
+from data.circuit import Circuit
+from data.cryptography import KEYSTREAM_FORWARD, counter_block, generate_session_key
+from data.header import TorHeader
+from data.onion import onion_payload, seal
+from data.stream import pack_stream
+from node_socket import UdpSocket
+from relay_node import RelayNode
+
+PAYLOAD_SIZE = 400
+
+
+def relay_cells():
+    """An in process relay holding one circuit, and a FORWARD and a BACKWARD cell for that circuit"""
+    downstream = UdpSocket(0)
+    upstream = UdpSocket(0)
+    downstream_port = downstream.sc.getsockname()[1]
+    upstream_port = upstream.sc.getsockname()[1]
+    relay = RelayNode(my_id=0, my_port=0, ports_of_nodes=[], node_number=0)
+    circuit = Circuit(1, generate_session_key())
+    circuit.downstream_port = downstream_port
+    relay.circuits.add(circuit)
+    relay.circuits.bind_upstream(circuit, upstream_port)
+
+    # The relay is the circuit's exit: forward it takes off the last layer, backward it gets the server's response
+    payload = pack_stream(0, bytes(PAYLOAD_SIZE))
+    block = counter_block(KEYSTREAM_FORWARD, 0)
+    body = circuit.crypto.keystream_xor(block, seal(upstream_port, payload))
+    cases = {
+        "RELAY FORWARD": pack_cell(TorHeader(circuit.circuit_id, "RELAY FORWARD"), downstream_port,
+                                   onion_payload(circuit.crypto.wrap_counters(block), body)),
+        "RELAY BACKWARD": pack_cell(TorHeader(circuit.upstream_id, "RELAY BACKWARD"), upstream_port, payload),
+    }
+    # The sockets stay referenced so their ports are not reused while the relay sends to them
+    return relay, cases, (downstream, upstream)
+
+
+def main(cells: int = 20000):
+    relay, cases, sockets = relay_cells()
+    print(f"{'cell':<16}{'us/cell':>10}{'cells/s':>10}")
+    for label, cell in cases.items():
+        start = time.process_time()
+        for _ in range(cells):
+            relay.handle_message(cell)
+        elapsed = time.process_time() - start
+        print(f"{label:<16}{elapsed / cells * 1e6:>10.1f}{cells / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,58 @@
+"""Relay throughput against the number of concurrent circuits, blocking loop versus asyncio mode
+
+Usage: python -m benchmarks.relay_concurrency [duration_seconds]
+"""
+import socket
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, BenchClient, run_relay, run_server, spawn, wait_for_port
+from data.cryptography import generate_rsa_key
+
+CIRCUIT_COUNTS = [1, 2, 4, 8, 16, 32]
+# (label, async mode, executor workers)
+RELAY_MODES = [("sync", False, 0), ("async", True, 0), ("async x4", True, 4)]
+
+
+def measure(circuit_count: int, duration: float, key_pair) -> tuple:
+    clients = [BenchClient() for _ in range(circuit_count)]
+    circuits = [client.create(2 * i, BENCH_RELAY_STARTING_PORT, key_pair) for i, client in enumerate(clients)]
+    completed = [0] * circuit_count
+    timeouts = [0] * circuit_count
+    deadline = time.monotonic() + duration
+
+    def worker(i):
+        while time.monotonic() < deadline:
+            try:
+                clients[i].request(circuits[i], "ping")
+                completed[i] += 1
+            except socket.timeout:
+                timeouts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(circuit_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(completed) / duration, sum(timeouts)
+
+
+def main(duration: float = 3.0):
+    key_pair = generate_rsa_key()
+    server = spawn(run_server, BENCH_SERVER_PORT, True)
+    wait_for_port(BENCH_SERVER_PORT)
+    print(f"{'mode':<10}{'circuits':>10}{'req/s':>12}{'timeouts':>10}")
+    for label, async_mode, workers in RELAY_MODES:
+        relay = spawn(run_relay, 0, BENCH_RELAY_STARTING_PORT, async_mode, workers)
+        wait_for_port(BENCH_RELAY_STARTING_PORT)
+        for circuit_count in CIRCUIT_COUNTS:
+            throughput, timeouts = measure(circuit_count, duration, key_pair)
+            print(f"{label:<10}{circuit_count:>10}{throughput:>12.1f}{timeouts:>10}")
+        relay.terminate()
+        relay.join()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,96 @@
+"""Throughput of one relay run as 1, 2, 4... worker processes sharing its port, circuits steered by id
+
+Load generator processes send RELAY FORWARD cells as fast as they can over circuits spread across the
+workers, and the relay forwards them to a sink that counts what arrives. The relay drops what it cannot
+keep up with, so the forwarded rate is its capacity. Worker processes only help with free cores to run on.
+
+Usage: python -m benchmarks.relay_scaling [max workers] [circuits] [seconds] [generators]
+"""
+import os
+import socket
+import sys
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BenchClient, run_relay, spawn
+from data.cell import pack_cell
+from data.cryptography import KEYSTREAM_FORWARD, counter_block, generate_rsa_key
+from data.gui_logging_tools import set_fast_mode
+from data.header import TorHeader
+from data.onion import onion_payload, seal
+from data.stream import pack_stream
+from node_socket import fragment, reuseport_sockets
+
+PAYLOAD_SIZE = 400
+SINK_TIMEOUT = 0.5
+
+
+def generate(relay_port: int, datagrams: list, seconds: float):
+    # Load generators give way to the relay where they share cores, so more relay processes are not
+    # simply a bigger share of the same cores
+    os.nice(10)
+    sc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sc.connect(("127.0.0.1", relay_port))
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for datagram in datagrams:
+            try:
+                sc.send(datagram)
+            except OSError:
+                # A full buffer or an error left by an earlier datagram, the relay is saturated either way
+                pass
+
+
+def measure(workers: int, relay_port: int, circuits: int, seconds: float, generators: int, key_pair) -> float:
+    relays = [spawn(run_relay, 0, relay_port, False, 0, 16, worker, workers, worker_socket)
+              for worker, worker_socket in enumerate(reuseport_sockets(relay_port, workers))]
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.settimeout(SINK_TIMEOUT)
+    sink_port = sink.getsockname()[1]
+
+    client = BenchClient()
+    body = seal(sink_port, pack_stream(0, bytes(PAYLOAD_SIZE)))
+    datagrams = []
+    for circuit_id in range(1, circuits + 1):
+        circuit = client.create(circuit_id, relay_port, key_pair)
+        # Every cell is sent over and over, a keystream used again does not matter to a benchmark
+        block = counter_block(KEYSTREAM_FORWARD, 0)
+        cell = pack_cell(TorHeader(circuit_id, "RELAY FORWARD"), client.my_port,
+                         onion_payload(circuit.crypto.wrap_counters(block), circuit.crypto.keystream_xor(block, body)))
+        datagrams.extend(fragment(cell))
+
+    loads = [spawn(generate, relay_port, datagrams[i::generators], seconds) for i in range(generators)]
+    forwarded = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        try:
+            sink.recv(2048)
+            forwarded += 1
+        except socket.timeout:
+            pass
+    elapsed = time.monotonic() - start
+    for process in loads + relays:
+        process.terminate()
+        process.join()
+    sink.close()
+    return forwarded / elapsed
+
+
+def main(max_workers: int = 4, circuits: int = 64, seconds: int = 3, generators: int = 2):
+    # Relay workers are forked from here and keep to the fast path
+    set_fast_mode(True)
+    key_pair = generate_rsa_key()
+    print(f"{os.cpu_count()} cores")
+    print(f"{'workers':>8}{'cells/s':>12}{'speedup':>10}")
+    baseline = None
+    workers = 1
+    while workers <= max_workers:
+        relay_port = BENCH_RELAY_STARTING_PORT + workers
+        throughput = measure(workers, relay_port, circuits, seconds, generators, key_pair)
+        baseline = baseline or throughput
+        print(f"{workers:>8}{throughput:>12.0f}{throughput / baseline:>10.2f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,75 @@
+"""Cells per second with a fresh socket per message against the pooled, connected send sockets
+
+Usage: python -m benchmarks.send_path [duration_seconds]
+"""
+import socket
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_RELAY_STARTING_PORT, BENCH_SERVER_PORT, BenchClient, run_relay, run_server, spawn, wait_for_port
+from data.cell import CELL_PAYLOAD_SIZE, pack_cell
+from data.cryptography import generate_rsa_key
+from data.header import TorHeader
+from node_socket import SEND_POOL_SIZE, UdpSocket
+
+CONCURRENT_CIRCUITS = 8
+
+
+def raw_send_rate(pool_size: int, duration: float) -> float:
+    """Cells per second a single node can push out"""
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    port = sink.getsockname()[1]
+    sender = UdpSocket(0, pool_size=pool_size)
+    cell = pack_cell(TorHeader(1, "RELAY FORWARD"), sender.sc.getsockname()[1], bytes(CELL_PAYLOAD_SIZE))
+    sent = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for _ in range(100):
+            sender.send(cell, port)
+        sent += 100
+    sender.close()
+    sink.close()
+    return sent / duration
+
+
+def relay_cell_rate(duration: float, key_pair) -> float:
+    """Cells per second through a relay, a forward and a backward cell per request"""
+    clients = [BenchClient() for _ in range(CONCURRENT_CIRCUITS)]
+    circuits = [client.create(2 * i, BENCH_RELAY_STARTING_PORT, key_pair) for i, client in enumerate(clients)]
+    completed = [0] * CONCURRENT_CIRCUITS
+    deadline = time.monotonic() + duration
+
+    def worker(i):
+        while time.monotonic() < deadline:
+            try:
+                clients[i].request(circuits[i], "ping")
+                completed[i] += 1
+            except socket.timeout:
+                pass
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(CONCURRENT_CIRCUITS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 2 * sum(completed) / duration
+
+
+def main(duration: float = 3.0):
+    key_pair = generate_rsa_key()
+    server = spawn(run_server, BENCH_SERVER_PORT, True)
+    wait_for_port(BENCH_SERVER_PORT)
+    print(f"{'send path':<16}{'node cells/s':>14}{'relay cells/s':>15}")
+    for label, pool_size in (("fresh socket", 0), ("pooled", SEND_POOL_SIZE)):
+        relay = spawn(run_relay, 0, BENCH_RELAY_STARTING_PORT, False, 0, pool_size)
+        wait_for_port(BENCH_RELAY_STARTING_PORT)
+        print(f"{label:<16}{raw_send_rate(pool_size, duration):>14.0f}{relay_cell_rate(duration, key_pair):>15.0f}")
+        relay.terminate()
+        relay.join()
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main(*(float(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,69 @@
+"""Server load test: requests per second and latency percentiles with concurrent clients sending straight to the server
+
+Usage: python -m benchmarks.server_load [clients] [requests per client] [handler ms]
+"""
+import statistics
+import sys
+import threading
+import time
+
+from benchmarks.common import BENCH_SERVER_PORT, BenchClient, run_server, spawn, wait_for_port
+from data.header import TorHeader
+from data.stream import pack_stream, unpack_stream
+from server_node import RequestHandler
+
+# (label, async mode, workers)
+SERVER_MODES = [
+    ("async", True, 0),
+    ("threads x1", False, 1),
+    ("threads x4", False, 4),
+    ("threads x16", False, 16),
+]
+
+
+class SlowHandler(RequestHandler):
+    """Stands in for a handler that waits on a backend for a while"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def handle(self, request: bytes) -> bytes:
+        time.sleep(self.delay)
+        return request + b" accepted"
+
+
+def client_loop(client: BenchClient, client_id: int, requests: int, latencies: list):
+    for i in range(requests):
+        start = time.perf_counter()
+        client.send(TorHeader(client_id, "RELAY FORWARD"), pack_stream(i, f"request {i}".encode()), BENCH_SERVER_PORT)
+        stream_id, response = unpack_stream(client.receive())
+        assert stream_id == i
+        latencies.append(time.perf_counter() - start)
+
+
+def main(clients: int = 16, requests: int = 50, handler_ms: float = 5.0):
+    print(f"{clients} clients x {requests} requests, handler takes {handler_ms} ms")
+    print(f"{'server':<14}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, async_mode, workers in SERVER_MODES:
+        server = spawn(run_server, BENCH_SERVER_PORT, async_mode, workers, SlowHandler(handler_ms / 1e3))
+        wait_for_port(BENCH_SERVER_PORT)
+        bench_clients = [BenchClient(timeout=30) for _ in range(clients)]
+        latencies = []
+        threads = [threading.Thread(target=client_loop, args=(bench_clients[i], i, requests, latencies)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(f"{label:<14}{len(latencies) / elapsed:>10.0f}{statistics.median(latencies) * 1e3:>10.2f}{p99 * 1e3:>10.2f}")
+        for client in bench_clients:
+            client.node_socket.close()
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main(*(float(arg) if i == 2 else int(arg) for i, arg in enumerate(sys.argv[1:])))
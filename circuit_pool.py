@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from client import ClientCircuit, ClientNode
+from node_socket import UdpSocket
+
+CIRCUIT_POOL_SIZE = 4
+# A circuit is rotated out once it is this old (seconds) or has carried this many requests
+CIRCUIT_MAX_AGE = 600.0
+CIRCUIT_MAX_USES = 100
+# Idle circuits are rotated out before relays evict them, see data.circuit_table.RELAY_CIRCUIT_IDLE_TIMEOUT
+CIRCUIT_MAX_IDLE = 240.0
+# Relay replies lost while building would otherwise block the builder forever
+CIRCUIT_BUILD_TIMEOUT = 10.0
+CIRCUIT_BUILD_RETRY_DELAY = 1.0
+
+
+class CircuitPool:
+    """Circuits built ahead of time by a background thread and handed out one per request
+
+    Every circuit gets its own socket so replies on different circuits never mix. The builder keeps
+    `size` circuits ready or in use, and replaces circuits retired for age, idle time or use count.
+    """
+
+    def __init__(self, client: ClientNode, circuit_len: int, size: int = CIRCUIT_POOL_SIZE,
+                 max_age: float = CIRCUIT_MAX_AGE, max_uses: int = CIRCUIT_MAX_USES, max_idle: float = CIRCUIT_MAX_IDLE):
+        if size <= 0:
+            raise ValueError(f"Circuit pool size must be positive, got {size}")
+        self.client = client
+        self.circuit_len = circuit_len
+        self.size = size
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self.ready = deque()
+        # Circuits that are ready, in use or being built
+        self.live = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.built = 0
+        self.retired = 0
+        self.hits = 0
+        self.misses = 0
+        self.builder = threading.Thread(target=self.build_loop, daemon=True, name="Circuit pool")
+        self.builder.start()
+
+    def expired(self, circuit: ClientCircuit) -> bool:
+        now = time.monotonic()
+        return (circuit.use_count >= self.max_uses
+                or now - circuit.created_at >= self.max_age
+                or now - circuit.last_used >= self.max_idle)
+
+    def acquire(self, timeout: float = None) -> ClientCircuit:
+        """Take a ready circuit, waiting for the builder if none is ready"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        with self.condition:
+            while True:
+                while self.ready:
+                    circuit = self.ready.popleft()
+                    if self.expired(circuit):
+                        self.retire(circuit)
+                        continue
+                    if waited:
+                        self.misses += 1
+                    else:
+                        self.hits += 1
+                    return circuit
+                if not self.running:
+                    raise RuntimeError("Circuit pool is closed")
+                waited = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.misses += 1
+                    raise TimeoutError(f"No circuit ready after {timeout} seconds")
+                self.condition.wait(remaining)
+
+    def release(self, circuit: ClientCircuit):
+        """Return a circuit after a request, retiring it if it is due for rotation"""
+        with self.condition:
+            if self.running and not self.expired(circuit):
+                self.ready.append(circuit)
+                self.condition.notify_all()
+            else:
+                self.retire(circuit)
+
+    def discard(self, circuit: ClientCircuit):
+        """Retire a circuit that failed a request instead of handing it out again"""
+        with self.condition:
+            self.retire(circuit)
+
+    def retire(self, circuit: ClientCircuit):
+        # Called with the condition held
+        self.live -= 1
+        self.retired += 1
+        try:
+            self.client.destroy_circuit(circuit)
+        except OSError:
+            logging.exception("Failed to destroy retired circuit")
+        circuit.node_socket.close()
+        self.condition.notify_all()
+
+    def request(self, request_msg: str, timeout: float = None) -> str:
+        """Send one request over a pooled circuit and return the response"""
+        circuit = self.acquire(timeout)
+        try:
+            response = self.client.request(request_msg, circuit)
+        except BaseException:
+            self.discard(circuit)
+            raise
+        self.release(circuit)
+        return response
+
+    def build_loop(self):
+        while True:
+            with self.condition:
+                while self.running and self.live >= self.size:
+                    self.retire_expired()
+                    self.condition.wait(1.0)
+                if not self.running:
+                    return
+                self.live += 1
+            node_socket = UdpSocket(0)
+            node_socket.sc.settimeout(CIRCUIT_BUILD_TIMEOUT)
+            try:
+                circuit = self.client.build_circuit(self.circuit_len, node_socket)
+            except Exception:
+                logging.exception("Failed to build pooled circuit")
+                node_socket.close()
+                with self.condition:
+                    self.live -= 1
+                time.sleep(CIRCUIT_BUILD_RETRY_DELAY)
+                continue
+            with self.condition:
+                self.built += 1
+                if self.running:
+                    self.ready.append(circuit)
+                else:
+                    self.retire(circuit)
+                self.condition.notify_all()
+
+    def retire_expired(self):
+        # Called with the condition held, so idle circuits rotate without waiting for the next acquire
+        for circuit in [circuit for circuit in self.ready if self.expired(circuit)]:
+            self.ready.remove(circuit)
+            self.retire(circuit)
+
+    def wait_until_full(self, timeout: float = None) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.ready) >= self.size or not self.running, timeout)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"ready": len(self.ready), "live": self.live, "built": self.built, "retired": self.retired,
+                    "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            while self.ready:
+                self.retire(self.ready.popleft())
+            self.condition.notify_all()
@@ -1,25 +1,78 @@
-import json
+from concurrent.futures import Future
+import itertools
 import logging
 from pprint import pformat
 import random
+import socket
 import threading
+import time
+from typing import List, Tuple
+from data.cell import CELL_PAYLOAD_SIZE, Cell, pack_cell, unpack_cell
 from data.header import TorHeader
 from node import Node
-from data.cryptography import generate_rsa_key, decrypt_with_rsa, encrypt_with_aes, decrypt_with_aes
+from node_socket import UdpSocket
+from data.cryptography import HANDSHAKE_RSA, HANDSHAKE_X25519, KEYSTREAM_FORWARD, counter_block, generate_rsa_key, decrypt_with_rsa, generate_x25519_key, derive_x25519_session_key
 from data.circuit import Circuit
+from data.hop_trace import BACKWARD, FORWARD, HopLatencyStats, hop_record, parse_trace, with_trace
+from data.onion import (CELL_COUNTER_SIZE, ONION_BODY_SIZE, ONION_HEADER, apply_layers, apply_layers_batch, onion_payload, pack_bodies, seal,
+                        split_payload, unpack_bodies, unseal, unwrap_counters, wrap_counters)
+from data.stream import pack_stream, unpack_stream
+from data.key_pool import RSA_KEY_POOL_HIGH, RSA_KEY_POOL_LOW, RsaKeyPool
 import tkinter as tk
-from ast import literal_eval
+from data.event_trace import LiveEventFeed
 from data.gui_logging_tools import *
+from event_viewer import VirtualListbox
+
+STREAM_POLL_INTERVAL = 0.5
+# Responses already waiting that the stream receiver takes with the one it woke up for, to decrypt them together
+STREAM_RECEIVE_BATCH = 32
+# How often the client gui looks for new events while the run goes on, and how many it takes at a time
+EVENT_POLL_INTERVAL_MS = 100
+EVENT_POLL_BATCH = 5000
+
+class ClientCircuit:
+    """A circuit as the client sees it: the session key of every hop and the socket its cells come back on"""
+
+    def __init__(self, node_socket: UdpSocket):
+        self.node_socket = node_socket
+        self.port = node_socket.sc.getsockname()[1]
+        self.circuit_list = []
+        self.random_node_id_list = []
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.use_count = 0
+        # Keystream numbers of the data cells sent on the circuit, every one is used once
+        self.cell_counter = itertools.count()
+
+    def listen(self) -> bytes:
+        inbound_message, address = self.node_socket.listen()
+        return inbound_message
+
 
 class ClientNode(Node):
 
-    def __init__(self, my_port: int, node_and_port_dict: dict, main_gui: tk.Tk):
+    def __init__(self, my_port: int, node_and_port_dict: dict, main_gui: tk.Tk, handshake: int = HANDSHAKE_RSA, headless: bool = False,
+                 key_pool_low: int = RSA_KEY_POOL_LOW, key_pool_high: int = RSA_KEY_POOL_HIGH, server_port: int = 9999,
+                 trace_hops: bool = False):
         super().__init__(my_id=-1, my_port=my_port)
         self.node_and_port_dict = node_and_port_dict
-        self.circuit_list = []
+        self.server_port = server_port
+        self.circuit = None
         self.event_list = []
-        self.random_node_id_list = []
-
+        # Traced requests collect the times of every hop, their responses add them to hop_stats
+        self.trace_hops = trace_hops
+        self.hop_stats = HopLatencyStats()
+
+        self.handshake = handshake
+        self.headless = headless
+        # RSA key pairs are generated ahead of time, a high watermark of 0 generates them on demand
+        self.rsa_key_pool = None
+        if handshake == HANDSHAKE_RSA and key_pool_high > 0:
+            self.rsa_key_pool = RsaKeyPool(key_pool_low, key_pool_high)
+        if not headless:
+            self.build_gui()
+
+    def build_gui(self):
         # Client GUI
         # Code Generated By Pygubu Designer
         self.client_gui = tk.Tk()
@@ -35,17 +88,9 @@ class ClientNode(Node):
         label2.pack(side="top")
         frame8 = tk.Frame(frame6)
         frame8.configure(height=200)
-        self.event_history_listbox = tk.Listbox(frame8)
-        self.event_history_listvar = tk.StringVar()
-        self.event_history_listbox.configure(
-            activestyle="none",
-            listvariable=self.event_history_listvar,
-            selectmode="single",
-            width=35)
-        self.event_history_listbox.pack(fill="y", side="left")
-        self.event_history_scrollbar = tk.Scrollbar(frame8)
-        self.event_history_scrollbar.configure(orient="vertical")
-        self.event_history_scrollbar.pack(fill="y", side="left")
+        # Only the rows in view are drawn, so runs with many thousands of events stay responsive
+        self.event_history_listbox = VirtualListbox(frame8, width=35, on_select=self.on_event_listbox_select)
+        self.event_history_listbox.pack(fill="y", expand="true", side="left")
         frame8.pack(expand="true", fill="y", pady=10, side="top")
         frame6.pack(fill="y", padx=10, side="left")
         frame1 = tk.Frame(frame3)
@@ -74,27 +119,22 @@ class ClientNode(Node):
         frame7.configure(height=200, width=200)
         self.next_step = tk.Button(frame7)
         self.next_step.configure(height=2, text='Next step', width=15)
-        self.next_step.pack(side="top")
+        self.next_step.pack(side="right")
+        self.follow_live_var = tk.BooleanVar(value=False)
+        self.follow_live = tk.Checkbutton(frame7)
+        self.follow_live.configure(text='Follow live', variable=self.follow_live_var, command=self.gui_reveal_events)
+        self.follow_live.pack(padx=10, side="right")
         frame7.pack(anchor="e", padx=20, pady=10, side="top")
 
         # Configure gui
-        # History listbox
-        self.event_history_listbox.configure(yscrollcommand=self.event_history_scrollbar.set)
-        self.event_history_scrollbar.configure(command=self.event_history_listbox.yview)
-        self.event_history_listbox.bind("<<ListboxSelect>>", self.on_event_listbox_select)
-
         # Event detail
         self.event_detail.configure(yscrollcommand=self.event_detail_scrollbar.set)
         self.event_detail_scrollbar.configure(command=self.event_detail.yview)
 
         # Next step button
-        self.next_step.configure(command=self.gui_insert_next_step)
+        self.next_step.configure(command=self.gui_insert_next_step, state="disabled")
 
-    def on_event_listbox_select(self, event):
-        try:
-            selected_index = self.event_history_listbox.curselection()[0]
-        except:
-            return
+    def on_event_listbox_select(self, selected_index: int):
         selected_event_name, selected_event_detail = self.event_list[selected_index]
         self.event_name.configure(text=selected_event_name)
         self.event_detail.configure(state="normal")
@@ -103,254 +143,484 @@ class ClientNode(Node):
         self.event_detail.configure(state="disabled")
 
     def select_listbox_item(self, index):
-        self.event_history_listbox.selection_clear(0, "end")
-        self.event_history_listbox.selection_set(index)
-        self.on_event_listbox_select(None)
+        self.event_history_listbox.select(index)
 
     def gui_insert_next_step(self):
         next_index = self.event_history_listbox.size()
-        self.event_history_listbox.insert("end", self.event_list[next_index][0])
-        self.event_history_listbox.see(next_index)
+        self.event_history_listbox.append([self.event_list[next_index][0]])
         self.select_listbox_item(next_index)
-
-        # Disable next step button if the last event is reached
-        if self.event_history_listbox.size() == len(self.event_list):
+        self.gui_update_next_step()
+
+    def gui_reveal_events(self):
+        """Show every event received so far, used when following the run live"""
+        shown = self.event_history_listbox.size()
+        if self.follow_live_var.get() and shown < len(self.event_list):
+            self.event_history_listbox.append([event_name for event_name, event_detail in self.event_list[shown:]])
+            self.select_listbox_item(len(self.event_list) - 1)
+        self.gui_update_next_step()
+
+    def gui_update_next_step(self):
+        # Disable next step button until the next event has been received
+        if self.event_history_listbox.size() < len(self.event_list):
+            self.next_step.configure(state="normal")
+        else:
             self.next_step.configure(state="disabled")
 
-    def organize_event_for_simulation(self):
-        # Store necessary logs into memory
-        # TODO: don't forget to add server logs
-        unread_logs_dict = dict()
-        with open("logs/Client.txt", "r") as client_log:
-            unread_logs_dict["Client"] = [line.rstrip('\n') for line in client_log.readlines()]
-        index_of_relay_node_id_list_str = 8
-        active_relay_node_id_list = literal_eval(unread_logs_dict["Client"][index_of_relay_node_id_list_str])
-        del unread_logs_dict["Client"][index_of_relay_node_id_list_str - 1]
-        del unread_logs_dict["Client"][index_of_relay_node_id_list_str]
-        for each_node_id in active_relay_node_id_list:
-            with open(f"logs/Relay {each_node_id}.txt", "r") as relay_log:
-                unread_logs_dict[f"Relay {each_node_id}"] = [line.rstrip('\n') for line in relay_log.readlines()]
-        with open("logs/Server.txt", "r") as server_log:
-            unread_logs_dict["Server"] = [line.rstrip('\n') for line in server_log.readlines()]
-
-        # Start at client
-        current_node_log = "Client"
-
-        while True:
-            # Find the next event start and stop line
-            start_line = None
-            stop_line = None
-            for i, each_line in enumerate(unread_logs_dict[current_node_log]):
-                # Find start line
-                if each_line == "GUI_EVENT_START":
-                    start_line = i
-                # Find stop line
-                if each_line == "GUI_EVENT_STOP":
-                    stop_line = i - 1
-                    break # Stop after finding stop line
-
-            # Exit when no more gui event found
-            if start_line == None or stop_line == None:
-                return
-
-            # Record the event to event dictionary
-            event_name = unread_logs_dict[current_node_log][start_line + 1]
-            log_line_start = start_line + 2
-            self.event_list.append((event_name, "\n".join(unread_logs_dict[current_node_log][log_line_start:stop_line])))
-
-            # Look up the next event location
-            next_node = gui_event_get_next(unread_logs_dict[current_node_log][stop_line + 2])
-
-            # Remove processed logs
-            del unread_logs_dict[current_node_log][:stop_line + 3]
-
-            current_node_log = next_node
+    def gui_poll_events(self):
+        """Pick up the events the nodes traced since the last poll, while the run goes on"""
+        for event in self.event_feed.poll(EVENT_POLL_BATCH):
+            self.event_list.append((event.name, event.detail))
+        if self.event_history_listbox.size() == 0 and self.event_list:
+            self.gui_insert_next_step()
+        self.gui_reveal_events()
+        self.client_gui.after(EVENT_POLL_INTERVAL_MS, self.gui_poll_events)
 
     def start(self, circuit_len, message):
+        if self.headless or not narrating():
+            # Nothing is narrated to show in fast mode
+            self.run_simulation(circuit_len, message)
+            return
 
-        self.build_circuit(circuit_len)
-        self.send_request(message)
-
-        logging.info("Listening for response...")
-        inbound_message_json = self.listen_procedure()
-        inbound_message = json.loads(inbound_message_json)
-        data = inbound_message["data"]
-        gui_event_start("Client: Receive server response")
-        logging.info(f"\nINBOUND MESSAGE:\nTor header: {inbound_message['tor_header']}\nData: DATA encrypted with RELAY {self.random_node_id_list[0]} SESSION KEY\nSender port: {inbound_message['sender_port']}")
-        gui_event_stop(next_node="Client")
-        self.handle_response(data)
-
-        # Start the client gui
-        self.organize_event_for_simulation()
-        # TODO get self.event_dict to show in gui
-        # for event_name, event_log in self.event_list:
-        #     print(event_name)
-        #     print(event_log)
-        #     print()
-        self.gui_insert_next_step()
+        # The run goes on in the background while the client gui shows its events as the nodes trace them
+        self.event_feed = LiveEventFeed("logs")
+        threading.Thread(target=self.run_simulation, args=(circuit_len, message), daemon=True,
+                         name=threading.current_thread().name).start()
+        self.gui_poll_events()
         self.client_gui.mainloop()
 
-    def build_circuit(self, circuit_len: int):
-        gui_event_start("Client: Choosing circuit route")
-
-        logging.info(f"Available nodes for relay: {pformat(self.node_and_port_dict)}")
-        logging.info(f"Building a circuit with {circuit_len} nodes")
-        logging.info(f"Choosing {circuit_len} random node(s)...")
-        self.random_node_id_list = random.sample(self.node_and_port_dict.keys(), circuit_len)
-        circuit_dict = {key: self.node_and_port_dict[key] for key in self.random_node_id_list}
-        route_str = ""
-        for relay_id in circuit_dict.keys():
-            route_str += f"Relay {relay_id} -- "
-        logging.info(f"Route: Client -- {route_str}Server")
-        logging.info(f"\n{self.random_node_id_list}")
-        gui_event_stop(next_node="Client")
+    def run_simulation(self, circuit_len, message):
+        self.circuit = self.build_circuit(circuit_len)
+        response = self.request(message, self.circuit)
+        logging.info(f"Response: {response}")
+
+    def build_circuit(self, circuit_len: int, node_socket: UdpSocket = None) -> "ClientCircuit":
+        """Build a circuit whose cells are sent and received on `node_socket`, the client's own socket by default
+
+        A build that fails part way tears down the hops it already built before raising.
+        """
+        client_circuit = ClientCircuit(node_socket or self.node_socket)
+        try:
+            self.build_hops(client_circuit, circuit_len)
+        except BaseException:
+            if client_circuit.circuit_list:
+                self.destroy_circuit(client_circuit)
+            raise
+        return client_circuit
+
+    def build_hops(self, client_circuit: "ClientCircuit", circuit_len: int):
+        circuit_list = client_circuit.circuit_list
+        narrate = narrating()
+        random_node_id_list = client_circuit.random_node_id_list
+        random_node_id_list.extend(random.sample(list(self.node_and_port_dict.keys()), circuit_len))
+        circuit_dict = {key: self.node_and_port_dict[key] for key in random_node_id_list}
+        if narrate:
+            gui_event_start("Client: Choosing circuit route")
+            logging.info(f"Available nodes for relay: {pformat(self.node_and_port_dict)}")
+            logging.info(f"Building a circuit with {circuit_len} nodes")
+            logging.info(f"Choosing {circuit_len} random node(s)...")
+            route_str = ""
+            for relay_id in circuit_dict.keys():
+                route_str += f"Relay {relay_id} -- "
+            logging.info(f"Route: Client -- {route_str}Server")
+            logging.info(f"\n{random_node_id_list}")
+            gui_event_stop(next_node="Client")
 
         random_node_ports = list(circuit_dict.values())
         for i in range(len(random_node_ports)):
-            gui_event_start(f"Client: Start establishing connection to Relay {self.random_node_id_list[i]}")
-            logging.info("Starting circuit building loop...")
+            if narrate:
+                gui_event_start(f"Client: Start establishing connection to Relay {random_node_id_list[i]}")
+                logging.info("Starting circuit building loop...")
             # Create
-            logging.info("Generating public/private key pair for session key encryptions...")
-            logging.info(f"Target relay node: Relay {self.random_node_id_list[i]}")
-            private_key, public_key = generate_rsa_key()
-            logging.info(f"Public/Private key pair generated. Key will be used to encrypt session key from relay node.")
+            if self.handshake == HANDSHAKE_X25519:
+                if narrate:
+                    logging.info("Generating ephemeral X25519 key pair for session key agreement...")
+                    logging.info(f"Target relay node: Relay {random_node_id_list[i]}")
+                private_key, public_key = generate_x25519_key()
+                handshake_data = public_key
+                if narrate:
+                    logging.info("X25519 key pair generated. Session key will be derived from it and the relay node's X25519 public key.")
+            else:
+                if narrate:
+                    logging.info("Generating public/private key pair for session key encryptions...")
+                    logging.info(f"Target relay node: Relay {random_node_id_list[i]}")
+                if self.rsa_key_pool is not None:
+                    private_key, public_key = self.rsa_key_pool.take()
+                else:
+                    private_key, public_key = generate_rsa_key()
+                handshake_data = public_key.encode()
+                if narrate:
+                    logging.info(f"Public/Private key pair generated. Key will be used to encrypt session key from relay node.")
+            # Circuit ids are per link: the client picks the id on its link to the first relay,
+            # every relay picks the id on its link to the next one
+            circuit_id = random.getrandbits(31) if i == 0 else 0
             message = dict()
-            message["tor_header"] = TorHeader(i, "CREATE").__dict__
-            message["data"] = {"gk": public_key}
+            message["tor_header"] = TorHeader(circuit_id, "CREATE")
+            message["data"] = bytes([self.handshake]) + handshake_data
             message["target_port"] = random_node_ports[i]
-            logging.info(f"\nDATA:\nTor header: {message['tor_header']}\nData: CLIENT PUBLIC KEY\nTarget port: {message['target_port']}")
+            if narrate:
+                logging.info(f"\nDATA:\nTor header: {message['tor_header'].as_dict()}\nData: CLIENT PUBLIC KEY\nTarget port: {message['target_port']}")
 
             # Extend
-            if self.circuit_list: # If list is not empty
+            if circuit_list and narrate: # If list is not empty
                 gui_event_stop(next_node="Client")
                 gui_event_start("Client: Applying layered encription")
-                logging.info(f"Applying {len(self.circuit_list)} layer of encryption to message...")
+                logging.info(f"Applying {len(circuit_list)} layer of encryption to message...")
                 node_encryption_layer = []
-                for each_relay_id_with_sk in self.random_node_id_list[:i]:
+                for each_relay_id_with_sk in random_node_id_list[:i]:
                     node_encryption_layer.append(f"Relay {each_relay_id_with_sk}")
                 logging.info(f"Order of encryption key (from outer to inner): {node_encryption_layer}")
-            for each_circuit in self.circuit_list[::-1]:
-                logging.info(f"Encrypting data using RELAY {self.random_node_id_list[self.circuit_list.index(each_circuit)]} SESSION KEY...")
-                outbound_message = json.dumps(message)
-                encrypted_message = encrypt_with_aes(each_circuit.sk, outbound_message)
-                message["tor_header"] = TorHeader(each_circuit.circuit_id, "EXTEND").__dict__
-                message["data"] = encrypted_message
+            for layer in range(len(circuit_list) - 1, -1, -1):
+                each_circuit = circuit_list[layer]
+                if narrate:
+                    logging.info(f"Encrypting data using RELAY {random_node_id_list[layer]} SESSION KEY...")
+                inner_cell = pack_cell(message["tor_header"], message["target_port"], message["data"], fixed=False)
+                message["tor_header"] = TorHeader(each_circuit.circuit_id, "EXTEND")
+                message["data"] = each_circuit.crypto.encrypt(inner_cell)
                 message["target_port"] = each_circuit.upstream_port
-            gui_event_stop(next_node="Client")
 
             # Send
-            gui_event_start(f"Client: Sending message to Relay {self.random_node_id_list[0]}")
-            logging.info("Sending message...")
-            message["sender_port"] = self.my_port
-            log_data = ""
-            if (len(self.circuit_list) == 0):
-                log_data += "CLIENT PUBLIC KEY"
-            else:
-                log_data += f"DATA encrypted with RELAY {self.random_node_id_list[0]} SESSION KEY"
-            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: {log_data}\nTarget port: {message['target_port']}\nSender port: {message['sender_port']}")
-            outbound_message = json.dumps(message)
-            self.sending_procedure(outbound_message, random_node_ports[0])
-            gui_event_stop(next_node=f"Relay {self.random_node_id_list[0]}")
+            message["sender_port"] = client_circuit.port
+            if narrate:
+                gui_event_stop(next_node="Client")
+                gui_event_start(f"Client: Sending message to Relay {random_node_id_list[0]}")
+                logging.info("Sending message...")
+                if (len(circuit_list) == 0):
+                    log_data = "CLIENT PUBLIC KEY"
+                else:
+                    log_data = f"DATA encrypted with RELAY {random_node_id_list[0]} SESSION KEY"
+                logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {message['tor_header'].as_dict()}\nData: {log_data}\nTarget port: {message['target_port']}\nSender port: {message['sender_port']}")
+            outbound_message = pack_cell(message["tor_header"], message["sender_port"], message["data"])
+            client_circuit.node_socket.send(outbound_message, random_node_ports[0])
+            if narrate:
+                gui_event_stop(next_node=f"Relay {random_node_id_list[0]}")
+                logging.info("Listening for reply...")
 
             # Receive
-            logging.info("Listening for reply...")
-            inbound_message_json = self.listen_procedure()
-            inbound_message = json.loads(inbound_message_json)
-            data = inbound_message["data"]
-            gui_event_start(f"Client: Receiving session key response from Relay {self.random_node_id_list[i]}")
-            log_data = ""
-            if (len(self.circuit_list) == 0):
-                log_data += f"DATA encrypted with CLIENT PUBLIC KEY"
-            else:
-                log_data += f"DATA encrypted with RELAY {self.random_node_id_list[0]} SESSION KEY"
-            logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: {log_data}\nSender port: {message['sender_port']}")
-            gui_event_stop(next_node="Client")
-            gui_event_start(f"Client: Decrypting & storing session key from Relay {self.random_node_id_list[i]}")
-            layer = 0
-            for each_circuit in self.circuit_list:
-                logging.info(f"Peeling encryption layer using RELAY {self.random_node_id_list[layer]} SESSION KEY...")
-                decrypted_data = decrypt_with_aes(each_circuit.sk, data)
-                if layer < len(self.circuit_list) - 1:
-                    logging.info(f"DECRYPTED DATA: DATA encrypted with RELAY {self.random_node_id_list[layer+1]} SESSION KEY")
+            inbound_tor_header, sender_port, data = unpack_cell(client_circuit.listen())
+            if inbound_tor_header.cmd == "DESTROY":
+                # A relay that is full or failed the handshake refuses the circuit, the relays before it tear it down
+                raise ConnectionError(f"Circuit {inbound_tor_header.circuit_id} was destroyed while adding Relay {random_node_id_list[i]}")
+            if narrate:
+                gui_event_start(f"Client: Receiving session key response from Relay {random_node_id_list[i]}")
+                if (len(circuit_list) == 0):
+                    log_data = f"DATA encrypted with CLIENT PUBLIC KEY"
                 else:
-                    logging.info(f"DECRYPTED DATA: DATA encrypted with CLIENT PUBLIC KEY")
-                data = json.loads(decrypted_data)["data"]
-                layer += 1
-
-            logging.info("Decrypting session key using CLIENT PRIVATE KEY...")
-            sk = decrypt_with_rsa(private_key, data["sk"])
-            logging.info(f"Storing received session key for port {random_node_ports[i]}...")
-            new_circuit = Circuit(i, sk)
-            new_circuit.upstream_port = random_node_ports[i]
-            self.circuit_list.append(new_circuit)
-
-            logging.info(f"CIRCUIT STORED:")
-            debugstr = ""
-            for circuit in self.circuit_list:
-                debugstr += f"{str(circuit)}, upstream_port: {circuit.upstream_port}\n"
-            logging.info(f"\n{debugstr}")
-            if i < len(random_node_ports) - 1:
+                    log_data = f"DATA encrypted with RELAY {random_node_id_list[0]} SESSION KEY"
+                logging.info(f"\nINBOUND MESSAGE:\nTor header: {inbound_tor_header.as_dict()}\nData: {log_data}\nSender port: {sender_port}")
                 gui_event_stop(next_node="Client")
-        logging.info("Circuit built successfully")
-        gui_event_stop(next_node="Client")
+                gui_event_start(f"Client: Decrypting & storing session key from Relay {random_node_id_list[i]}")
+            for layer, each_circuit in enumerate(circuit_list):
+                data = each_circuit.crypto.decrypt(data)
+                if narrate:
+                    logging.info(f"Peeling encryption layer using RELAY {random_node_id_list[layer]} SESSION KEY...")
+                    if layer < len(circuit_list) - 1:
+                        logging.info(f"DECRYPTED DATA: DATA encrypted with RELAY {random_node_id_list[layer+1]} SESSION KEY")
+                    else:
+                        logging.info(f"DECRYPTED DATA: DATA encrypted with CLIENT PUBLIC KEY")
+
+            handshake_type, relay_handshake_data = data[0], data[1:]
+            if handshake_type != self.handshake:
+                raise ValueError(f"Relay {random_node_id_list[i]} answered handshake {self.handshake} with handshake {handshake_type}")
+            if handshake_type == HANDSHAKE_X25519:
+                if narrate:
+                    logging.info("Deriving session key from CLIENT X25519 PRIVATE KEY and RELAY X25519 PUBLIC KEY...")
+                sk = derive_x25519_session_key(private_key, relay_handshake_data, public_key, relay_handshake_data)
+            else:
+                if narrate:
+                    logging.info("Decrypting session key using CLIENT PRIVATE KEY...")
+                sk = decrypt_with_rsa(private_key, relay_handshake_data.decode())
+            new_circuit = Circuit(circuit_id, sk)
+            new_circuit.upstream_port = random_node_ports[i]
+            circuit_list.append(new_circuit)
+
+            if narrate:
+                logging.info(f"Storing received session key for port {random_node_ports[i]}...")
+                logging.info(f"CIRCUIT STORED:")
+                debugstr = ""
+                for circuit in circuit_list:
+                    debugstr += f"{str(circuit)}, upstream_port: {circuit.upstream_port}\n"
+                logging.info(f"\n{debugstr}")
+                if i < len(random_node_ports) - 1:
+                    gui_event_stop(next_node="Client")
+        if narrate:
+            logging.info("Circuit built successfully")
+            gui_event_stop(next_node="Client")
+        if self.rsa_key_pool is not None:
+            logging.debug(f"RSA key pool: {self.rsa_key_pool.stats()}")
 
-    def send_request(self, request_msg: str):
+    def send_request(self, request_msg: str, client_circuit: "ClientCircuit", stream_id: int = 0):
+        started = time.monotonic()
+        circuit_list = client_circuit.circuit_list
+        random_node_id_list = client_circuit.random_node_id_list
+        narrate = narrating()
 
-        gui_event_start(f"Client: Creating request message to send")
-        logging.info("Starting procedure to send request message...")
-        logging.info("Creating data...")
         message = dict()
-        message["tor_header"] = TorHeader(len(self.circuit_list), "RELAY FORWARD").__dict__
-        message["data"] = {"message": request_msg}
-        message["target_port"] = 9999
-        logging.info(f"\nDATA:\nTor header: {message['tor_header']}\nData: {message['data']}\nTarget port: {message['target_port']}")
-        gui_event_stop(next_node="Client")
-
-        gui_event_start(f"Client: Applying layered encryption to request message")
-        logging.info("Start encrypting message...")
-        for circuit in self.circuit_list[::-1]:
-            logging.info(f"Encrypting message with session key from RELAY {self.random_node_id_list[self.circuit_list.index(circuit)]} SESSION KEY")
-            outbound_message = json.dumps(message)
-            encrypted_message = encrypt_with_aes(circuit.sk, outbound_message)
-            message["tor_header"] = TorHeader(circuit.circuit_id, "RELAY FORWARD").__dict__
-            message["data"] = encrypted_message
-            message["target_port"] = circuit.upstream_port
-            logging.info(f"\nENCRYPTED MESSAGE:\nTor header: {message['tor_header']}\nData: DATA encrypted with RELAY {self.random_node_id_list[self.circuit_list.index(circuit)]} SESSION KEY\nTarget port: {message['target_port']}")
-        gui_event_stop(next_node="Client")
-
-        gui_event_start(f"Client: Sending request message")
+        # The exit relay picks the circuit id on its link to the server
+        message["tor_header"] = TorHeader(0, "RELAY FORWARD")
+        message["data"] = pack_stream(stream_id, request_msg.encode())
+        message["target_port"] = self.server_port
+        if narrate:
+            gui_event_start(f"Client: Creating request message to send")
+            logging.info("Starting procedure to send request message...")
+            logging.info("Creating data...")
+            logging.info(f"\nDATA:\nTor header: {message['tor_header'].as_dict()}\nStream: {stream_id}\nData: {request_msg}\nTarget port: {message['target_port']}")
+            gui_event_stop(next_node="Client")
+            gui_event_start(f"Client: Applying layered encryption to request message")
+            logging.info("Start encrypting message...")
+        # Every layer is a pass of the hop's keystream over the same fixed size body
+        counter = next(client_circuit.cell_counter)
+        message["data"] = seal(message["target_port"], message["data"])
+        if narrate:
+            for layer in range(len(circuit_list) - 1, -1, -1):
+                circuit = circuit_list[layer]
+                logging.info(f"Encrypting message with session key from RELAY {random_node_id_list[layer]} SESSION KEY")
+                logging.info(f"\nENCRYPTED MESSAGE:\nTor header: {TorHeader(circuit.circuit_id, 'RELAY FORWARD').as_dict()}\nData: DATA encrypted with RELAY {random_node_id_list[layer]} SESSION KEY\nTarget port: {circuit.upstream_port}")
+        message["tor_header"] = TorHeader(circuit_list[0].circuit_id, "RELAY FORWARD")
+        message["target_port"] = circuit_list[0].upstream_port
+        layers = [circuit.crypto for circuit in circuit_list]
+        hop_blocks, block = wrap_counters(layers, counter_block(KEYSTREAM_FORWARD, counter))
+        message["data"] = onion_payload(block, apply_layers(layers, hop_blocks, message["data"]))
+
         #Sending message
-        logging.info("Sending message...")
-        message["sender_port"] = self.my_port
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: DATA encrypted with RELAY {self.random_node_id_list[self.circuit_list.index(circuit)]} SESSION KEY\nTarget port: {message['target_port']}\nSender port: {message['sender_port']}")
-        outbound_message = json.dumps(message)
-        self.sending_procedure(outbound_message, self.circuit_list[0].upstream_port)
-        gui_event_stop(next_node=f"Relay {self.random_node_id_list[0]}")
-
-    def handle_response(self, response: str):
-        gui_event_start(f"Client: Decrypting response message")
-        logging.info("Start peeling encryption layers...")
-        layer = 0
-        for each_circuit in self.circuit_list:
-            logging.info(f"Decrypting message with RELAY {self.random_node_id_list[layer]} SESSION KEY...")
-            decrypted_data = decrypt_with_aes(each_circuit.sk, response)
-            log_data = ""
-            if layer < len(self.circuit_list) - 1:
-                log_data += f"DATA encrypted with RELAY {self.random_node_id_list[layer+1]} SESSION KEY"
+        message["sender_port"] = client_circuit.port
+        if narrate:
+            gui_event_stop(next_node="Client")
+            gui_event_start(f"Client: Sending request message")
+            logging.info("Sending message...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {message['tor_header'].as_dict()}\nData: DATA encrypted with RELAY {random_node_id_list[0]} SESSION KEY\nTarget port: {message['target_port']}\nSender port: {message['sender_port']}")
+        if self.trace_hops:
+            message["tor_header"].traced = True
+            outbound_message = with_trace(pack_cell(message["tor_header"], message["sender_port"], message["data"]),
+                                          hop_record(client_circuit.port, FORWARD, started, started, time.monotonic()))
+        else:
+            outbound_message = pack_cell(message["tor_header"], message["sender_port"], message["data"])
+        client_circuit.node_socket.send(outbound_message, circuit_list[0].upstream_port)
+        if narrate:
+            gui_event_stop(next_node=f"Relay {random_node_id_list[0]}")
+
+    def send_requests(self, request_msgs: List[str], client_circuit: "ClientCircuit", stream_ids: List[int]):
+        """send_request() for several requests on one circuit, the layers of those that fit a cell added in one call per hop"""
+        if len(request_msgs) == 1 or narrating() or self.trace_hops:
+            for request_msg, stream_id in zip(request_msgs, stream_ids):
+                self.send_request(request_msg, client_circuit, stream_id)
+            return
+        circuit_list = client_circuit.circuit_list
+        bodies = []
+        for request_msg, stream_id in zip(request_msgs, stream_ids):
+            data = pack_stream(stream_id, request_msg.encode())
+            if len(data) <= ONION_BODY_SIZE - ONION_HEADER.size:
+                bodies.append(seal(self.server_port, data))
+            else:
+                self.send_request(request_msg, client_circuit, stream_id)
+        if not bodies:
+            return
+        layers = [circuit.crypto for circuit in circuit_list]
+        hop_blocks, blocks = wrap_counters(layers, b"".join(counter_block(KEYSTREAM_FORWARD, next(client_circuit.cell_counter)) for _ in bodies))
+        buffer = pack_bodies(bodies, ONION_BODY_SIZE)
+        apply_layers_batch(layers, hop_blocks, buffer, ONION_BODY_SIZE)
+        tor_header = TorHeader(circuit_list[0].circuit_id, "RELAY FORWARD")
+        for index, body in enumerate(unpack_bodies(buffer, len(bodies), ONION_BODY_SIZE)):
+            block = blocks[index * CELL_COUNTER_SIZE:(index + 1) * CELL_COUNTER_SIZE]
+            client_circuit.node_socket.send(pack_cell(tor_header, client_circuit.port, onion_payload(block, body)), circuit_list[0].upstream_port)
+
+    def handle_responses(self, responses: List[bytes], client_circuit: "ClientCircuit") -> List[Tuple[int, str]]:
+        """handle_response() for several responses of one circuit, full cells decrypted in one call per hop"""
+        if len(responses) == 1 or narrating():
+            return [self.handle_response(response, client_circuit) for response in responses]
+        results = [None] * len(responses)
+        batch = []
+        for index, response in enumerate(responses):
+            if len(response) == CELL_PAYLOAD_SIZE:
+                batch.append(index)
             else:
-                log_data += str(json.loads(decrypted_data)["data"])
-            logging.info(f"DECRYPTED DATA: {log_data}")
-            response = json.loads(decrypted_data)["data"]
-            layer += 1
-        gui_event_stop(next_node=f"Client")
+                results[index] = self.handle_response(response, client_circuit)
+        if batch:
+            blocks, bodies = zip(*(split_payload(responses[index]) for index in batch))
+            layers = [circuit.crypto for circuit in client_circuit.circuit_list]
+            buffer = pack_bodies(bodies, ONION_BODY_SIZE)
+            apply_layers_batch(layers, unwrap_counters(layers, b"".join(blocks)), buffer, ONION_BODY_SIZE)
+            for index, body in zip(batch, unpack_bodies(buffer, len(batch), ONION_BODY_SIZE)):
+                port, response = unseal(body)
+                stream_id, response = unpack_stream(response)
+                results[index] = stream_id, bytes(response).decode()
+        return results
+
+    def handle_response(self, response: bytes, client_circuit: "ClientCircuit") -> Tuple[int, str]:
+        circuit_list = client_circuit.circuit_list
+        random_node_id_list = client_circuit.random_node_id_list
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Client: Decrypting response message")
+            logging.info("Start peeling encryption layers...")
+        block, response = split_payload(response)
+        layers = [circuit.crypto for circuit in circuit_list]
+        port, response = unseal(apply_layers(layers, unwrap_counters(layers, block), response))
+        stream_id, response = unpack_stream(response)
+        if narrate:
+            for layer in range(len(circuit_list)):
+                logging.info(f"Decrypting message with RELAY {random_node_id_list[layer]} SESSION KEY...")
+                if layer < len(circuit_list) - 1:
+                    logging.info(f"DECRYPTED DATA: DATA encrypted with RELAY {random_node_id_list[layer+1]} SESSION KEY")
+            logging.info(f"DECRYPTED DATA: {response.decode()} (stream {stream_id})")
+        if narrate:
+            gui_event_stop(next_node=f"Client")
+        return stream_id, response.decode()
+
+    def request(self, request_msg: str, client_circuit: "ClientCircuit") -> str:
+        """Send one request over the circuit and wait for its response"""
+        self.send_request(request_msg, client_circuit)
+
+        narrate = narrating()
+        if narrate:
+            logging.info("Listening for response...")
+        cell = Cell.unpack(client_circuit.listen(), time.monotonic())
+        inbound_tor_header, sender_port, data = cell.tor_header, cell.port, cell.payload
+        if inbound_tor_header.cmd == "DESTROY":
+            raise ConnectionError(f"Circuit {inbound_tor_header.circuit_id} was destroyed, DESTROY came from port {sender_port}")
+        if narrate:
+            gui_event_start("Client: Receive server response")
+            logging.info(f"\nINBOUND MESSAGE:\nTor header: {inbound_tor_header.as_dict()}\nData: DATA encrypted with RELAY {client_circuit.random_node_id_list[0]} SESSION KEY\nSender port: {sender_port}")
+            gui_event_stop(next_node="Client")
+        stream_id, response = self.handle_response(data, client_circuit)
+        if cell.trace is not None:
+            self.record_hops(cell, client_circuit)
+        client_circuit.use_count += 1
+        client_circuit.last_used = time.monotonic()
+        return response
+
+    def record_hops(self, cell: Cell, client_circuit: ClientCircuit):
+        """Add the hop records a traced response came back with, ending with the client's own, to hop_stats"""
+        trace = cell.trace + hop_record(client_circuit.port, BACKWARD, cell.received_at, cell.received_at, time.monotonic())
+        self.hop_stats.add(parse_trace(trace))
+
+    def destroy_circuit(self, client_circuit: ClientCircuit):
+        """Tear the circuit down, every relay on it passes the DESTROY on to the next one"""
+        first_hop = client_circuit.circuit_list[0]
+        logging.info(f"Destroying circuit {first_hop.circuit_id}...")
+        client_circuit.node_socket.send(pack_cell(TorHeader(first_hop.circuit_id, "DESTROY"), client_circuit.port, b""), first_hop.upstream_port)
+
+
+class CircuitStreams:
+    """Many concurrent request/response streams over one circuit
+
+    submit() sends a request on a new stream and returns a future for its response, a receiver thread
+    matches every RELAY BACKWARD cell to its stream. Use asyncio.wrap_future() to await the future.
+    The circuit must not be used for plain ClientNode.request() calls while streams are open.
+    """
+
+    def __init__(self, client: ClientNode, client_circuit: ClientCircuit):
+        self.client = client
+        self.circuit = client_circuit
+        self.stream_ids = itertools.count(1)
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        self.running = True
+        # The receiver wakes up this often to notice close()
+        client_circuit.node_socket.sc.settimeout(STREAM_POLL_INTERVAL)
+        self.receiver = threading.Thread(target=self.receive_loop, daemon=True, name=f"Streams {client_circuit.port}")
+        self.receiver.start()
+
+    def submit(self, request_msg: str) -> Future:
+        return self.submit_many([request_msg])[0]
+
+    def submit_many(self, request_msgs: List[str]) -> List[Future]:
+        """submit() for several requests at once, their cells are encrypted together"""
+        futures = [Future() for _ in request_msgs]
+        with self.pending_lock:
+            if not self.running:
+                raise ConnectionError("Circuit streams are closed")
+            stream_ids = [next(self.stream_ids) for _ in request_msgs]
+            self.pending.update(zip(stream_ids, futures))
+        for stream_id, future in zip(stream_ids, futures):
+            # A caller giving up on a stream should not leave it in the table
+            future.add_done_callback(lambda done, stream_id=stream_id: self.forget(stream_id))
+        try:
+            self.client.send_requests(request_msgs, self.circuit, stream_ids)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        return futures
+
+    def request(self, request_msg: str, timeout: float = None) -> str:
+        return self.submit(request_msg).result(timeout)
+
+    def forget(self, stream_id: int):
+        with self.pending_lock:
+            self.pending.pop(stream_id, None)
+
+    def receive_loop(self):
+        while self.running:
+            try:
+                messages = [self.circuit.listen()] + self.circuit.node_socket.drain(STREAM_RECEIVE_BATCH - 1)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            received_at = time.monotonic()
+            cells = [Cell.unpack(message, received_at) for message in messages]
+            destroy = next((cell for cell in cells if cell.tor_header.cmd == "DESTROY"), None)
+            if destroy is not None:
+                # Responses that came in ahead of the DESTROY are still delivered
+                cells = cells[:cells.index(destroy)]
+            if cells:
+                self.deliver(cells)
+            if destroy is not None:
+                logging.info(f"Circuit {destroy.tor_header.circuit_id} was destroyed by a relay")
+                with self.pending_lock:
+                    self.running = False
+                break
+        self.fail_pending(ConnectionError("Circuit closed"))
+
+    def deliver(self, cells: List[Cell]):
+        try:
+            responses = self.client.handle_responses([cell.payload for cell in cells], self.circuit)
+        except Exception:
+            if len(cells) > 1:
+                # Find the response at fault and deliver the others
+                for cell in cells:
+                    self.deliver([cell])
+                return
+            logging.exception("Failed to decrypt stream response")
+            return
+        for cell, (stream_id, response) in zip(cells, responses):
+            if cell.trace is not None:
+                self.client.record_hops(cell, self.circuit)
+            self.circuit.use_count += 1
+            self.circuit.last_used = time.monotonic()
+            with self.pending_lock:
+                future = self.pending.pop(stream_id, None)
+            if future is None:
+                logging.debug(f"Response for unknown or abandoned stream {stream_id}")
+            elif future.set_running_or_notify_cancel():
+                future.set_result(response)
+
+    def fail_pending(self, error: Exception):
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+    def close(self):
+        """Stop receiving and fail streams still waiting, the circuit's socket is closed"""
+        with self.pending_lock:
+            self.running = False
+        self.receiver.join()
+        self.circuit.node_socket.close()
 
 def thread_exception_handler(args):
     logging.error(f"Uncaught exception", exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
 
-def main(my_port: int, node_and_port_dict: dict, main_gui: tk.Tk, circuit_len: int, message: str):
+def main(my_port: int, node_and_port_dict: dict, main_gui: tk.Tk, circuit_len: int, message: str, handshake: int = HANDSHAKE_RSA,
+         key_pool_watermarks: tuple = (RSA_KEY_POOL_LOW, RSA_KEY_POOL_HIGH), fast_mode: bool = False):
     threading.excepthook = thread_exception_handler
+    set_fast_mode(fast_mode)
+    if not fast_mode:
+        start_event_trace("Client")
     try:
-        obj = ClientNode(my_port=my_port, node_and_port_dict=node_and_port_dict, main_gui=main_gui)
+        obj = ClientNode(my_port=my_port, node_and_port_dict=node_and_port_dict, main_gui=main_gui, handshake=handshake, headless=fast_mode,
+                         key_pool_low=key_pool_watermarks[0], key_pool_high=key_pool_watermarks[1])
         obj.start(circuit_len, message)
     except Exception:
         logging.exception("Caught Error")
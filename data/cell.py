@@ -0,0 +1,54 @@
+from typing import Tuple
+
+from data.header import HEADER_SIZE, TorHeader
+from data.hop_trace import split_trace
+
+CELL_SIZE = 512
+CELL_PAYLOAD_SIZE = CELL_SIZE - HEADER_SIZE
+CELL_PADDING = memoryview(bytes(CELL_PAYLOAD_SIZE))
+
+def pack_cell(tor_header: TorHeader, port: int, payload: bytes, fixed: bool = True) -> bytes:
+    """Pack a header and payload into a cell
+
+    On the wire the port field carries the sender port, inside an onion layer it carries the target port.
+    Fixed cells are zero padded to CELL_SIZE, payloads that do not fit are sent as variable length cells.
+    Onion layers are packed with fixed=False so the padding is not encrypted again at every hop.
+    """
+    header = tor_header.pack(port, len(payload))
+    if fixed and len(payload) < CELL_PAYLOAD_SIZE:
+        return header + payload + bytes(CELL_PAYLOAD_SIZE - len(payload))
+    return header + payload
+
+def cell_parts(tor_header: TorHeader, port: int, payload_parts: list) -> list:
+    """pack_cell() of a fixed cell as the list of its pieces, for a socket to gather without joining them"""
+    length = sum(len(part) for part in payload_parts)
+    parts = [tor_header.pack(port, length)] + payload_parts
+    if length < CELL_PAYLOAD_SIZE:
+        parts.append(CELL_PADDING[:CELL_PAYLOAD_SIZE - length])
+    return parts
+
+def unpack_cell(cell: bytes) -> Tuple[TorHeader, int, bytes]:
+    tor_header, port, length = TorHeader.unpack(cell)
+    return tor_header, port, cell[HEADER_SIZE:HEADER_SIZE + length]
+
+class Cell:
+    """A cell decoded once, handed as is to dispatch, logging and forwarding
+
+    `trace` holds the hop records of a traced cell and is None otherwise, `received_at` is when the node
+    read the cell off its socket.
+    """
+    __slots__ = ("tor_header", "port", "payload", "trace", "received_at")
+
+    def __init__(self, tor_header: TorHeader, port: int, payload: bytes, trace: bytes = None, received_at: float = 0.0):
+        self.tor_header = tor_header
+        self.port = port
+        self.payload = payload
+        self.trace = trace
+        self.received_at = received_at
+
+    @classmethod
+    def unpack(cls, cell: bytes, received_at: float = 0.0) -> "Cell":
+        """Decode a cell, the payload of a cell read into a receive buffer is a view into that buffer"""
+        tor_header, port, payload = unpack_cell(cell)
+        # Hop records are added to as the cell goes on, they get a copy of their own
+        return cls(tor_header, port, payload, bytes(split_trace(cell)) if tor_header.traced else None, received_at)
@@ -1,41 +1,58 @@
-from Crypto.Cipher import AES
+from data.cryptography import CircuitCrypto, decode_base64, encode_base64
+
+def link_key(port: int, circuit_id: int) -> int:
+    """(port of the peer, circuit id) packed in one int, cheaper to keep a million of than a tuple"""
+    return port << 32 | circuit_id
 
 class Circuit:
+    """One hop of a circuit: its id on the link towards the client, its session key and both neighbours
+
+    Relays hold one of these per circuit, so it has no __dict__, keeps the raw key and uses 0 for a port or id not known yet.
+    Each link is stored as its link_key(), the same int a relay's CircuitTable indexes the circuit by, and the
+    ports and ids are read out of it.
+    """
+    __slots__ = ("downstream_key", "upstream_key", "key", "last_used", "exit_counter")
+
     def __init__(self, circuit_id: int, sk: str):
-        self.circuit_id = circuit_id
-        self.sk = sk
+        self.downstream_key = link_key(0, circuit_id)
+        self.upstream_key = 0
+        self.key = decode_base64(sk)
+        self.last_used = 0.0
+        # Number of the next data cell the exit relay sends back, None once the circuit is extended past this hop
+        self.exit_counter = 0
 
     @property
-    def downstream_port(self):
-        return self._downstream_port
+    def circuit_id(self) -> int:
+        return self.downstream_key & 0xFFFFFFFF
 
-    @downstream_port.setter
-    def downstream_port(self, value):
-        self._downstream_port = value
+    @property
+    def downstream_port(self) -> int:
+        return self.downstream_key >> 32
 
-    # @property
-    # def downstream_id(self):
-    #     return self._downstream_id
+    @downstream_port.setter
+    def downstream_port(self, port: int):
+        self.downstream_key = link_key(port, self.circuit_id)
 
-    # @downstream_id.setter
-    # def downstream_id(self, value):
-    #     self._downstream_id = value
+    @property
+    def upstream_id(self) -> int:
+        return self.upstream_key & 0xFFFFFFFF
 
     @property
-    def upstream_port(self):
-        return self._upstream_port
+    def upstream_port(self) -> int:
+        return self.upstream_key >> 32
 
     @upstream_port.setter
-    def upstream_port(self, value):
-        self._upstream_port = value
+    def upstream_port(self, port: int):
+        self.upstream_key = link_key(port, self.upstream_id)
 
-    # @property
-    # def upstream_id(self):
-    #     return self._upstream_id
+    @property
+    def crypto(self) -> CircuitCrypto:
+        # Made on use, a circuit holds nothing but its key and the cipher comes from the cache
+        return CircuitCrypto(self.key)
 
-    # @upstream_id.setter
-    # def upstream_id(self, value):
-    #     self._upstream_id = value
+    @property
+    def sk(self) -> str:
+        return encode_base64(self.key)
 
     def __str__(self):
-        return f"id: {self.circuit_id}, sk: {self.sk}"
\ No newline at end of file
+        return f"id: {self.circuit_id}, sk: {self.sk}"
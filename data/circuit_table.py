@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from data.circuit import Circuit, link_key
+
+# Circuits a relay holds before evicting the least recently used one, about 300 MB of circuit state when full
+RELAY_MAX_CIRCUITS = 1_000_000
+# Seconds without a cell before a relay drops a circuit
+RELAY_CIRCUIT_IDLE_TIMEOUT = 300.0
+# Circuits keep the time they were last used to this many seconds, so those used within one tick share a float
+CIRCUIT_CLOCK_RESOLUTION = 1.0
+
+class CircuitTable:
+    """The circuits a relay knows, looked up from either of their links
+
+    Circuit ids are only unique per link, so circuits are keyed by (port of the peer, circuit id) on the link
+    towards the client and on the link away from it. The index of the link towards the client is kept in least
+    recently used order: the oldest circuit is evicted when the table is full, and circuits idle for longer than
+    `idle_timeout` are evicted by expire().
+
+    The table of worker `worker` of a relay sharded over `workers` processes only picks upstream circuit ids
+    with id % workers == worker, so the cells coming back on them are steered to it.
+    """
+
+    def __init__(self, max_circuits: int = RELAY_MAX_CIRCUITS, idle_timeout: float = RELAY_CIRCUIT_IDLE_TIMEOUT,
+                 worker: int = 0, workers: int = 1):
+        self.max_circuits = max_circuits
+        self.idle_timeout = idle_timeout
+        self.worker = worker
+        self.workers = workers
+        self.downstream = OrderedDict()
+        self.upstream = dict()
+        self.clock = time.monotonic()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.destroyed = 0
+        self.idle_evictions = 0
+        self.capacity_evictions = 0
+
+    def __len__(self):
+        return len(self.downstream)
+
+    def add(self, circuit: Circuit) -> List[Circuit]:
+        """Store a new circuit, returning the circuits it replaced or evicted"""
+        removed = []
+        with self.lock:
+            key = circuit.downstream_key
+            if key in self.downstream:
+                removed.append(self.downstream[key])
+                self.remove_locked(self.downstream[key])
+            while len(self.downstream) >= self.max_circuits:
+                oldest = next(iter(self.downstream.values()))
+                self.remove_locked(oldest)
+                self.capacity_evictions += 1
+                removed.append(oldest)
+            circuit.last_used = self.now()
+            self.downstream[key] = circuit
+            self.created += 1
+        return removed
+
+    def bind_upstream(self, circuit: Circuit, port: int):
+        """Pick a circuit id that is free on the link to `port` and route the circuit's upstream side through it"""
+        with self.lock:
+            if circuit.upstream_port:
+                del self.upstream[circuit.upstream_key]
+            upstream_id = self.random_upstream_id()
+            # Avoiding the ids the peer uses towards us too keeps DESTROY from that port unambiguous
+            while upstream_id == 0 or link_key(port, upstream_id) in self.upstream or link_key(port, upstream_id) in self.downstream:
+                upstream_id = self.random_upstream_id()
+            circuit.upstream_key = link_key(port, upstream_id)
+            self.upstream[circuit.upstream_key] = circuit
+
+    def random_upstream_id(self) -> int:
+        return random.getrandbits(31) // self.workers * self.workers + self.worker
+
+    def from_downstream(self, port: int, circuit_id: int) -> Circuit:
+        return self.touch(self.downstream.get(link_key(port, circuit_id)))
+
+    def from_upstream(self, port: int, circuit_id: int) -> Circuit:
+        return self.touch(self.upstream.get(link_key(port, circuit_id)))
+
+    def touch(self, circuit: Circuit) -> Circuit:
+        if circuit is not None:
+            with self.lock:
+                if self.downstream.get(circuit.downstream_key) is circuit:
+                    circuit.last_used = self.now()
+                    self.downstream.move_to_end(circuit.downstream_key)
+        return circuit
+
+    def now(self) -> float:
+        now = time.monotonic()
+        if now - self.clock >= CIRCUIT_CLOCK_RESOLUTION:
+            self.clock = now
+        return self.clock
+
+    def remove(self, circuit: Circuit) -> bool:
+        """Drop a destroyed circuit, returns False if it was already gone"""
+        with self.lock:
+            if self.downstream.get(circuit.downstream_key) is not circuit:
+                return False
+            self.remove_locked(circuit)
+            self.destroyed += 1
+            return True
+
+    def remove_locked(self, circuit: Circuit):
+        del self.downstream[circuit.downstream_key]
+        if circuit.upstream_port:
+            del self.upstream[circuit.upstream_key]
+
+    def expire(self) -> List[Circuit]:
+        """Evict the circuits idle for longer than the idle timeout"""
+        expired = []
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            while self.downstream:
+                oldest = next(iter(self.downstream.values()))
+                if oldest.last_used > deadline:
+                    break
+                self.remove_locked(oldest)
+                self.idle_evictions += 1
+                expired.append(oldest)
+        return expired
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"live": len(self.downstream), "created": self.created, "destroyed": self.destroyed,
+                    "idle_evictions": self.idle_evictions, "capacity_evictions": self.capacity_evictions}
@@ -1,14 +1,39 @@
+from functools import lru_cache
 from typing import Tuple
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import ECC, RSA
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Cipher._mode_ecb import EcbMode
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
+from Crypto.Util.strxor import strxor
 import base64
+import struct
 
 BLOCK_SIZE = 16
 KEY_SIZE = 16
 RSA_SIZE = 2048
+# Ready AES ciphers are kept for the most recently used session keys only, about 1.3 KB each, so a relay's memory
+# does not grow with a cipher per circuit. A cell of a circuit outside them builds its cipher again, about 12 us.
+# The ciphers of the counter keys are cached apart, as many again.
+AES_CIPHER_CACHE_SIZE = 16384
+# Counter mode keystreams of data cells. The cell's counter block at the exit is the direction in the top byte and
+# the number of the cell in the next 56 bits, every other hop's is that block under the counter keys of the hops
+# between it and the exit. A hop's keystream for a cell is its counter block XOR the index of every keystream
+# block, from 1, under its session key.
+KEYSTREAM_FORWARD = 0
+KEYSTREAM_BACKWARD = 1
+KEYSTREAM_BLOCK_INDEX = struct.Struct("!Q")
+# HKDF context of the key a hop wraps counter blocks with, derived from its session key so that the counter
+# blocks it passes on are never encrypted under the key of its keystreams
+COUNTER_KEY_CONTEXT = b"counter block"
+
+# Handshake type, sent as the first byte of CREATE and CREATED payloads
+HANDSHAKE_RSA = 0
+HANDSHAKE_X25519 = 1
+HANDSHAKE_TYPES = {"rsa": HANDSHAKE_RSA, "x25519": HANDSHAKE_X25519}
 
 def generate_session_key() -> str:
     return encode_base64(get_random_bytes(16))
@@ -34,33 +59,124 @@ def generate_rsa_cipher(key: bytes) -> PKCS1_OAEP.PKCS1OAEP_Cipher:
     return PKCS1_OAEP.new(key)
 
 def encrypt_with_aes(sk: str, message: str) -> str:
-    cipher = generate_aes_cipher(sk)
-    encrypted_message = cipher.encrypt(pad(message.encode(), BLOCK_SIZE))
-    return encode_base64(encrypted_message)
+    return encode_base64(encrypt_bytes_with_aes(sk, message.encode()))
 
 def decrypt_with_aes(sk: str, encoded_message: str) -> str:
-    message = decode_base64(encoded_message)
+    return decrypt_bytes_with_aes(sk, decode_base64(encoded_message)).decode()
+
+def encrypt_bytes_with_aes(sk: str, data: bytes) -> bytes:
     cipher = generate_aes_cipher(sk)
-    decrypted_message = unpad(cipher.decrypt(message), 16)
-    return decrypted_message.decode()
+    return cipher.encrypt(pad(data, BLOCK_SIZE))
+
+def decrypt_bytes_with_aes(sk: str, data: bytes) -> bytes:
+    cipher = generate_aes_cipher(sk)
+    return unpad(cipher.decrypt(data), BLOCK_SIZE)
 
 def encrypt_with_rsa(input_key: str, message: str) -> str:
     """
     Key can be either private key or public key
     """
-    key = RSA.import_key(input_key.encode())
-    cipher = generate_rsa_cipher(key)
+    cipher = generate_rsa_cipher(RSA.import_key(input_key.encode()))
     ciphertext = cipher.encrypt(message.encode())
     return encode_base64(ciphertext)
 
 def decrypt_with_rsa(private_key: str, message: str) -> str:
     "Key must be private"
-    key = RSA.import_key(private_key.encode())
-    cipher = generate_rsa_cipher(key)
+    cipher = generate_rsa_cipher(RSA.import_key(private_key.encode()))
     ciphertext = decode_base64(message)
     decrypted_text = cipher.decrypt(ciphertext).decode()
     return decrypted_text
 
+def generate_x25519_key() -> Tuple[ECC.EccKey, bytes]:
+    """Ephemeral X25519 key pair, the public key is returned raw (32 bytes)"""
+    private_key = ECC.generate(curve="Curve25519")
+    return private_key, private_key.public_key().export_key(format="raw")
+
+def derive_x25519_session_key(private_key: ECC.EccKey, peer_public_key: bytes, client_public_key: bytes, relay_public_key: bytes) -> str:
+    """Session key both ends derive from the X25519 shared secret, bound to both public keys by HKDF-SHA256"""
+    def kdf(shared_secret: bytes) -> bytes:
+        return HKDF(shared_secret, KEY_SIZE, b"", SHA256, context=client_public_key + relay_public_key)
+    session_key = key_agreement(eph_priv=private_key, eph_pub=import_x25519_public_key(peer_public_key), kdf=kdf)
+    return encode_base64(session_key)
+
+def counter_block(direction: int, counter: int) -> bytes:
+    """The counter block of cell `counter` in `direction` at the exit relay"""
+    return KEYSTREAM_BLOCK_INDEX.pack(direction << 56 | counter) + bytes(KEYSTREAM_BLOCK_INDEX.size)
+
+@lru_cache(maxsize=64)
+def keystream_indexes(count: int, cells: int = 1) -> bytes:
+    """The indexes of `count` keystream blocks as blocks, for each of `cells` cells"""
+    return b"".join(bytes(KEYSTREAM_BLOCK_INDEX.size) + KEYSTREAM_BLOCK_INDEX.pack(index) for index in range(1, count + 1)) * cells
+
+def keystream_counter_blocks(block: bytes, length: int) -> bytes:
+    """Blocks to encrypt for `length` bytes of the keystream of the cell with counter block `block`"""
+    count = -(-length // BLOCK_SIZE)
+    return strxor(block * count, keystream_indexes(count))
+
+def keystream_stride(length: int) -> int:
+    """Bytes the keystream of a `length` byte body takes, whole blocks"""
+    return -(-length // BLOCK_SIZE) * BLOCK_SIZE
+
+def batch_counter_blocks(blocks: bytes, length: int) -> bytes:
+    """keystream_counter_blocks() of several cells whose counter blocks are back to back in `blocks`,
+    keystream_stride(length) bytes per cell"""
+    count = keystream_stride(length) // BLOCK_SIZE
+    spread = b"".join([blocks[start:start + BLOCK_SIZE] * count for start in range(0, len(blocks), BLOCK_SIZE)])
+    return strxor(spread, keystream_indexes(count, len(blocks) // BLOCK_SIZE))
+
+@lru_cache(maxsize=AES_CIPHER_CACHE_SIZE)
+def aes_cipher(key: bytes) -> EcbMode:
+    return AES.new(key, AES.MODE_ECB)
+
+@lru_cache(maxsize=AES_CIPHER_CACHE_SIZE)
+def counter_cipher(key: bytes) -> EcbMode:
+    """Cipher of the counter key derived from session key `key`"""
+    return AES.new(HKDF(key, KEY_SIZE, b"", SHA256, context=COUNTER_KEY_CONTEXT), AES.MODE_ECB)
+
+class CircuitCrypto:
+    """Raw session key of one circuit, its cipher comes from the cache of recently used ones"""
+    __slots__ = ("key",)
+
+    def __init__(self, key: bytes):
+        self.key = key
+
+    @property
+    def cipher(self) -> EcbMode:
+        return aes_cipher(self.key)
+
+    def encrypt(self, data: bytes) -> bytes:
+        return self.cipher.encrypt(pad(data, BLOCK_SIZE))
+
+    def decrypt(self, data: bytes) -> bytes:
+        return unpad(self.cipher.decrypt(data), BLOCK_SIZE)
+
+    def keystream(self, counter_blocks: bytes) -> bytes:
+        # A CTR cipher object made for every cell costs more than the whole pass, the circuit's ECB cipher encrypts
+        # the counter blocks instead
+        return self.cipher.encrypt(counter_blocks)
+
+    def keystream_xor(self, block: bytes, data: bytes) -> bytes:
+        """`data` XOR the AES-CTR keystream of the cell with counter block `block`, which both adds and removes a layer"""
+        keystream = self.keystream(keystream_counter_blocks(block, len(data)))[:len(data)]
+        # Without cffi, pycryptodome hands anything but bytes to C through ctypes, copying a view out is cheaper
+        return strxor(data if isinstance(data, bytes) else bytes(data), keystream)
+
+    def keystream_xor_batch(self, counter_blocks: bytes, buffer):
+        """XOR the keystream of `counter_blocks` into `buffer` in place, one AES call and one XOR for every cell in it
+
+        `buffer` is a bytearray or writable memoryview as long as `counter_blocks`, the bodies of the cells
+        each at the start of their stride.
+        """
+        strxor(buffer, self.keystream(counter_blocks), output=buffer)
+
+    def wrap_counters(self, blocks: bytes) -> bytes:
+        """This hop's counter blocks, back to back, as the hop on its client side uses them"""
+        return counter_cipher(self.key).encrypt(blocks)
+
+    def unwrap_counters(self, blocks: bytes) -> bytes:
+        """Counter blocks of the hop on the client side of this one, back to back, as this hop uses them"""
+        return counter_cipher(self.key).decrypt(blocks)
+
 
 def encode_base64(data) -> str:
     return base64.b64encode(data).decode()
@@ -0,0 +1,120 @@
+import os
+import struct
+import threading
+import time
+from typing import NamedTuple
+
+# timestamp, then the byte lengths of the node name, event name, next node and detail that follow the header
+EVENT_HEADER = struct.Struct("!dHHHI")
+TRACE_SUFFIX = ".trace"
+
+class Event(NamedTuple):
+    timestamp: float
+    node: str
+    name: str
+    next_node: str
+    detail: str
+
+
+def trace_path(directory: str, node: str) -> str:
+    return os.path.join(directory, f"{node}{TRACE_SUFFIX}")
+
+
+class EventTraceWriter:
+    """Append-only trace of the GUI events of one node"""
+
+    def __init__(self, directory: str, node: str):
+        self.node = node
+        self.path = trace_path(directory, node)
+        # Every run starts a new trace
+        self.trace_file = open(self.path, "wb")
+        self.lock = threading.Lock()
+
+    def append(self, name: str, next_node: str, detail: str, timestamp: float = None):
+        node, name, next_node, detail = (field.encode() for field in (self.node, name, next_node, detail))
+        record = EVENT_HEADER.pack(time.time() if timestamp is None else timestamp,
+                                   len(node), len(name), len(next_node), len(detail)) + node + name + next_node + detail
+        with self.lock:
+            self.trace_file.write(record)
+
+    def flush(self):
+        with self.lock:
+            self.trace_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.trace_file.close()
+
+
+def read_event(trace_file) -> Event:
+    """The event at the current position of `trace_file`, None at the end of the trace or of what is written so far"""
+    header = trace_file.read(EVENT_HEADER.size)
+    if len(header) < EVENT_HEADER.size:
+        return None
+    timestamp, *lengths = EVENT_HEADER.unpack(header)
+    body = trace_file.read(sum(lengths))
+    if len(body) < sum(lengths):
+        return None
+    fields = []
+    start = 0
+    for length in lengths:
+        fields.append(body[start:start + length].decode())
+        start += length
+    return Event(timestamp, *fields)
+
+
+class TraceTail:
+    """Reads a trace while its node is still appending to it"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.trace_file = None
+        self.offset = 0
+
+    def next(self) -> Event:
+        """The next complete event, None if the node has not written it yet"""
+        if self.trace_file is None:
+            if not os.path.exists(self.path):
+                return None
+            self.trace_file = open(self.path, "rb")
+        if os.fstat(self.trace_file.fileno()).st_size < self.offset:
+            # The node started over with a new trace
+            self.offset = 0
+        self.trace_file.seek(self.offset)
+        event = read_event(self.trace_file)
+        if event is not None:
+            self.offset = self.trace_file.tell()
+        return event
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+
+
+class LiveEventFeed:
+    """Events of a run in the order they happened, following every event to the node the next one is at
+
+    Every poll() returns the events written since the last one, so a run can be shown while it is still going.
+    Each node's trace is read once from start to end, so replay is linear in the number of events.
+    """
+
+    def __init__(self, directory: str, first_node: str = "Client"):
+        self.directory = directory
+        self.node = first_node
+        self.tails = dict()
+
+    def poll(self, limit: int = None) -> list:
+        events = []
+        while limit is None or len(events) < limit:
+            if self.node not in self.tails:
+                self.tails[self.node] = TraceTail(trace_path(self.directory, self.node))
+            event = self.tails[self.node].next()
+            if event is None:
+                break
+            events.append(event)
+            self.node = event.next_node
+        return events
+
+    def close(self):
+        for tail in self.tails.values():
+            tail.close()
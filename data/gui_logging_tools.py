@@ -1,20 +1,62 @@
 import logging
+import threading
+from data.event_trace import EventTraceWriter
+from data.node_logging import NODE_LOG_DATE_FORMAT, NODE_LOG_FORMAT
+
+# Teaching mode narrates every step so the client GUI can replay it, fast mode drops the narration.
+# Callers building costly narration put it behind `if narrating():` so fast mode does not format it at all.
+narration_enabled = True
+event_trace = None
+# The event each thread is narrating, log lines written meanwhile become its detail
+open_events = threading.local()
+
+class EventDetailHandler(logging.Handler):
+    """Collects the log lines written between gui_event_start and gui_event_stop into the event's detail"""
+
+    def emit(self, record: logging.LogRecord):
+        detail = getattr(open_events, "detail", None)
+        if detail is not None:
+            detail.append(self.format(record))
+
+
+def set_fast_mode(fast: bool):
+    global narration_enabled
+    narration_enabled = not fast
+
+def narrating() -> bool:
+    return narration_enabled
+
+def start_event_trace(node: str, directory: str = "logs"):
+    """Record this process's GUI events in the binary trace of `node` that the client replays"""
+    global event_trace
+    event_trace = EventTraceWriter(directory, node)
+    detail_handler = EventDetailHandler()
+    # Event details read like the node's log
+    detail_handler.setFormatter(logging.Formatter(NODE_LOG_FORMAT, datefmt=NODE_LOG_DATE_FORMAT))
+    logging.getLogger().addHandler(detail_handler)
 
 def gui_event_start(name):
-    logging.info(f"\nGUI_EVENT_START\n{name}")
+    if narration_enabled:
+        logging.info(f"\nGUI_EVENT_START\n{name}")
+        if event_trace is not None:
+            open_events.name = name
+            open_events.detail = []
 
 # def gui_event_additional_info(info: dict)
 #     logging.info(f"\nGUI_EVENT_ADDITIONAL_INFO\n{info}")
 
 def gui_event_stop(next_node):
-    logging.info(f"\nGUI_EVENT_STOP\nNext event at: {next_node}")
-
-def gui_event_get_next(string:str):
-    return string[15:]
+    if narration_enabled:
+        detail = getattr(open_events, "detail", None)
+        if event_trace is not None and detail is not None:
+            open_events.detail = None
+            event_trace.append(open_events.name, next_node, "\n".join(detail))
+            event_trace.flush()
+        logging.info(f"\nGUI_EVENT_STOP\nNext event at: {next_node}")
 
 def gui_event_get_node_name_from_port(port:int):
     if port == 9998:
         return "Client"
     if port == 9999:
         return "Server"
-    return f"Relay {port - 10000}"
\ No newline at end of file
+    return f"Relay {port - 10000}"
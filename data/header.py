@@ -1,6 +1,41 @@
-import json
+import struct
+from typing import Tuple
+
+# circuit id, command, port, payload length
+HEADER_STRUCT = struct.Struct("!IBHI")
+HEADER_SIZE = HEADER_STRUCT.size
+
+COMMAND_CODES = {
+    "CREATE": 1,
+    "CREATED": 2,
+    "EXTEND": 3,
+    "EXTENDED": 4,
+    "RELAY FORWARD": 5,
+    "RELAY BACKWARD": 6,
+    "DESTROY": 7,
+}
+COMMAND_NAMES = {code: cmd for cmd, code in COMMAND_CODES.items()}
+# Command of a cell whose code is not in COMMAND_CODES, nodes have no handler for it and drop the cell
+UNKNOWN_COMMAND = "UNKNOWN"
+# Set in the command byte of a traced cell, which then ends with the hop records of data.hop_trace
+TRACE_FLAG = 0x80
 
 class TorHeader:
-    def __init__(self, circuit_id: int, cmd: str):
+    __slots__ = ("circuit_id", "cmd", "traced")
+
+    def __init__(self, circuit_id: int, cmd: str, traced: bool = False):
         self.circuit_id = circuit_id
-        self.cmd = cmd
\ No newline at end of file
+        self.cmd = cmd
+        self.traced = traced
+
+    def as_dict(self) -> dict:
+        return {"circuit_id": self.circuit_id, "cmd": self.cmd}
+
+    def pack(self, port: int, length: int) -> bytes:
+        return HEADER_STRUCT.pack(self.circuit_id, COMMAND_CODES[self.cmd] | (TRACE_FLAG if self.traced else 0), port, length)
+
+    @classmethod
+    def unpack(cls, buffer: bytes) -> Tuple["TorHeader", int, int]:
+        """Returns the header, the port field and the payload length"""
+        circuit_id, cmd_code, port, length = HEADER_STRUCT.unpack_from(buffer)
+        return cls(circuit_id, COMMAND_NAMES.get(cmd_code & ~TRACE_FLAG, UNKNOWN_COMMAND), bool(cmd_code & TRACE_FLAG)), port, length
@@ -0,0 +1,124 @@
+import struct
+import threading
+from typing import Dict, List, NamedTuple
+
+# Port of the node, direction, then monotonic times: cell received, handler started, crypto done. The time the
+# cell is handed to the socket is only known once the record is on its way, so it is not recorded.
+HOP_RECORD = struct.Struct("!HBddd")
+# A traced cell ends with its hop records and their count
+HOP_COUNT = struct.Struct("!B")
+FORWARD = 0
+BACKWARD = 1
+# For the server, "crypto" is the time its request handler took
+SERVER = 2
+DIRECTION_NAMES = {FORWARD: "forward", BACKWARD: "backward", SERVER: "server"}
+# Upper bounds of the histogram buckets in microseconds, the last bucket takes everything above
+LATENCY_BUCKETS_US = [2 ** exponent for exponent in range(21)]
+
+class HopRecord(NamedTuple):
+    port: int
+    direction: int
+    received: float
+    started: float
+    crypto_done: float
+
+
+def hop_record(port: int, direction: int, received: float, started: float, crypto_done: float) -> bytes:
+    return HOP_RECORD.pack(port, direction, received, started, crypto_done)
+
+def trace_suffix(trace: bytes) -> bytes:
+    return trace + HOP_COUNT.pack(len(trace) // HOP_RECORD.size)
+
+def with_trace(cell: bytes, trace: bytes) -> bytes:
+    return cell + trace_suffix(trace)
+
+def split_trace(message: bytes) -> bytes:
+    """The hop records at the end of a traced message"""
+    count, = HOP_COUNT.unpack_from(message, len(message) - HOP_COUNT.size)
+    end = len(message) - HOP_COUNT.size
+    return message[end - count * HOP_RECORD.size:end]
+
+def parse_trace(trace: bytes) -> List[HopRecord]:
+    return [HopRecord(*fields) for fields in HOP_RECORD.iter_unpack(trace)]
+
+
+class LatencyHistogram:
+    """Counts of durations in power of two microsecond buckets, with their exact count, sum and maximum"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_US) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        microseconds = seconds * 1e6
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_US) and microseconds > LATENCY_BUCKETS_US[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += microseconds
+        self.max = max(self.max, microseconds)
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket holding the given percentile, in microseconds"""
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return LATENCY_BUCKETS_US[bucket] if bucket < len(LATENCY_BUCKETS_US) else self.max
+        return 0.0
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean_us": round(self.total / self.count, 1), "p50_us": self.percentile(50),
+                "p99_us": self.percentile(99), "max_us": round(self.max, 1)}
+
+
+class HopLatencyStats:
+    """Where the time of traced requests went, per position along the circuit and per node
+
+    Every hop is split into stages: transit from the previous hop's crypto being done until this hop read the
+    cell, which takes in the previous hop's send and the time the cell waited in this hop's socket, queue from
+    reading it until its handler started, and crypto.
+    """
+
+    STAGES = ("transit", "queue", "crypto")
+
+    def __init__(self):
+        self.per_hop = dict()
+        self.per_node = dict()
+        self.lock = threading.Lock()
+
+    def add(self, records: List[HopRecord]):
+        with self.lock:
+            self.add_locked(records)
+
+    def add_locked(self, records: List[HopRecord]):
+        previous = None
+        for position, record in enumerate(records):
+            stages = {
+                "transit": record.received - previous.crypto_done if previous is not None else None,
+                "queue": record.started - record.received,
+                "crypto": record.crypto_done - record.started,
+            }
+            hop = (position, record.direction)
+            for table, key in ((self.per_hop, hop), (self.per_node, record.port)):
+                histograms = table.setdefault(key, {stage: LatencyHistogram() for stage in self.STAGES})
+                for stage, seconds in stages.items():
+                    if seconds is not None:
+                        histograms[stage].add(seconds)
+            previous = record
+
+    def report(self, node_names: Dict[int, str] = None) -> dict:
+        node_names = node_names or dict()
+        with self.lock:
+            return {
+                "per_hop": {f"{position} {DIRECTION_NAMES[direction]}": {stage: histogram.summary() for stage, histogram in histograms.items()}
+                            for (position, direction), histograms in sorted(self.per_hop.items())},
+                "per_node": {node_names.get(port, f"port {port}"): {stage: histogram.summary() for stage, histogram in histograms.items()}
+                             for port, histograms in sorted(self.per_node.items())},
+            }
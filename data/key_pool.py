@@ -0,0 +1,78 @@
+import logging
+import threading
+from collections import deque
+from typing import Tuple
+
+from data.cryptography import generate_rsa_key
+
+RSA_KEY_POOL_LOW = 2
+RSA_KEY_POOL_HIGH = 8
+
+class RsaKeyPool:
+    """RSA key pairs generated ahead of demand by a background thread
+
+    Whenever the pool drops below `low_watermark` keys the worker refills it up to `high_watermark`.
+    Taking a key from an empty pool generates one on the spot and counts as a miss.
+    """
+
+    def __init__(self, low_watermark: int = RSA_KEY_POOL_LOW, high_watermark: int = RSA_KEY_POOL_HIGH):
+        if not 0 < low_watermark <= high_watermark:
+            raise ValueError(f"Invalid key pool watermarks: low {low_watermark}, high {high_watermark}")
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.keys = deque()
+        self.condition = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.running = True
+        # An empty pool starts out below the low watermark
+        self.refilling = True
+        self.worker = threading.Thread(target=self.fill, name="RSA key pool", daemon=True)
+        self.worker.start()
+
+    def take(self) -> Tuple[str, str]:
+        with self.condition:
+            if self.keys:
+                self.hits += 1
+                key_pair = self.keys.popleft()
+            else:
+                self.misses += 1
+                key_pair = None
+            if len(self.keys) < self.low_watermark:
+                self.refilling = True
+                self.condition.notify_all()
+        return key_pair or generate_rsa_key()
+
+    def fill(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.keys) >= self.low_watermark:
+                    self.refilling = False
+                    self.condition.notify_all()
+                    self.condition.wait()
+                if not self.running:
+                    return
+                self.refilling = True
+                missing = self.high_watermark - len(self.keys)
+            logging.debug(f"Refilling RSA key pool with {missing} key(s)")
+            for _ in range(missing):
+                key_pair = generate_rsa_key()
+                with self.condition:
+                    if not self.running:
+                        return
+                    self.keys.append(key_pair)
+                    self.condition.notify_all()
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        """Block until the worker has finished refilling"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.refilling or not self.running, timeout)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {"size": len(self.keys), "hits": self.hits, "misses": self.misses}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
@@ -0,0 +1,127 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+NODE_LOG_FORMAT = '%(asctime)-4s %(levelname)-6s %(threadName)s:%(lineno)-3d %(message)s'
+NODE_LOG_DATE_FORMAT = '%H:%M:%S'
+# Records waiting for the writer thread before new ones are dropped
+LOG_QUEUE_SIZE = 10000
+# Records written between two flushes of the log file
+LOG_FLUSH_BATCH = 256
+LOG_MAX_BYTES = 16 * 2**20
+LOG_BACKUP_COUNT = 3
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the log writer without ever blocking the thread that logs
+
+    Drop policy: when the queue is full the writer has fallen behind, and the new record is dropped and
+    counted instead of waiting for room. The writer logs how many records were dropped once it catches up.
+    """
+
+    def __init__(self, log_queue: queue.SimpleQueue, queue_size: int = LOG_QUEUE_SIZE):
+        super().__init__(log_queue)
+        self.queue_size = queue_size
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The writer thread is in the same process, so the record is queued as is and formatted there
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # SimpleQueue has no bound of its own but is far cheaper to put into than Queue, checking the size
+        # first keeps it near queue_size
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+        else:
+            self.queue.put(record)
+
+
+class BatchedFileHandler(RotatingFileHandler):
+    """Size rotated log file that is flushed by the log writer once per batch rather than after every record"""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class LogWriter:
+    """Background thread writing the records queued by a DroppingQueueHandler to a BatchedFileHandler"""
+
+    def __init__(self, queue_handler: DroppingQueueHandler, file_handler: BatchedFileHandler, batch_size: int = LOG_FLUSH_BATCH):
+        self.queue_handler = queue_handler
+        self.file_handler = file_handler
+        self.batch_size = batch_size
+        self.dropped_reported = 0
+        self.thread = threading.Thread(target=self.run, daemon=True, name="Log writer")
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        log_queue = self.queue_handler.queue
+        while True:
+            batch = [log_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    self.file_handler.flush_batch()
+                    return
+                self.file_handler.handle(record)
+            self.report_dropped()
+            self.file_handler.flush_batch()
+            # Formatting holds the GIL, hand it back between batches so a node thread waiting for it is not held up
+            time.sleep(0)
+
+    def report_dropped(self):
+        dropped = self.queue_handler.dropped
+        if dropped > self.dropped_reported:
+            self.file_handler.handle(logging.makeLogRecord({
+                "name": "node_logging", "levelno": logging.WARNING, "levelname": "WARNING", "threadName": self.thread.name,
+                "msg": f"Log writer fell behind, {dropped - self.dropped_reported} log records dropped",
+            }))
+            self.dropped_reported = dropped
+
+    def stop(self):
+        """Write out what is queued and stop the thread"""
+        if self.thread.is_alive():
+            self.queue_handler.queue.put(None)
+            self.thread.join()
+        self.file_handler.close()
+
+
+def start_node_logging(filename: str, level: int, queue_size: int = LOG_QUEUE_SIZE, max_bytes: int = LOG_MAX_BYTES,
+                       backup_count: int = LOG_BACKUP_COUNT) -> LogWriter:
+    """Send this process's logs to `filename` through a queue and a background writer thread
+
+    Cells are forwarded on the threads that log, so they only queue records and never wait on the file.
+    Replaces the handlers the process inherited, so a node started from the main program gets a log of its own.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    # A rotating handler always appends, start every run with an empty log like before
+    open(filename, "w").close()
+    file_handler = BatchedFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(logging.Formatter(NODE_LOG_FORMAT, datefmt=NODE_LOG_DATE_FORMAT))
+    queue_handler = DroppingQueueHandler(queue.SimpleQueue(), queue_size)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # Node logs show no process fields, skip looking them up for every record
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    writer = LogWriter(queue_handler, file_handler)
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
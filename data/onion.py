@@ -0,0 +1,89 @@
+import struct
+from typing import List, Sequence, Tuple
+from Crypto.Util.strxor import strxor
+
+from data.cell import CELL_PAYLOAD_SIZE
+from data.cryptography import BLOCK_SIZE, CircuitCrypto, batch_counter_blocks, keystream_stride
+
+# Counter block of a data cell, ahead of its onion layers, see data.cryptography.counter_block. Every hop decrypts
+# the counter block of a forward cell with its counter key and encrypts that of a backward cell, so a cell carries a
+# different counter block on every link and cells cannot be matched across a relay by it.
+CELL_COUNTER_SIZE = BLOCK_SIZE
+# Under all the layers: the port the exit relay sends the data to, 0 towards the client, and the length of the data
+ONION_HEADER = struct.Struct("!HI")
+# Data cells are zero padded to this body size, which stays the same at every hop
+ONION_BODY_SIZE = CELL_PAYLOAD_SIZE - CELL_COUNTER_SIZE
+
+def seal(port: int, data: bytes) -> bytes:
+    """The body of a data cell before any layer is added
+
+    The layers are not authenticated: flipping a bit of a body on the way flips the same bit of what the exit or
+    the client unseals, so anyone on the path can change the port or the data of a cell unnoticed. Bodies are
+    kept confidential only.
+    """
+    body = ONION_HEADER.pack(port, len(data)) + data
+    if len(body) < ONION_BODY_SIZE:
+        body += bytes(ONION_BODY_SIZE - len(body))
+    return body
+
+def unseal(body: bytes) -> Tuple[int, bytes]:
+    port, length = ONION_HEADER.unpack_from(body)
+    return port, body[ONION_HEADER.size:ONION_HEADER.size + length]
+
+def onion_payload(block: bytes, body: bytes) -> bytes:
+    return bytes(block) + body
+
+def onion_parts(block: bytes, body: bytes) -> list:
+    """onion_payload() as pieces for Node.tor_send(), the body is not copied"""
+    return [block, body]
+
+def split_payload(payload: bytes) -> Tuple[bytes, bytes]:
+    return bytes(payload[:CELL_COUNTER_SIZE]), payload[CELL_COUNTER_SIZE:]
+
+def wrap_counters(layers: Sequence[CircuitCrypto], blocks: bytes) -> Tuple[List[bytes], bytes]:
+    """For exit counter blocks back to back, the counter blocks of every hop, first hop first, and the blocks the first hop receives"""
+    hop_blocks = []
+    for crypto in reversed(layers):
+        hop_blocks.append(blocks)
+        blocks = crypto.wrap_counters(blocks)
+    return hop_blocks[::-1], blocks
+
+def unwrap_counters(layers: Sequence[CircuitCrypto], blocks: bytes) -> List[bytes]:
+    """For counter blocks back to back as the client receives them, the counter blocks of every hop, first hop first"""
+    hop_blocks = []
+    for crypto in layers:
+        blocks = crypto.unwrap_counters(blocks)
+        hop_blocks.append(blocks)
+    return hop_blocks
+
+def apply_layers(layers: Sequence[CircuitCrypto], hop_blocks: Sequence[bytes], body: bytes) -> bytes:
+    """Add or remove the layer of every hop at once, each with its own counter block
+
+    Keystream layers commute, so the keystreams of all hops are XORed together and the body is XORed
+    with the result. The counter blocks of all hops are built in one go.
+    """
+    stride = keystream_stride(len(body))
+    counter_blocks = batch_counter_blocks(b"".join(hop_blocks), len(body))
+    mask = None
+    for start, crypto in zip(range(0, len(counter_blocks), stride), layers):
+        keystream = crypto.keystream(counter_blocks[start:start + stride])
+        mask = keystream if mask is None else strxor(mask, keystream)
+    return strxor(body, mask[:len(body)])
+
+def pack_bodies(bodies: Sequence[bytes], length: int) -> bytearray:
+    """One buffer holding bodies of `length` bytes, each at the start of its keystream stride"""
+    gap = bytes(keystream_stride(length) - length)
+    return bytearray(gap.join(bodies) + gap)
+
+def unpack_bodies(buffer, count: int, length: int) -> List[memoryview]:
+    stride = keystream_stride(length)
+    view = memoryview(buffer)
+    return [view[index * stride:index * stride + length] for index in range(count)]
+
+def apply_layers_batch(layers: Sequence[CircuitCrypto], hop_blocks: Sequence[bytes], buffer, length: int):
+    """apply_layers() for a buffer of pack_bodies(), in place, one AES call per hop for all the cells
+
+    `hop_blocks` holds the counter blocks of every hop, those of all the cells back to back.
+    """
+    for crypto, blocks in zip(layers, hop_blocks):
+        crypto.keystream_xor_batch(batch_counter_blocks(blocks, length), buffer)
@@ -0,0 +1,14 @@
+import struct
+from typing import Tuple
+
+# Every relay payload starts with the id of the stream it belongs to, so many request/response
+# streams can share one circuit. The server echoes the id back with the response.
+STREAM_STRUCT = struct.Struct("!I")
+STREAM_HEADER_SIZE = STREAM_STRUCT.size
+
+def pack_stream(stream_id: int, payload: bytes) -> bytes:
+    return STREAM_STRUCT.pack(stream_id) + payload
+
+def unpack_stream(data: bytes) -> Tuple[int, bytes]:
+    stream_id, = STREAM_STRUCT.unpack_from(data)
+    return stream_id, data[STREAM_HEADER_SIZE:]
@@ -0,0 +1,93 @@
+import tkinter as tk
+import tkinter.font as tkfont
+from typing import Callable
+
+class VirtualListbox(tk.Frame):
+    """A list of text rows that only draws the rows in view
+
+    A Tk Listbox keeps a widget item for every row and slows down with many thousands of them. This list
+    keeps the rows as plain strings and a fixed set of canvas items, one per visible row, that are given
+    the text of whatever rows are scrolled into view. Adding rows or scrolling costs the same with
+    a hundred rows as with a million.
+    """
+
+    def __init__(self, master, width: int = 35, height: int = 10, on_select: Callable[[int], None] = None):
+        super().__init__(master)
+        self.font = tkfont.nametofont("TkDefaultFont")
+        self.row_height = self.font.metrics("linespace") + 2
+        self.canvas = tk.Canvas(self, width=self.font.measure("0") * width, height=self.row_height * height,
+                                background="white", highlightthickness=0)
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.canvas.pack(fill="both", expand=True, side="left")
+        self.scrollbar.pack(fill="y", side="left")
+        self.rows = []
+        self.top = 0
+        self.selected = None
+        self.on_select = on_select
+        self.row_items = []
+        self.highlight = self.canvas.create_rectangle(0, 0, 0, 0, fill="#0078d7", width=0, state="hidden")
+
+        self.canvas.bind("<Configure>", lambda event: self.redraw())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<MouseWheel>", lambda event: self.yview("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.canvas.bind("<Button-4>", lambda event: self.yview("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda event: self.yview("scroll", 1, "units"))
+
+    def visible_rows(self) -> int:
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def size(self) -> int:
+        return len(self.rows)
+
+    def append(self, rows: list):
+        self.rows.extend(rows)
+        self.redraw()
+
+    def redraw(self):
+        visible = self.visible_rows()
+        self.top = max(0, min(self.top, len(self.rows) - visible))
+        while len(self.row_items) < visible:
+            self.row_items.append(self.canvas.create_text(4, len(self.row_items) * self.row_height, anchor="nw", font=self.font))
+        for position, item in enumerate(self.row_items):
+            index = self.top + position
+            text = self.rows[index] if position < visible and index < len(self.rows) else ""
+            self.canvas.itemconfigure(item, text=text, fill="white" if index == self.selected else "black")
+        if self.selected is not None and self.top <= self.selected < self.top + visible:
+            y = (self.selected - self.top) * self.row_height
+            self.canvas.coords(self.highlight, 0, y, self.canvas.winfo_width(), y + self.row_height)
+            self.canvas.itemconfigure(self.highlight, state="normal")
+            self.canvas.tag_lower(self.highlight)
+        else:
+            self.canvas.itemconfigure(self.highlight, state="hidden")
+        if self.rows:
+            self.scrollbar.set(self.top / len(self.rows), min(1.0, (self.top + visible) / len(self.rows)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def yview(self, *args):
+        visible = self.visible_rows()
+        if args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.rows))
+        elif args[0] == "scroll":
+            step = visible if args[2] == "pages" else 1
+            self.top += int(args[1]) * step
+        self.redraw()
+
+    def see(self, index: int):
+        visible = self.visible_rows()
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + visible:
+            self.top = index - visible + 1
+        self.redraw()
+
+    def select(self, index: int):
+        self.selected = index
+        self.see(index)
+        if self.on_select is not None:
+            self.on_select(index)
+
+    def on_click(self, event):
+        index = self.top + event.y // self.row_height
+        if index < len(self.rows):
+            self.select(index)
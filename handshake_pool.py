@@ -0,0 +1,75 @@
+import logging
+import multiprocessing
+import os
+from multiprocessing.connection import Connection
+from typing import Iterator, Tuple
+
+from data.cryptography import HANDSHAKE_X25519, derive_x25519_session_key, encrypt_with_rsa, generate_session_key, generate_x25519_key
+
+HANDSHAKE_POOL_WORKERS = 2
+# Handshakes a relay keeps in flight, CREATE cells beyond that are refused with a DESTROY
+HANDSHAKE_MAX_PENDING = 64
+# Niceness of the pool processes, so a relay forwarding data cells wins the cores they share
+HANDSHAKE_WORKER_NICE = 10
+
+def handshake(handshake_type: int, client_handshake_data: bytes) -> Tuple[str, bytes]:
+    """The relay's half of a CREATE: the session key, and the reply data of the CREATED cell"""
+    if handshake_type == HANDSHAKE_X25519:
+        relay_private_key, relay_public_key = generate_x25519_key()
+        sk = derive_x25519_session_key(relay_private_key, client_handshake_data, client_handshake_data, relay_public_key)
+        return sk, relay_public_key
+    sk = generate_session_key()
+    return sk, encrypt_with_rsa(client_handshake_data.decode(), sk).encode()
+
+def handshake_worker(jobs: multiprocessing.Queue, completions: Connection, completions_lock):
+    if hasattr(os, "nice"):
+        os.nice(HANDSHAKE_WORKER_NICE)
+    while True:
+        job_id, handshake_type, client_handshake_data = jobs.get()
+        try:
+            result = handshake(handshake_type, client_handshake_data)
+        except Exception:
+            logging.exception(f"Handshake {job_id} failed")
+            result = None
+        with completions_lock:
+            completions.send((job_id, result))
+
+
+class HandshakePool:
+    """Processes doing the public key work of one relay's CREATE cells
+
+    The pool is started by the program that starts the relay, see main.start_nodes. The relay submits jobs
+    and waits on `completions` next to its socket, every completion is its job id and the result of
+    handshake(), None if it failed.
+    """
+
+    def __init__(self, workers: int = HANDSHAKE_POOL_WORKERS, max_pending: int = HANDSHAKE_MAX_PENDING):
+        self.max_pending = max_pending
+        self.jobs = multiprocessing.Queue()
+        self.completions, self.completions_writer = multiprocessing.Pipe(duplex=False)
+        # Kept here as well, a process started with spawn unpickles its arguments after start() returns
+        self.completions_lock = multiprocessing.Lock()
+        self.processes = [multiprocessing.Process(target=handshake_worker, args=(self.jobs, self.completions_writer, self.completions_lock),
+                                                  daemon=True)
+                          for _ in range(workers)]
+
+    def __getstate__(self):
+        # A relay process gets the job queue and the completions pipe only, the worker processes belong to the
+        # program that started them, so the pool can be passed to a relay process under spawn as well as fork
+        return {"max_pending": self.max_pending, "jobs": self.jobs, "completions": self.completions, "processes": []}
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def submit(self, job_id: int, handshake_type: int, client_handshake_data: bytes):
+        self.jobs.put((job_id, handshake_type, client_handshake_data))
+
+    def ready(self) -> Iterator[Tuple[int, Tuple[str, bytes]]]:
+        """Completions that arrived so far, without waiting"""
+        while self.completions.poll():
+            yield self.completions.recv()
+
+    def terminate(self):
+        for process in self.processes:
+            process.terminate()
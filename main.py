@@ -11,13 +11,33 @@ import sys
 import server_node
 import relay_node
 import client
+from data.cryptography import HANDSHAKE_TYPES
+from data.node_logging import start_node_logging
+from handshake_pool import HandshakePool
+from node_socket import reuseport_sockets, reuseport_supported
 
 basic_logging = logging.INFO
 client_logging = logging.INFO
 list_nodes = []
+# The relays' handshake pools, a relay process started with spawn opens their queues after start_nodes returns
+handshake_pools = []
 client_port = 9998
 server_port = 9999
 node_starting_port = 10000
+async_nodes = False
+# Keep the server answering requests on a pool of server_workers threads instead of replying once
+persistent_server = False
+server_workers = 4
+# Skip the step by step narration and the replay window, for runs where only speed matters
+fast_mode = False
+# Worker processes per relay, sharing its port with circuits split between them by id (Linux only)
+relay_workers = 1
+# Processes doing the public key work of CREATE cells for every relay process, 0 does it in the relay
+handshake_workers = 0
+# "rsa" or "x25519", see data.cryptography.HANDSHAKE_TYPES
+handshake_mode = "rsa"
+# Low and high watermarks of the client's RSA key pool, (0, 0) generates keys on demand
+rsa_key_pool_watermarks = (2, 8)
 
 logging.basicConfig(format='%(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
                     datefmt='%Y-%m-%d:%H:%M:%S',
@@ -34,13 +54,7 @@ class NodeProcess(multiprocessing.Process):
 
 
 def reload_logging_config_node(filename):
-    from importlib import reload
-    reload(logging)
-    logging.basicConfig(format='%(asctime)-4s %(levelname)-6s %(threadName)s:%(lineno)-3d %(message)s',
-                        datefmt='%H:%M:%S',
-                        filename=f"logs/{filename}",
-                        filemode='w',
-                        level=client_logging)
+    start_node_logging(f"logs/{filename}", client_logging)
 
 def handle_exception(exc_type, exc_value, exc_traceback):
     logger.error(f"Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
@@ -123,14 +137,47 @@ def main():
 def execution(node_number, circuit_length, message, main_gui):
     logger = logging.getLogger(__name__)
     sys.excepthook = handle_exception
+    node_and_port_dict = start_nodes(node_number, server_port, node_starting_port, persistent_server, fast_mode, relay_workers,
+                                     handshake_workers)
+
+    logger.info("Launching client...")
+    logger.info(f"Creating client instance at port {client_port}...")
+    reload_logging_config_node(f"Client.txt")
+    thread = threading.Thread(target=client.main, name="Client", daemon=True, args=(
+        client_port,
+        node_and_port_dict,
+        main_gui,
+        circuit_length,
+        message,
+        HANDSHAKE_TYPES[handshake_mode],
+        rsa_key_pool_watermarks,
+        fast_mode
+    ))
+    thread.start()
+
+def start_nodes(node_number: int, server_port: int, node_starting_port: int, persistent: bool, fast: bool, workers: int = 1,
+                handshake_workers: int = 0) -> dict:
+    """Start the server and `node_number` relays in processes of their own, returns the port of every relay
+
+    With more than one worker every relay runs as that many processes sharing its port, and with handshake
+    workers every relay process gets a pool of that many processes for its handshakes. They are started
+    from here because node processes are daemonic and cannot start processes of their own.
+    """
     makedirs("logs", exist_ok=True)
+    if workers > 1 and not reuseport_supported:
+        logger.warning("Relay workers need SO_REUSEPORT on Linux, running one process per relay")
+        workers = 1
 
     logger.info("The main program is running...")
     logger.info(f"Creating server instance at port {server_port}...")
     logger.info("Start running server nodes...")
     process = NodeProcess(target=server_node.main, daemon=True, args=(
         server_port,
-        node_number
+        node_number,
+        async_nodes,
+        persistent,
+        server_workers,
+        fast
     ))
     process.start()
     list_nodes.append(process)
@@ -146,32 +193,39 @@ def execution(node_number, circuit_length, message, main_gui):
     node_and_port_dict = dict()
     for node_id in range(node_number):
         this_node_port = node_starting_port + node_id
-        process = NodeProcess(target=relay_node.main, daemon=True, args=(
-            node_id,
-            port_used_for_node,
-            this_node_port,
-            node_number
-        ))
-        process.start()
-        list_nodes.append(process)
+        # All sockets of a relay are bound here, in worker order, before any worker starts
+        worker_sockets = reuseport_sockets(this_node_port, workers) if workers > 1 else [None]
+        for worker, worker_socket in enumerate(worker_sockets):
+            handshake_pool = None
+            if handshake_workers > 0:
+                handshake_pool = HandshakePool(handshake_workers)
+                handshake_pool.start()
+                handshake_pools.append(handshake_pool)
+                list_nodes.extend(handshake_pool.processes)
+            process = NodeProcess(target=relay_node.main, daemon=True, args=(
+                node_id,
+                port_used_for_node,
+                this_node_port,
+                node_number,
+                async_nodes,
+                fast,
+                worker,
+                workers,
+                worker_socket,
+                handshake_pool
+            ))
+            process.start()
+            list_nodes.append(process)
+        for worker_socket in worker_sockets:
+            if worker_socket is not None:
+                worker_socket.close()
         node_and_port_dict[node_id] = this_node_port
     logger.info("Done running relay nodes...")
     logger.info(f"Available nodes for relay:\n{pformat(node_and_port_dict)}")
 
     logger.info("Done running multiple nodes...")
     logger.debug(f"number of running processes: {len(list_nodes)}")
-
-    logger.info("Launching client...")
-    logger.info(f"Creating client instance at port {client_port}...")
-    reload_logging_config_node(f"Client.txt")
-    thread = threading.Thread(target=client.main, name="Client", daemon=True, args=(
-        client_port,
-        node_and_port_dict,
-        main_gui,
-        circuit_length,
-        message
-    ))
-    thread.start()
+    return node_and_port_dict
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
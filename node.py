@@ -1,20 +1,99 @@
+import asyncio
 import logging
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from data.cell import cell_parts
+from data.header import TorHeader
+from data.hop_trace import trace_suffix
 from node_socket import UdpSocket
 
+# Handlers run on the event loop itself unless a worker count is given
+ASYNC_WORKERS = 0
+
+class NodeProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol that hands every inbound message to its node as a separate task"""
+
+    def __init__(self, node: "Node"):
+        self.node = node
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address):
+        message, ack = self.node.node_socket.reassembler.feed(data, address)
+        if ack is not None:
+            self.transport.sendto(ack, address)
+        if message is not None:
+            self.node.dispatch(message)
+
+    def error_received(self, exc: Exception):
+        logging.error(f"Datagram error: {exc}")
+
+
 class Node:
 
-    def __init__(self, my_id: int, my_port: int):
+    def __init__(self, my_id: int, my_port: int, sc: socket.socket = None):
         self.my_id = my_id
-        self.my_port = my_port
-        self.node_socket = UdpSocket(my_port)
+        self.node_socket = UdpSocket(my_port, sc=sc)
+        # Port 0 binds an ephemeral port, keep the one actually bound so peers can reply
+        self.my_port = self.node_socket.sc.getsockname()[1]
+        self.loop = None
+        self.executor = None
+        self.pending_tasks = set()
 
     def start(self):
         pass
 
-    def listen_procedure(self) -> str:
+    def handle_message(self, inbound_message: bytes, received_at: float = None):
+        pass
+
+    def start_async(self, workers: int = ASYNC_WORKERS):
+        asyncio.run(self.serve_async(workers))
+
+    async def serve_async(self, workers: int = ASYNC_WORKERS):
+        self.loop = asyncio.get_running_loop()
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"Node {self.my_id}")
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: NodeProtocol(self), sock=self.node_socket.sc)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+
+    def dispatch(self, inbound_message: bytes):
+        # Taken here so the time a cell waits for a handler shows in hop traces
+        task = self.loop.create_task(self.handle_message_async(inbound_message, time.monotonic()))
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    async def handle_message_async(self, inbound_message: bytes, received_at: float):
+        try:
+            if self.executor is None:
+                self.handle_message(inbound_message, received_at)
+            else:
+                await self.loop.run_in_executor(self.executor, self.handle_message, inbound_message, received_at)
+        except Exception:
+            logging.exception("Failed to handle message")
+
+    def listen_procedure(self) -> bytes:
         inbound_message, address = self.node_socket.listen()
         return inbound_message
 
-    def sending_procedure(self, message, port):
-        self.node_socket.send(message, port)
\ No newline at end of file
+    def sending_procedure(self, message: bytes, port: int):
+        self.node_socket.send(message, port)
+
+    def tor_send(self, circuit_id: int, cmd: str, data, target_port: int, trace: bytes = None):
+        """Send a cell, a traced one if `trace` holds the hop records it collected so far
+
+        `data` is the payload, or the list of pieces it is made of. The socket gathers the cell from its
+        pieces, a payload that is a view into a receive buffer goes out without being copied.
+        """
+        parts = cell_parts(TorHeader(circuit_id, cmd, traced=trace is not None), self.my_port, data if isinstance(data, list) else [data])
+        if trace is not None:
+            parts.append(trace_suffix(trace))
+        self.node_socket.send_parts(parts, target_port)
@@ -1,13 +1,61 @@
+import ctypes
 import logging
+import queue
+import random
+import select
 import socket
+import struct
+import sys
 import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# kind, message id, sequence number, fragment count, flow id
+FRAGMENT_STRUCT = struct.Struct("!BIIII")
+# Every fragment of a message carries the message's first four bytes, the circuit id of a cell, as its flow id
+FLOW_ID = struct.Struct("!I")
+FLOW_ID_OFFSET = FRAGMENT_STRUCT.size - FLOW_ID.size
+FRAGMENT_DATA = 0
+FRAGMENT_ACK = 1
+FRAGMENT_PAYLOAD_SIZE = 1400
+DATAGRAM_SIZE = FRAGMENT_STRUCT.size + FRAGMENT_PAYLOAD_SIZE
+RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024
+# Datagrams read without a copy go into a ring of preallocated buffers, a message read that way is a view into
+# one of them and stays valid until this many more datagrams are read
+RECEIVE_RING_SIZE = 64
+
+# Messages longer than one window are flow controlled with cumulative acks
+ACK_WINDOW = 32
+ACK_TIMEOUT = 0.2
+SEND_RETRIES = 10
+
+REASSEMBLY_TIMEOUT = 5.0
+MAX_PENDING_MESSAGES = 256
+MAX_REASSEMBLY_BYTES = 64 * 1024 * 1024
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# Connected sockets kept open per destination port, least recently used is closed first
+SEND_POOL_SIZE = 16
+# Linux UDP segmentation offload lets a single sendmsg carry a whole window of fragments
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+segmentation_offload = sys.platform.startswith("linux")
+# Linux lets sockets sharing a port with SO_REUSEPORT pick which of them gets a datagram with a classic BPF program
+SO_ATTACH_REUSEPORT_CBPF = 51
+reuseport_supported = sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+# struct sock_filter, one classic BPF instruction: opcode, jump offsets and constant
+BPF_INSTRUCTION = struct.Struct("HBBI")
+# Windows sockets have no sendmsg, a datagram is joined from its parts there
+gather_supported = hasattr(socket.socket, "sendmsg")
 
 
 class NodeSocket:
 
-    def __init__(self, socket_kind: socket.SocketKind, port: int = 0):
-        sc = socket.socket(socket.AF_INET, socket_kind)
-        sc.bind(('127.0.0.1', port))
+    def __init__(self, socket_kind: socket.SocketKind, port: int = 0, sc: socket.socket = None):
+        # A socket bound beforehand, like one of a group sharing a port, is used as is
+        if sc is None:
+            sc = socket.socket(socket.AF_INET, socket_kind)
+            sc.bind(('127.0.0.1', port))
         self.sc = sc
 
 
@@ -39,19 +87,351 @@ class TcpSocket(NodeSocket):
             s.sendall(message.encode("UTF-8"))
             return s.recv(1024).decode("UTF-8")
 
+def fragment_header(message_id: int, seq: int, count: int, first_bytes: bytes) -> bytes:
+    """Header of fragment `seq` of a message starting with `first_bytes`, its flow id is their first four bytes"""
+    flow_id, = FLOW_ID.unpack_from(first_bytes) if len(first_bytes) >= FLOW_ID.size else (0,)
+    return FRAGMENT_STRUCT.pack(FRAGMENT_DATA, message_id, seq, count, flow_id)
+
+def fragment(message: bytes) -> List[bytes]:
+    message_id = random.getrandbits(32)
+    count = max(1, -(-len(message) // FRAGMENT_PAYLOAD_SIZE))
+    return [
+        fragment_header(message_id, seq, count, message) + message[seq * FRAGMENT_PAYLOAD_SIZE:(seq + 1) * FRAGMENT_PAYLOAD_SIZE]
+        for seq in range(count)
+    ]
+
+def flow_steering_filter(count: int) -> bytes:
+    """Classic BPF program sending a datagram to socket number (flow id % count) of its SO_REUSEPORT group"""
+    instructions = [
+        # A = 32 bit word at the flow id, offsets start at the UDP payload
+        (0x20, 0, 0, FLOW_ID_OFFSET),
+        # A = A % count
+        (0x94, 0, 0, count),
+        # return A
+        (0x16, 0, 0, 0),
+    ]
+    return b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in instructions)
+
+def reuseport_sockets(port: int, count: int) -> List[socket.socket]:
+    """`count` UDP sockets bound to the same port, each getting the datagrams of the flows that are theirs
+
+    The kernel numbers the sockets of a group in the order they were bound, so socket i gets every flow id
+    with flow id % count == i, fragments of a message all go to the same socket.
+    """
+    if not reuseport_supported:
+        raise OSError("Steering datagrams between sockets sharing a port needs SO_REUSEPORT on Linux")
+    sockets = []
+    for _ in range(count):
+        sc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sc.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sc.bind(('127.0.0.1', port))
+        sockets.append(sc)
+    code = flow_steering_filter(count)
+    program = ctypes.create_string_buffer(code, len(code))
+    # struct sock_fprog: instruction count and a pointer to the instructions
+    fprog = struct.pack("@HP", len(code) // BPF_INSTRUCTION.size, ctypes.addressof(program))
+    sockets[0].setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    return sockets
+
+def send_batch(sc: socket.socket, fragments: List[bytes]):
+    """Send fragments back to back on a connected socket, in one system call where the kernel allows it"""
+    global segmentation_offload
+    if segmentation_offload and len(fragments) > 1:
+        try:
+            sc.sendmsg([b"".join(fragments)], [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", DATAGRAM_SIZE))])
+            return
+        except ConnectionRefusedError:
+            raise
+        except OSError as e:
+            logging.info(f"UDP segmentation offload unavailable ({e}), sending fragments one by one")
+            segmentation_offload = False
+    for each_fragment in fragments:
+        sc.send(each_fragment)
+
+def send_gathered(sc: socket.socket, parts: List[bytes]):
+    """Send one datagram made of `parts` on a connected socket"""
+    if gather_supported:
+        sc.sendmsg(parts)
+    else:
+        sc.send(b"".join(parts))
+
+def send_fragments(sc: socket.socket, fragments: List[bytes]):
+    """Send the fragments of one message on a connected socket
+
+    Messages of up to ACK_WINDOW fragments are sent like any other datagram. Longer messages are sent
+    one window at a time, go-back-N style, waiting for the receiver to ack what it has reassembled so far.
+    """
+    if len(fragments) <= ACK_WINDOW:
+        send_batch(sc, fragments)
+        return
+
+    kind, message_id, seq, count, flow_id = FRAGMENT_STRUCT.unpack_from(fragments[0])
+    previous_timeout = sc.gettimeout()
+    sc.settimeout(ACK_TIMEOUT)
+    try:
+        base = 0
+        retries = 0
+        while base < count:
+            send_batch(sc, fragments[base:base + ACK_WINDOW])
+            try:
+                acked = wait_for_ack(sc, message_id)
+            except socket.timeout:
+                retries += 1
+                if retries > SEND_RETRIES:
+                    raise TimeoutError(f"No ack for message {message_id} to {sc.getpeername()} after {SEND_RETRIES} retries")
+                continue
+            if acked > base:
+                base = acked
+                retries = 0
+    finally:
+        sc.settimeout(previous_timeout)
+
+def wait_for_ack(sc: socket.socket, message_id: int) -> int:
+    while True:
+        datagram = sc.recv(FRAGMENT_STRUCT.size)
+        kind, acked_message_id, acked, count, flow_id = FRAGMENT_STRUCT.unpack_from(datagram)
+        if kind == FRAGMENT_ACK and acked_message_id == message_id:
+            return acked
+
+
+class PendingMessage:
+
+    def __init__(self, count: int):
+        self.fragments = [None] * count
+        self.received = 0
+        self.contiguous = 0
+        self.size = 0
+        self.last_seen = time.monotonic()
+
+
+class Reassembler:
+    """Bounded reassembly buffer for fragmented messages
+
+    Incomplete messages are dropped once they have not seen a fragment for `timeout` seconds,
+    or oldest first when the buffer holds more than `max_pending` messages or `max_bytes` bytes.
+    """
+
+    def __init__(self, timeout: float = REASSEMBLY_TIMEOUT, max_pending: int = MAX_PENDING_MESSAGES, max_bytes: int = MAX_REASSEMBLY_BYTES):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.pending = OrderedDict()
+        self.pending_bytes = 0
+        # Recently completed messages, so retransmitted fragments are acked instead of reassembled again
+        self.completed = OrderedDict()
+        self.dropped = 0
+
+    def feed(self, datagram: bytes, address) -> Tuple[Optional[bytes], Optional[bytes]]:
+        """Returns the reassembled message once it is complete and the ack to send back to the sender, if any"""
+        kind, message_id, seq, count, flow_id = FRAGMENT_STRUCT.unpack_from(datagram)
+        if kind != FRAGMENT_DATA or seq >= count:
+            return None, None
+        if count == 1:
+            return datagram[FRAGMENT_STRUCT.size:], None
+        if count * FRAGMENT_PAYLOAD_SIZE > MAX_MESSAGE_SIZE:
+            logging.warning(f"Dropping message {message_id} from {address}: {count} fragments is over the size limit")
+            return None, None
+
+        key = (address, message_id)
+        flow_controlled = count > ACK_WINDOW
+        needs_ack = flow_controlled and ((seq + 1) % ACK_WINDOW == 0 or seq + 1 == count)
+        if key in self.completed:
+            return None, FRAGMENT_STRUCT.pack(FRAGMENT_ACK, message_id, count, count, flow_id) if needs_ack else None
+
+        now = time.monotonic()
+        self.expire(now)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = PendingMessage(count)
+        else:
+            self.pending.move_to_end(key)
+        pending.last_seen = now
+
+        if pending.fragments[seq] is None:
+            # The datagram may be a view into a receive buffer that is read into again
+            payload = bytes(datagram[FRAGMENT_STRUCT.size:])
+            pending.fragments[seq] = payload
+            pending.received += 1
+            pending.size += len(payload)
+            self.pending_bytes += len(payload)
+            while pending.contiguous < count and pending.fragments[pending.contiguous] is not None:
+                pending.contiguous += 1
+
+        ack = FRAGMENT_STRUCT.pack(FRAGMENT_ACK, message_id, pending.contiguous, count, flow_id) if needs_ack else None
+        if pending.received == count:
+            self.remove(key)
+            self.completed[key] = count
+            if len(self.completed) > self.max_pending:
+                self.completed.popitem(last=False)
+            return b"".join(pending.fragments), ack
+
+        while len(self.pending) > self.max_pending or self.pending_bytes > self.max_bytes:
+            self.drop(next(iter(self.pending)))
+        return None, ack
+
+    def expire(self, now: float):
+        while self.pending:
+            key, pending = next(iter(self.pending.items()))
+            if now - pending.last_seen < self.timeout:
+                return
+            self.drop(key)
+
+    def drop(self, key):
+        address, message_id = key
+        pending = self.remove(key)
+        self.dropped += 1
+        logging.warning(f"Dropping incomplete message {message_id} from {address}: {pending.received}/{len(pending.fragments)} fragments")
+
+    def remove(self, key) -> PendingMessage:
+        pending = self.pending.pop(key)
+        self.pending_bytes -= pending.size
+        return pending
+
+
 class UdpSocket(NodeSocket):
 
-    def __init__(self, port: int = 0):
-        super(UdpSocket, self).__init__(socket.SOCK_DGRAM, port)
+    def __init__(self, port: int = 0, pool_size: int = SEND_POOL_SIZE, sc: socket.socket = None):
+        super(UdpSocket, self).__init__(socket.SOCK_DGRAM, port, sc)
+        self.sc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+        self.reassembler = Reassembler()
+        self.receive_buffer = memoryview(bytearray(DATAGRAM_SIZE))
+        self.receive_ring = None
+        self.ring_position = 0
+        # A pool size of 0 opens a fresh socket for every message
+        self.pool_size = pool_size
+        self.send_sockets = OrderedDict()
+        self.pool_lock = threading.Lock()
+        # Messages longer than ACK_WINDOW fragments wait for their acks on a sender thread, so the thread reading
+        # the socket keeps acking what peers send it. Later messages to a port with one of them queued are queued
+        # behind it to keep their order.
+        self.send_queue = queue.SimpleQueue()
+        self.queued = dict()
+        self.queue_lock = threading.Lock()
+        self.sender = None
 
-    def listen(self):
-        input_value_byte, address = self.sc.recvfrom(2048)
-        return input_value_byte.decode("UTF-8"), address
+    def listen(self, copy: bool = True):
+        while True:
+            message, address = self.receive(copy)
+            if message is not None:
+                return message, address
+
+    def receive(self, copy: bool = True):
+        """Read one datagram, returns the message it completes, None if it does not complete one
+
+        The datagram is read into a preallocated buffer and a message that came in it is copied out once.
+        With copy=False the buffer is the next one of the receive ring and the message is a view
+        into it, valid until RECEIVE_RING_SIZE more datagrams are read.
+        """
+        if copy:
+            buffer = self.receive_buffer
+        else:
+            if self.receive_ring is None:
+                self.receive_ring = [memoryview(bytearray(DATAGRAM_SIZE)) for _ in range(RECEIVE_RING_SIZE)]
+            buffer = self.receive_ring[self.ring_position]
+            self.ring_position = (self.ring_position + 1) % RECEIVE_RING_SIZE
+        size, address = self.sc.recvfrom_into(buffer)
+        message, ack = self.reassembler.feed(buffer[:size], address)
+        if ack is not None:
+            self.sc.sendto(ack, address)
+        if copy and isinstance(message, memoryview):
+            message = bytes(message)
+        return message, address
+
+    def drain(self, limit: int, copy: bool = True) -> List[bytes]:
+        """Messages completed by the datagrams already waiting, reading at most `limit` datagrams and never blocking"""
+        messages = []
+        for _ in range(limit):
+            if not select.select([self.sc], [], [], 0)[0]:
+                break
+            message, address = self.receive(copy)
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    def send(self, message: bytes, port: int = 0):
+        self.send_parts([message], port)
+
+    def send_parts(self, parts: list, port: int = 0):
+        """Send the message made of `parts` in order, each a bytes-like object
+
+        A message that fits one datagram is gathered from its parts by sendmsg behind its fragment header,
+        without joining them where sendmsg exists. The first part holds at least the first four bytes of the message.
+        A message that cannot be delivered, like one to a port nobody listens on, is logged and dropped.
+        """
+        if sum(len(part) for part in parts) <= FRAGMENT_PAYLOAD_SIZE:
+            send, data = send_gathered, [fragment_header(random.getrandbits(32), 0, 1, parts[0])] + parts
+        else:
+            send, data = send_fragments, fragment(b"".join(parts))
+        with self.queue_lock:
+            if len(data) > ACK_WINDOW or port in self.queued:
+                self.queued[port] = self.queued.get(port, 0) + 1
+                # Parts may be views into the receive ring
+                self.send_queue.put((port, send, [bytes(part) for part in data]))
+                if self.sender is None:
+                    self.sender = threading.Thread(target=self.send_queued, name="Fragment sender", daemon=True)
+                    self.sender.start()
+                return
+        self.send_now(port, send, data)
+
+    def send_queued(self):
+        while True:
+            item = self.send_queue.get()
+            if item is None:
+                return
+            port, send, data = item
+            self.send_now(port, send, data)
+            with self.queue_lock:
+                self.queued[port] -= 1
+                if self.queued[port] == 0:
+                    del self.queued[port]
+
+    def send_now(self, port: int, send, data: list):
+        """Send with `send` to `port`, a message that cannot be delivered is logged and dropped"""
+        try:
+            if self.pool_size == 0:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+                    client_socket.connect(("127.0.0.1", port))
+                    send(client_socket, data)
+                return
 
-    @staticmethod
-    def send(message: str, port: int = 0):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client_socket.sendto(message.encode("UTF-8"), ("127.0.0.1", port))
-        client_socket.close()
+            while True:
+                entry = self.get_send_socket(port)
+                client_socket, send_lock = entry
+                with send_lock:
+                    # Evicted and closed by another thread while this one waited for the lock, take a pooled one
+                    if self.send_sockets.get(port) is not entry:
+                        continue
+                    try:
+                        send(client_socket, data)
+                    except ConnectionRefusedError:
+                        # Pending error from an earlier datagram, sent while nothing was listening on the port
+                        send(client_socket, data)
+                    return
+        except OSError as e:
+            logging.warning(f"Dropping message to port {port}: {e!r}")
 
+    def get_send_socket(self, port: int) -> Tuple[socket.socket, threading.Lock]:
+        with self.pool_lock:
+            entry = self.send_sockets.get(port)
+            if entry is not None:
+                self.send_sockets.move_to_end(port)
+                return entry
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client_socket.connect(("127.0.0.1", port))
+            entry = self.send_sockets[port] = (client_socket, threading.Lock())
+            evicted = self.send_sockets.popitem(last=False)[1] if len(self.send_sockets) > self.pool_size else None
+        if evicted is not None:
+            evicted_socket, evicted_lock = evicted
+            # Waits for a send in progress, later senders see the entry is gone from the pool
+            with evicted_lock:
+                evicted_socket.close()
+        return entry
 
+    def close(self):
+        if self.sender is not None:
+            self.send_queue.put(None)
+        with self.pool_lock:
+            for client_socket, send_lock in self.send_sockets.values():
+                client_socket.close()
+            self.send_sockets.clear()
+        self.sc.close()
@@ -1,19 +1,55 @@
-import json
+import asyncio
+import itertools
 import logging
+from multiprocessing.connection import wait
 from pprint import pformat
+import socket
 import threading
+import time
+from data.cell import Cell
 from data.header import TorHeader
 from node import Node
-from data.cryptography import generate_session_key, encrypt_with_rsa, decrypt_with_aes, encrypt_with_aes
+from data.cryptography import HANDSHAKE_X25519, KEYSTREAM_BACKWARD, counter_block, generate_session_key, encrypt_with_rsa, generate_x25519_key, derive_x25519_session_key
 from data.circuit import Circuit
+from data.circuit_table import RELAY_CIRCUIT_IDLE_TIMEOUT, RELAY_MAX_CIRCUITS, CircuitTable
+from data.hop_trace import BACKWARD, FORWARD, hop_record
+from data.onion import onion_parts, seal, split_payload, unseal
+from data.stream import unpack_stream
 from data.gui_logging_tools import *
+from data.node_logging import start_node_logging
+from handshake_pool import HandshakePool
+
+# Seconds between two logs of the relay's circuit metrics
+RELAY_METRICS_INTERVAL = 60.0
+# Cells handled in a row while handshakes are waiting to be finished, before finishing them anyway
+HANDSHAKE_FINISH_INTERVAL = 32
+# Data cells are handled as views into the receive ring, other cells are kept or decoded and are copied out first
+DATA_COMMANDS = ("RELAY FORWARD", "RELAY BACKWARD")
 
 class RelayNode(Node):
-    def __init__(self, my_id: int, my_port: int, ports_of_nodes: list, node_number: int):
-        super().__init__(my_id=my_id, my_port=my_port)
+    def __init__(self, my_id: int, my_port: int, ports_of_nodes: list, node_number: int,
+                 max_circuits: int = RELAY_MAX_CIRCUITS, idle_timeout: float = RELAY_CIRCUIT_IDLE_TIMEOUT,
+                 worker: int = 0, workers: int = 1, sc: socket.socket = None, handshake_pool: HandshakePool = None):
+        super().__init__(my_id=my_id, my_port=my_port, sc=sc)
+        # Without narration, CREATE cells are handed to the pool and finished once their crypto is done
+        self.handshake_pool = handshake_pool
+        self.pending_handshakes = dict()
+        self.handshake_ids = itertools.count()
         self.node_number = node_number
-        self.circuit_dict = dict()
-        self.circuit_where_upstream_id_equals = dict()
+        # A relay sharded over several processes gets the circuits whose ids map to its worker number
+        self.circuits = CircuitTable(max_circuits, idle_timeout, worker, workers)
+        # Backward cells of one circuit can be handled on several executor threads at once
+        self.exit_counter_lock = threading.Lock()
+        self.metrics_logged_at = time.monotonic()
+        self.handlers = {
+            "CREATE": self.create,
+            "EXTEND": self.extend,
+            "CREATED": self.cr_or_ext,
+            "EXTENDED": self.cr_or_ext,
+            "RELAY FORWARD": self.relay_forward,
+            "RELAY BACKWARD": self.relay_backward,
+            "DESTROY": self.destroy,
+        }
 
         self.port_of_nodes_dictionary = {}
         for i in range(0, node_number):
@@ -21,228 +57,373 @@ class RelayNode(Node):
         logging.debug(f"self.port_of_nodes_dictionary: {pformat(self.port_of_nodes_dictionary)}")
 
     def start(self):
+        # Narration decodes payloads and gets them as bytes, otherwise cells are handled in the receive ring
+        copy = narrating()
+        if self.handshake_pool is None:
+            while True:
+                message, address = self.node_socket.listen(copy)
+                self.handle_received(message)
+        sc = self.node_socket.sc
+        cells = 0
         while True:
-            gui_event_start(f"Relay {self.my_id}: inbound message")
-            inbound_message = self.listen_procedure()
-            message = json.loads(inbound_message)
-            header = TorHeader(**message["tor_header"])
-            cmd = header.cmd
-
-            if cmd == "CREATE":
-                logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: CLIENT PUBLIC KEY\nSender port: {message['sender_port']}")
-                gui_event_stop(next_node=f"Relay {self.my_id}")
-                self.create(header, message["data"], message["sender_port"])
-            elif cmd == "EXTEND":
-                logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {message['sender_port']}")
-                gui_event_stop(next_node=f"Relay {self.my_id}")
-                self.extend(header, message["data"], message["sender_port"])
-            elif cmd in ["CREATED", "EXTENDED"]:
-                if cmd == "CREATED":
-                    logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: RELAY {gui_event_get_node_name_from_port(message['sender_port'])[-1]} SESSION KEY\nSender port: {message['sender_port']}")
-                else:
-                    logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: DATA ENCRYPTED with RELAY {gui_event_get_node_name_from_port(message['sender_port'])[-1]} SESSION KEY\nSender port: {message['sender_port']}")
-                gui_event_stop(next_node=f"Relay {self.my_id}")
-                self.cr_or_ext(header, message["data"], message["sender_port"])
-            elif cmd == "RELAY FORWARD":
-                logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {message['sender_port']}")
-                gui_event_stop(next_node=f"Relay {self.my_id}")
-                self.relay_forward(header, message["data"], message["sender_port"])
-            elif cmd == "RELAY BACKWARD":
-                if isinstance(message['data'], dict) or self.is_json(message['data']):
-                    logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: {message['data']}\nSender port: {message['sender_port']}")
-                else:
-                    logging.info(f"\nINBOUND MESSAGE:\nTor header: {message['tor_header']}\nData: DATA encrypted with RELAY {gui_event_get_node_name_from_port(message['sender_port'])[-1]} SESSION KEY\nSender port: {message['sender_port']}")
-                gui_event_stop(next_node=f"Relay {self.my_id}")
-                self.relay_backward(header, message["data"])
+            ready = wait([sc, self.handshake_pool.completions])
+            # Cells go first, handshakes are finished when no cell is waiting or after a run of cells
+            if sc in ready and cells < HANDSHAKE_FINISH_INTERVAL:
+                message, address = self.node_socket.receive(copy)
+                if message is not None:
+                    self.handle_received(message)
+                cells += 1
             else:
-                logging.debug(f"Received unknown command {cmd}")
+                self.finish_handshakes()
+                cells = 0
 
-    def create(self, tor_header: TorHeader, data: dict, sender_port: int):
-        gui_event_start(f"Relay {self.my_id}: Initializing new circuit")
+    async def serve_async(self, workers: int = 0):
+        if self.handshake_pool is not None:
+            asyncio.get_running_loop().add_reader(self.handshake_pool.completions.fileno(), self.finish_handshakes)
+        await super().serve_async(workers)
 
-        logging.info("Command received: CREATE")
-        logging.info("Initializing new circuit...")
-        # Initialize data
-        logging.info("Generating session key...")
-        sk = generate_session_key()
-        gk = data["gk"]
+    def handle_message(self, inbound_message: bytes, received_at: float = None):
+        self.evict_idle_circuits()
+        cell = Cell.unpack(inbound_message, time.monotonic() if received_at is None else received_at)
+        handler = self.handlers.get(cell.tor_header.cmd)
+        if handler is None:
+            logging.debug(f"Received unknown command {cell.tor_header.cmd}")
+            return
+        if isinstance(cell.payload, memoryview) and cell.tor_header.cmd not in DATA_COMMANDS:
+            cell.payload = bytes(cell.payload)
+        if narrating():
+            gui_event_start(f"Relay {self.my_id}: inbound message")
+            logging.info(f"\nINBOUND MESSAGE:\nTor header: {cell.tor_header.as_dict()}\n{self.describe_inbound(cell)}Sender port: {cell.port}")
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+        handler(cell)
 
-        # Store circuit data
-        logging.info("Storing downstream node to memory...")
-        new_circuit = Circuit(tor_header.circuit_id, sk)
+    def handle_received(self, inbound_message):
+        """handle_message() for the receive loop, a cell whose handler fails is logged and dropped"""
+        try:
+            self.handle_message(inbound_message)
+        except Exception:
+            logging.exception("Failed to handle message")
+
+    def describe_inbound(self, cell: Cell) -> str:
+        cmd = cell.tor_header.cmd
+        if cmd == "CREATE":
+            return "Data: CLIENT PUBLIC KEY\n"
+        if cmd in ["EXTEND", "RELAY FORWARD"]:
+            return f"Data: DATA encrypted with RELAY {self.my_id} SESSION KEY\n"
+        if cmd == "CREATED":
+            return f"Data: RELAY {gui_event_get_node_name_from_port(cell.port)[-1]} SESSION KEY\n"
+        if cmd == "EXTENDED":
+            return f"Data: DATA ENCRYPTED with RELAY {gui_event_get_node_name_from_port(cell.port)[-1]} SESSION KEY\n"
+        if cmd == "RELAY BACKWARD":
+            if gui_event_get_node_name_from_port(cell.port) == "Server":
+                stream_id, response = unpack_stream(cell.payload)
+                return f"Stream: {stream_id}\nData: {response.decode()}\n"
+            return f"Data: DATA encrypted with RELAY {gui_event_get_node_name_from_port(cell.port)[-1]} SESSION KEY\n"
+        return ""
+
+    def store_circuit(self, circuit_id: int, sender_port: int, sk: str):
+        new_circuit = Circuit(circuit_id, sk)
         new_circuit.downstream_port = sender_port
-        self.circuit_dict[tor_header.circuit_id] = new_circuit
-        logging.info("Circuit initialized")
+        for removed_circuit in self.circuits.add(new_circuit):
+            if removed_circuit.downstream_port == sender_port and removed_circuit.circuit_id == circuit_id:
+                logging.warning(f"Circuit {circuit_id} from port {sender_port} is created again, replacing it")
+                self.send_destroy(removed_circuit, downstream=False, upstream=True)
+            else:
+                logging.info(f"Relay full, evicting least recently used circuit {removed_circuit.circuit_id}")
+                self.send_destroy(removed_circuit, downstream=True, upstream=True)
 
-        gui_event_stop(next_node=f"Relay {self.my_id}")
-        gui_event_start(f"Relay {self.my_id}: Replying back to inform that circuit has been successfully initialized")
+    def submit_handshake(self, cell: Cell):
+        circuit_id, sender_port = cell.tor_header.circuit_id, cell.port
+        if len(self.pending_handshakes) >= self.handshake_pool.max_pending:
+            logging.warning(f"{len(self.pending_handshakes)} handshakes in flight, refusing circuit {circuit_id} from port {sender_port}")
+            self.tor_send(circuit_id, "DESTROY", b"", sender_port)
+            return
+        job_id = next(self.handshake_ids)
+        self.pending_handshakes[job_id] = cell
+        self.handshake_pool.submit(job_id, cell.payload[0], cell.payload[1:])
 
-        # Create reply message and encrypt it
-        logging.info("Creating reply message...")
-        message = sk
-        logging.info(f"Message: RELAY {self.my_id} SESSION KEY")
-        encrypted_message = encrypt_with_rsa(gk, message)
-        logging.info("Encrypting reply message with CLIENT PUBLIC KEY...")
+    def finish_handshakes(self):
+        """Store the circuits of the handshakes the pool completed and reply CREATED to their clients"""
+        for job_id, result in self.handshake_pool.ready():
+            cell = self.pending_handshakes.pop(job_id)
+            circuit_id, sender_port = cell.tor_header.circuit_id, cell.port
+            if result is None:
+                self.tor_send(circuit_id, "DESTROY", b"", sender_port)
+                continue
+            sk, reply_data = result
+            self.store_circuit(circuit_id, sender_port, sk)
+            self.tor_send(circuit_id, "CREATED", bytes([cell.payload[0]]) + reply_data, sender_port)
 
-        gui_event_stop(next_node=f"Relay {self.my_id}")
-        gui_event_start(f"Relay {self.my_id}: Sending message to {gui_event_get_node_name_from_port(sender_port)}")
+    def find_circuit(self, circuit: Circuit, port: int, circuit_id: int) -> Circuit:
+        if circuit is None:
+            logging.warning(f"No circuit {circuit_id} on the link with port {port}")
+        return circuit
 
-        # Reply
-        logging.info(f"Sending CREATED message to port {sender_port}...")
-        outbound_data = {"sk": encrypted_message}
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(tor_header.circuit_id, 'CREATED').__dict__}\nData: RELAY {self.my_id} SESSION KEY encrypted with CLIENT PUBLIC KEY\nSender port: {self.my_port}")
-        self.tor_send(tor_header.circuit_id, "CREATED", outbound_data, sender_port)
-
-        gui_event_stop(next_node=gui_event_get_node_name_from_port(sender_port))
-
-    def extend(self, tor_header: TorHeader, data: str, sender_port: int):
-        gui_event_start(f"Relay {self.my_id}: Decrypting message")
-        logging.info("Command received: EXTEND")
-        logging.info("Decrypting message...")
-        circuit = self.circuit_dict[tor_header.circuit_id]
-        message = decrypt_with_aes(circuit.sk, data)
-        log_data = ""
-        if isinstance(json.loads(message)['data'], dict) or self.is_json(json.loads(message)['data']):
-            log_data = "CLIENT PUBLIC KEY"
-        else:
-            log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(json.loads(message)['target_port'])[-1]} SESSION KEY"
-        logging.info("DECRYPTED MESSAGE: " + log_data)
-        gui_event_stop(next_node=f"Relay {self.my_id}")
+    def evict_idle_circuits(self):
+        for circuit in self.circuits.expire():
+            logging.info(f"Circuit {circuit.circuit_id} from port {circuit.downstream_port} idle, tearing it down")
+            self.send_destroy(circuit, downstream=True, upstream=True)
+        if time.monotonic() - self.metrics_logged_at >= RELAY_METRICS_INTERVAL:
+            self.metrics_logged_at = time.monotonic()
+            logging.info(f"Relay {self.my_id} circuits: {self.circuits.stats()}")
 
-        gui_event_start(f"Relay {self.my_id}: Processing upstream node data")
-        logging.info("Processing data...")
-        message = json.loads(message)
-        inbound_tor_header = TorHeader(**message["tor_header"])
-        extracted_data = message["data"]
-        target_port = message["target_port"]
-
-        logging.info("Storing upstream node to memory...")
-        current_circuit = self.circuit_dict[tor_header.circuit_id]
-        current_circuit.upstream_port = target_port
-        self.circuit_where_upstream_id_equals[inbound_tor_header.circuit_id] = current_circuit
-        gui_event_stop(next_node=f"Relay {self.my_id}")
+    def send_destroy(self, circuit: Circuit, downstream: bool, upstream: bool):
+        if downstream:
+            self.tor_send(circuit.circuit_id, "DESTROY", b"", circuit.downstream_port)
+        if upstream and circuit.upstream_port:
+            self.tor_send(circuit.upstream_id, "DESTROY", b"", circuit.upstream_port)
 
-        gui_event_start(f"Relay {self.my_id}: Sending EXTEND/CREATE message to next relay node")
-        logging.info(f"Relaying message to next target port {target_port}...")
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(inbound_tor_header.circuit_id, inbound_tor_header.cmd).__dict__}\nData: {log_data}\nSender port: {self.my_port}")
-        self.tor_send(
-            inbound_tor_header.circuit_id,
-            inbound_tor_header.cmd,
-            extracted_data,
-            target_port
-        )
-        gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(target_port)}")
-
-    def cr_or_ext(self, tor_header: TorHeader, data: dict, sender_port: int):
-        gui_event_start(f"Relay {self.my_id}: Encrypting message")
-        logging.info("Received confirmation message of successful circuit build")
-        circuit: Circuit = self.circuit_where_upstream_id_equals[tor_header.circuit_id]
-        logging.info("Extracting data...")
-        log_data = ""
-        if isinstance(data, dict) or self.is_json(data):
-            log_data = f"RELAY {gui_event_get_node_name_from_port(sender_port)[-1]} SESSION KEY encrypted with CLIENT PUBLIC KEY"
+    def create(self, cell: Cell):
+        tor_header, sender_port, data = cell.tor_header, cell.port, cell.payload
+        narrate = narrating()
+        if self.handshake_pool is not None and not narrate:
+            self.submit_handshake(cell)
+            return
+        if narrate:
+            gui_event_start(f"Relay {self.my_id}: Initializing new circuit")
+            logging.info("Command received: CREATE")
+            logging.info("Initializing new circuit...")
+        # Initialize data
+        handshake_type, client_handshake_data = data[0], data[1:]
+        if handshake_type == HANDSHAKE_X25519:
+            if narrate:
+                logging.info("Generating ephemeral X25519 key pair...")
+            relay_private_key, relay_public_key = generate_x25519_key()
+            if narrate:
+                logging.info("Deriving session key from RELAY X25519 PRIVATE KEY and CLIENT X25519 PUBLIC KEY...")
+            sk = derive_x25519_session_key(relay_private_key, client_handshake_data, client_handshake_data, relay_public_key)
         else:
-            log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(sender_port)[-1]} SESSION KEY"
-        logging.info("DATA: " + log_data)
-        logging.info("Adding encryption layer...")
-        message = dict()
-        message["data"] = data
-        message_json = json.dumps(message)
-        encrypted_message = encrypt_with_aes(circuit.sk, message_json)
-        gui_event_stop(next_node=f"Relay {self.my_id}")
+            if narrate:
+                logging.info("Generating session key...")
+            sk = generate_session_key()
+
+        # Store circuit data
+        if narrate:
+            logging.info("Storing downstream node to memory...")
+        self.store_circuit(tor_header.circuit_id, sender_port, sk)
+        if narrate:
+            logging.info("Circuit initialized")
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Replying back to inform that circuit has been successfully initialized")
+            # Create reply message and encrypt it
+            logging.info("Creating reply message...")
+        if handshake_type == HANDSHAKE_X25519:
+            reply_data = relay_public_key
+            if narrate:
+                logging.info("Message: RELAY X25519 PUBLIC KEY")
+                log_data = f"RELAY {self.my_id} X25519 PUBLIC KEY"
+        else:
+            reply_data = encrypt_with_rsa(client_handshake_data.decode(), sk).encode()
+            if narrate:
+                logging.info(f"Message: RELAY {self.my_id} SESSION KEY")
+                logging.info("Encrypting reply message with CLIENT PUBLIC KEY...")
+                log_data = f"RELAY {self.my_id} SESSION KEY encrypted with CLIENT PUBLIC KEY"
+
+        # Reply
+        if narrate:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Sending message to {gui_event_get_node_name_from_port(sender_port)}")
+            logging.info(f"Sending CREATED message to port {sender_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(tor_header.circuit_id, 'CREATED').as_dict()}\nData: {log_data}\nSender port: {self.my_port}")
+        self.tor_send(tor_header.circuit_id, "CREATED", bytes([handshake_type]) + reply_data, sender_port)
+        if narrate:
+            gui_event_stop(next_node=gui_event_get_node_name_from_port(sender_port))
+
+    def extend(self, cell: Cell):
+        tor_header, sender_port = cell.tor_header, cell.port
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Relay {self.my_id}: Decrypting message")
+            logging.info("Command received: EXTEND")
+            logging.info("Decrypting message...")
+        circuit = self.find_circuit(self.circuits.from_downstream(sender_port, tor_header.circuit_id), sender_port, tor_header.circuit_id)
+        if circuit is None:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            return
+        # Data cells of this circuit go on upstream from now on
+        circuit.exit_counter = None
+        inner_cell = Cell.unpack(circuit.crypto.decrypt(cell.payload))
+        inbound_tor_header, target_port = inner_cell.tor_header, inner_cell.port
+        if narrate:
+            if inbound_tor_header.cmd == "CREATE":
+                log_data = "CLIENT PUBLIC KEY"
+            else:
+                log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(target_port)[-1]} SESSION KEY"
+            logging.info("DECRYPTED MESSAGE: " + log_data)
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Processing upstream node data")
+            logging.info("Processing data...")
 
-        gui_event_start(f"Relay {self.my_id}: Sending EXTENDED message to next relay node")
-        logging.info(f"Forwarding message to port {circuit.downstream_port}...")
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(circuit.circuit_id, 'EXTENDED').__dict__}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
+        if target_port != circuit.upstream_port:
+            self.circuits.bind_upstream(circuit, target_port)
+            if narrate:
+                logging.info("Storing upstream node to memory...")
+                logging.info(f"Circuit id on the link to port {target_port}: {circuit.upstream_id}")
+
+        if narrate:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Sending EXTEND/CREATE message to next relay node")
+            logging.info(f"Relaying message to next target port {target_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(circuit.upstream_id, inbound_tor_header.cmd).as_dict()}\nData: {log_data}\nSender port: {self.my_port}")
+        self.tor_send(circuit.upstream_id, inbound_tor_header.cmd, inner_cell.payload, target_port)
+        if narrate:
+            gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(target_port)}")
+
+    def cr_or_ext(self, cell: Cell):
+        tor_header, sender_port = cell.tor_header, cell.port
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Relay {self.my_id}: Encrypting message")
+            logging.info("Received confirmation message of successful circuit build")
+        circuit = self.find_circuit(self.circuits.from_upstream(sender_port, tor_header.circuit_id), sender_port, tor_header.circuit_id)
+        if circuit is None:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            return
+        if narrate:
+            logging.info("Extracting data...")
+            if tor_header.cmd == "CREATED":
+                log_data = f"RELAY {gui_event_get_node_name_from_port(sender_port)[-1]} SESSION KEY encrypted with CLIENT PUBLIC KEY"
+            else:
+                log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(sender_port)[-1]} SESSION KEY"
+            logging.info("DATA: " + log_data)
+            logging.info("Adding encryption layer...")
+        encrypted_message = circuit.crypto.encrypt(cell.payload)
+
+        if narrate:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Sending EXTENDED message to next relay node")
+            logging.info(f"Forwarding message to port {circuit.downstream_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(circuit.circuit_id, 'EXTENDED').as_dict()}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
         self.tor_send(circuit.circuit_id, "EXTENDED", encrypted_message, circuit.downstream_port)
-        gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(circuit.downstream_port)}")
-
-    def relay_forward(self, tor_header: TorHeader, data: str, sender_port: int):
-        gui_event_start(f"Relay {self.my_id}: Decrypting message")
-        logging.info("Command received: RELAY FORWARD")
-        logging.info("Peeling 1 layer of encryption...")
-        circuit = self.circuit_dict[tor_header.circuit_id]
-        message = decrypt_with_aes(circuit.sk, data)
-        log_data = ""
-        if isinstance(json.loads(message)['data'], dict) or self.is_json(json.loads(message)['data']):
-            log_data = json.loads(message)['data']
+        if narrate:
+            gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(circuit.downstream_port)}")
+
+    def relay_forward(self, cell: Cell):
+        started = time.monotonic()
+        tor_header, sender_port = cell.tor_header, cell.port
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Relay {self.my_id}: Decrypting message")
+            logging.info("Command received: RELAY FORWARD")
+            logging.info("Peeling 1 layer of encryption...")
+        circuit = self.find_circuit(self.circuits.from_downstream(sender_port, tor_header.circuit_id), sender_port, tor_header.circuit_id)
+        if circuit is None:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            return
+        crypto = circuit.crypto
+        block, body = split_payload(cell.payload)
+        block = crypto.unwrap_counters(block)
+        body = crypto.keystream_xor(block, body)
+        crypto_done = time.monotonic()
+        if circuit.exit_counter is None:
+            # Still under the layers of the relays further up
+            target_port, payload = circuit.upstream_port, onion_parts(block, body)
         else:
-            log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(json.loads(message)['target_port'])[-1]} SESSION KEY"
-        logging.info(f"\nDECRYPTED MESSAGE:\nTor header: {json.loads(message)['tor_header']}\nData: {log_data}\nTarget port: {json.loads(message)['target_port']}\nSender port: {self.my_port}")
-        gui_event_stop(next_node=f"Relay {self.my_id}")
+            target_port, payload = unseal(body)
+        if narrate:
+            if gui_event_get_node_name_from_port(target_port) == "Server":
+                stream_id, request = unpack_stream(payload)
+                log_data = f"{request.decode()} (stream {stream_id})"
+            else:
+                log_data = f"DATA encrypted with RELAY {gui_event_get_node_name_from_port(target_port)[-1]} SESSION KEY"
+            logging.info(f"\nDECRYPTED MESSAGE:\nData: {log_data}\nTarget port: {target_port}\nSender port: {self.my_port}")
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Forwarding message")
+
+        if target_port != circuit.upstream_port:
+            # The exit relay opens the circuit's link to the server on the first request
+            self.circuits.bind_upstream(circuit, target_port)
+        if narrate:
+            logging.info(f"Relaying message to next target port {target_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(circuit.upstream_id, 'RELAY FORWARD').as_dict()}\nData: {log_data}\nSender port: {self.my_port}")
+        trace = None
+        if cell.trace is not None:
+            trace = cell.trace + hop_record(self.my_port, FORWARD, cell.received_at, started, crypto_done)
+        self.tor_send(circuit.upstream_id, "RELAY FORWARD", payload, target_port, trace)
+        if narrate:
+            gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(target_port)}")
 
-        gui_event_start(f"Relay {self.my_id}: Forwarding message")
-        message = json.loads(message)
-        inbound_tor_header = TorHeader(**message["tor_header"])
-        extracted_data = message["data"]
-        target_port = message["target_port"]
-
-        logging.info(f"Relaying message to next target port {target_port}...")
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(inbound_tor_header.circuit_id, inbound_tor_header.cmd).__dict__}\nData: {log_data}\nSender port: {self.my_port}")
-        self.tor_send(
-            inbound_tor_header.circuit_id,
-            inbound_tor_header.cmd,
-            extracted_data,
-            target_port
-        )
-        gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(target_port)}")
-
-    def relay_backward(self, tor_header: TorHeader, data: dict):
-        gui_event_start(f"Relay {self.my_id}: Encrypting message")
-        logging.info("Command received: RELAY BACKWARD")
-        if tor_header.circuit_id in self.circuit_where_upstream_id_equals:
-            circuit: Circuit = self.circuit_where_upstream_id_equals[tor_header.circuit_id]
+    def relay_backward(self, cell: Cell):
+        started = time.monotonic()
+        tor_header, sender_port = cell.tor_header, cell.port
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Relay {self.my_id}: Encrypting message")
+            logging.info("Command received: RELAY BACKWARD")
+        circuit = self.find_circuit(self.circuits.from_upstream(sender_port, tor_header.circuit_id), sender_port, tor_header.circuit_id)
+        if circuit is None:
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            return
+        if circuit.exit_counter is None:
+            block, body = split_payload(cell.payload)
         else:
-            circuit: Circuit = self.circuit_dict[tor_header.circuit_id-1]
-        logging.info("Adding 1 encryption layer...")
-        message = dict()
-        message["data"] = data
-        message_json = json.dumps(message)
-        encrypted_message = encrypt_with_aes(circuit.sk, message_json)
-        logging.info(f"\nENCRYPTED MESSAGE\nTor header: {TorHeader(circuit.circuit_id, 'RELAY BACKWARD').__dict__}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
-        gui_event_stop(next_node=f"Relay {self.my_id}")
+            # The server's response gets its first layer here
+            block, body = counter_block(KEYSTREAM_BACKWARD, self.next_exit_counter(circuit)), seal(0, cell.payload)
+        crypto = circuit.crypto
+        encrypted_message = onion_parts(crypto.wrap_counters(block), crypto.keystream_xor(block, body))
+        crypto_done = time.monotonic()
+        if narrate:
+            logging.info("Adding 1 encryption layer...")
+            logging.info(f"\nENCRYPTED MESSAGE\nTor header: {TorHeader(circuit.circuit_id, 'RELAY BACKWARD').as_dict()}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            gui_event_start(f"Relay {self.my_id}: Relaying message")
+            logging.info(f"Relaying message to port {circuit.downstream_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE\nTor header: {TorHeader(circuit.circuit_id, 'RELAY BACKWARD').as_dict()}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
+        trace = None
+        if cell.trace is not None:
+            trace = cell.trace + hop_record(self.my_port, BACKWARD, cell.received_at, started, crypto_done)
+        self.tor_send(circuit.circuit_id, "RELAY BACKWARD", encrypted_message, circuit.downstream_port, trace)
+        if narrate:
+            gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(circuit.downstream_port)}")
 
-        gui_event_start(f"Relay {self.my_id}: Relaying message")
-        logging.info(f"Relaying message to port {circuit.downstream_port}...")
-        logging.info(f"\nOUTBOUND MESSAGE\nTor header: {TorHeader(circuit.circuit_id, 'RELAY BACKWARD').__dict__}\nData: DATA encrypted with RELAY {self.my_id} SESSION KEY\nSender port: {self.my_port}")
-        self.tor_send(circuit.circuit_id, "RELAY BACKWARD", encrypted_message, circuit.downstream_port)
-        gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(circuit.downstream_port)}")
-
-    def tor_send(self, circuit_id: int, cmd: str, data, target_port: int):
-        message = dict()
-        message["tor_header"] = TorHeader(circuit_id, cmd).__dict__
-        message["data"] = data
-        message["sender_port"] = self.my_port
-        outbound_message = json.dumps(message)
-        self.sending_procedure(outbound_message, target_port)
-    
-    def is_json(self, data: str):
-        try:
-            json.loads(data)
-        except ValueError as e:
-            return False
-        return True
+    def next_exit_counter(self, circuit: Circuit) -> int:
+        with self.exit_counter_lock:
+            counter = circuit.exit_counter
+            circuit.exit_counter = counter + 1
+        return counter
+
+    def destroy(self, cell: Cell):
+        tor_header, sender_port = cell.tor_header, cell.port
+        gui_event_start(f"Relay {self.my_id}: Tearing down circuit")
+        logging.info("Command received: DESTROY")
+        circuit = self.circuits.from_downstream(sender_port, tor_header.circuit_id)
+        from_downstream = circuit is not None
+        if circuit is None:
+            circuit = self.circuits.from_upstream(sender_port, tor_header.circuit_id)
+        if circuit is None or not self.circuits.remove(circuit):
+            logging.info(f"Circuit {tor_header.circuit_id} from port {sender_port} is already gone")
+            gui_event_stop(next_node=f"Relay {self.my_id}")
+            return
+        logging.info("Circuit removed from memory")
+        # Pass the DESTROY on along the circuit, away from where it came from
+        self.send_destroy(circuit, downstream=not from_downstream, upstream=from_downstream)
+        gui_event_stop(next_node=f"Relay {self.my_id}")
 
 
 def thread_exception_handler(args):
     logging.error(f"Uncaught exception", exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
 
 def reload_logging(filename):
-    from importlib import reload
-    reload(logging)
-    logging.basicConfig(format='%(asctime)-4s %(levelname)-6s %(threadName)s:%(lineno)-3d %(message)s',
-                        datefmt='%H:%M:%S',
-                        filename=f"logs/{filename}",
-                        filemode='w',
-                        level=logging.INFO)
-
-def main(node_id: int, ports_of_nodes: list, my_port: int = 0, node_number: int = 0):
+    start_node_logging(f"logs/{filename}", logging.INFO)
+
+def main(node_id: int, ports_of_nodes: list, my_port: int = 0, node_number: int = 0, async_mode: bool = False, fast_mode: bool = False,
+         worker: int = 0, workers: int = 1, sc: socket.socket = None, handshake_pool: HandshakePool = None):
     threading.excepthook = thread_exception_handler
+    set_fast_mode(fast_mode)
     file_name_prefix = f"Relay {node_id}"
+    if workers > 1:
+        file_name_prefix += f" worker {worker}"
     reload_logging(f"{file_name_prefix}.txt")
+    # The GUI replays one event trace per relay, the workers of a sharded relay narrate in their logs only
+    if not fast_mode and workers == 1:
+        start_event_trace(file_name_prefix)
     try:
-        obj = RelayNode(my_id=node_id, my_port=my_port, ports_of_nodes=ports_of_nodes, node_number=node_number)
-        obj.start()
+        obj = RelayNode(my_id=node_id, my_port=my_port, ports_of_nodes=ports_of_nodes, node_number=node_number,
+                        worker=worker, workers=workers, sc=sc, handshake_pool=handshake_pool)
+        if async_mode:
+            obj.start_async()
+        else:
+            obj.start()
     except Exception:
         logging.exception("Caught Error")
         raise
\ No newline at end of file
@@ -1,63 +1,148 @@
-import json
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import logging
 import threading
-from data.header import TorHeader
+import time
+from data.cell import Cell
+from data.header import UNKNOWN_COMMAND, TorHeader
+from data.hop_trace import SERVER, hop_record
+from data.stream import pack_stream, unpack_stream
 from pprint import pformat
 from node import Node
 from data.gui_logging_tools import *
+from data.node_logging import start_node_logging
+
+SERVER_WORKERS = 4
+# Requests waiting for a worker, per worker, before the server stops reading new ones
+SERVER_BACKLOG_PER_WORKER = 4
+
+class RequestHandler(ABC):
+    """Turns the payload of a request into the payload of its response
+
+    Handlers run on the server's worker threads, so several requests can be in one handler at once.
+    """
+
+    @abstractmethod
+    def handle(self, request: bytes) -> bytes:
+        ...
+
+
+class AcceptHandler(RequestHandler):
+    """Default handler, appends " accepted" to every request"""
+
+    def handle(self, request: bytes) -> bytes:
+        return request + b" accepted"
+
 
 class ServerNode(Node):
 
-    def __init__(self, my_port: int, node_number: int):
+    def __init__(self, my_port: int, node_number: int, handler: RequestHandler = None):
         super().__init__(my_id=-1, my_port=my_port)
+        self.handler = handler or AcceptHandler()
 
     def start(self):
         logging.info("Listening for request...")
-        gui_event_start(f"Server: Receive request message")
-        inbound_message_json = self.listen_procedure()
-        inbound_message = json.loads(inbound_message_json)
-        header = TorHeader(**inbound_message["tor_header"])
-        data = inbound_message["data"]
-        logging.info(f"\nINBOUND MESSAGE:\nTor header: {inbound_message['tor_header']}\nData: {inbound_message['data']}\nSender port: {inbound_message['sender_port']}")
-        gui_event_stop(next_node="Server")
-        self.send_response(header, data["message"], inbound_message["sender_port"])
-    
-    def send_response(self, tor_header: TorHeader, request_message: str, sender_port: int):
-        gui_event_start(f"Server: Send response message")
-        response_message = request_message + " accepted"
-        logging.info(f"Sending response message to port {sender_port}...")
-        outbound_data = {"message": response_message}
-        logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(tor_header.circuit_id, 'RELAY BACKWARD').__dict__}\nData: {outbound_data}\nSender port: {self.my_port}")
-        self.tor_send(tor_header.circuit_id, "RELAY BACKWARD", outbound_data, sender_port)
-        gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(sender_port)}")
-    
-    def tor_send(self, circuit_id: int, cmd: str, data, target_port: int):
-        message = dict()
-        message["tor_header"] = TorHeader(circuit_id, cmd).__dict__
-        message["data"] = data
-        message["sender_port"] = self.my_port
-        outbound_message = json.dumps(message)
-        self.sending_procedure(outbound_message, target_port)
+        self.handle_message(self.listen_procedure())
+
+    def serve_forever(self, workers: int = SERVER_WORKERS):
+        """Keep answering requests, running the handler for overlapping requests concurrently on a bounded pool"""
+        # Node processes cannot start processes of their own, see main.start_nodes, so the pool is threads
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Server handler")
+        backlog = threading.BoundedSemaphore(workers * SERVER_BACKLOG_PER_WORKER)
+        try:
+            while True:
+                if narrating():
+                    logging.info("Listening for request...")
+                try:
+                    received = self.receive_request(self.listen_procedure())
+                except Exception:
+                    logging.exception("Failed to handle message")
+                    continue
+                if received is None:
+                    continue
+                cell, stream_id, request = received
+                backlog.acquire()
+                future = executor.submit(self.run_handler, cell, request)
+                future.add_done_callback(partial(self.on_request_handled, backlog, cell.tor_header, stream_id, cell.port))
+        finally:
+            executor.shutdown(wait=False)
+
+    def on_request_handled(self, backlog: threading.BoundedSemaphore, tor_header: TorHeader, stream_id: int, sender_port: int,
+                           future: Future):
+        backlog.release()
+        try:
+            response, trace = future.result()
+        except Exception:
+            logging.exception(f"Request handler failed on stream {stream_id}")
+            return
+        self.send_response(tor_header, stream_id, response, sender_port, trace)
+
+    def handle_message(self, inbound_message: bytes, received_at: float = None):
+        received = self.receive_request(inbound_message, received_at)
+        if received is None:
+            return
+        cell, stream_id, request = received
+        response, trace = self.run_handler(cell, request)
+        self.send_response(cell.tor_header, stream_id, response, cell.port, trace)
+
+    def run_handler(self, cell: Cell, request: bytes):
+        """The handler's response, and the hop records to send back with it if the request was traced"""
+        started = time.monotonic()
+        response = self.handler.handle(request)
+        if cell.trace is None:
+            return response, None
+        return response, cell.trace + hop_record(self.my_port, SERVER, cell.received_at, started, time.monotonic())
+
+    def receive_request(self, inbound_message: bytes, received_at: float = None):
+        cell = Cell.unpack(inbound_message, time.monotonic() if received_at is None else received_at)
+        header, sender_port, data = cell.tor_header, cell.port, cell.payload
+        if header.cmd == "DESTROY":
+            # The server keeps no state per circuit
+            logging.debug(f"Circuit {header.circuit_id} from port {sender_port} destroyed")
+            return None
+        if header.cmd == UNKNOWN_COMMAND:
+            logging.debug(f"Received unknown command from port {sender_port}")
+            return None
+        stream_id, request = unpack_stream(data)
+        if narrating():
+            gui_event_start(f"Server: Receive request message")
+            logging.info(f"\nINBOUND MESSAGE:\nTor header: {header.as_dict()}\nStream: {stream_id}\nData: {request.decode(errors='replace')}\nSender port: {sender_port}")
+            gui_event_stop(next_node="Server")
+        return cell, stream_id, request
+
+    def send_response(self, tor_header: TorHeader, stream_id: int, response: bytes, sender_port: int, trace: bytes = None):
+        narrate = narrating()
+        if narrate:
+            gui_event_start(f"Server: Send response message")
+            logging.info(f"Sending response message to port {sender_port}...")
+            logging.info(f"\nOUTBOUND MESSAGE:\nTor header: {TorHeader(tor_header.circuit_id, 'RELAY BACKWARD').as_dict()}\nStream: {stream_id}\nData: {response.decode(errors='replace')}\nSender port: {self.my_port}")
+        self.tor_send(tor_header.circuit_id, "RELAY BACKWARD", pack_stream(stream_id, response), sender_port, trace)
+        if narrate:
+            gui_event_stop(next_node=f"{gui_event_get_node_name_from_port(sender_port)}")
 
 
 def thread_exception_handler(args):
     logging.error(f"Uncaught exception", exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
 
 def reload_logging(filename):
-    from importlib import reload
-    reload(logging)
-    logging.basicConfig(format='%(asctime)-4s %(levelname)-6s %(threadName)s:%(lineno)-3d %(message)s',
-                        datefmt='%H:%M:%S',
-                        filename=f"logs/{filename}",
-                        filemode='w',
-                        level=logging.DEBUG)
-
-def main(my_port: int = 0, node_number: int = 0):
+    start_node_logging(f"logs/{filename}", logging.DEBUG)
+
+def main(my_port: int = 0, node_number: int = 0, async_mode: bool = False, persistent: bool = False, workers: int = SERVER_WORKERS,
+         fast_mode: bool = False):
     threading.excepthook = thread_exception_handler
+    set_fast_mode(fast_mode)
     reload_logging("Server.txt")
+    if not fast_mode:
+        start_event_trace("Server")
     try:
         obj = ServerNode(my_port=my_port, node_number=node_number)
-        obj.start()
+        if async_mode:
+            obj.start_async()
+        elif persistent:
+            obj.serve_forever(workers)
+        else:
+            obj.start()
     except Exception:
         logging.exception("Caught Error")
         raise